@@ -0,0 +1,107 @@
+import numpy as np
+from Wavefront import WavefrontRenderer
+from PathTracer import PathTracer
+
+"""
+    Adaptive sampler, spends the sample budget on the pixels that are still noisy
+    Keeps a running mean and variance for every pixel with Welford's method
+"""
+
+
+class AdaptiveSampler:
+    scene = None
+    min_samples: int = 4
+    max_samples: int = 64
+    sample_budget: int = 0
+    error_threshold: float = 0.01
+    count: np.ndarray = None
+    mean: np.ndarray = None
+    m2: np.ndarray = None
+
+    def __init__(self, scene, min_samples: int = 4, max_samples: int = 64, sample_budget: int = None,
+                 error_threshold: float = 0.01):
+        """
+        :param scene: Scene to render, through its camera
+        :param min_samples: Samples every pixel gets before its variance is trusted
+        :param max_samples: Most samples any one pixel gets
+        :param sample_budget: Total samples for the frame, 16 per pixel if not given, at least one per pixel
+        :param error_threshold: A pixel is done once the standard error of its mean is below this in every channel
+        """
+        self.scene = scene
+        self.min_samples = max(2, int(min_samples))
+        self.max_samples = max(self.min_samples, int(max_samples))
+        n_pixels = scene.cam.x_res * scene.cam.y_res
+        self.sample_budget = int(sample_budget) if sample_budget is not None else 16 * n_pixels
+        if self.sample_budget < n_pixels:
+            # pixels that never get a sample would come out black
+            raise ValueError("AdaptiveSampler __init__: Sample budget is below one sample per pixel ",
+                             self.sample_budget)
+        self.error_threshold = float(error_threshold)
+
+        self.count = np.zeros([n_pixels, ], dtype=np.int64)
+        self.mean = np.zeros([n_pixels, scene.color_channels])
+        self.m2 = np.zeros([n_pixels, scene.color_channels])
+
+    def add_samples(self, pixels: np.ndarray, colors: np.ndarray):
+        # Welford update, pixels must not repeat within one call
+        self.count[pixels] += 1
+        delta = colors - self.mean[pixels]
+        self.mean[pixels] += delta/self.count[pixels, None]
+        self.m2[pixels] += delta * (colors - self.mean[pixels])
+
+    def error(self) -> np.ndarray:
+        # standard error of each pixel's mean, worst channel, np.inf for pixels with fewer than two samples
+        n = self.count[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            err = np.sqrt(self.m2/(n - 1)/n).max(axis=1)
+        return np.where(self.count < 2, np.inf, err)
+
+    def render(self, n_bounces: int = 1, n_incident_rays: int = 1, mode: str = "recursive",
+               batch_size: int = 4096) -> np.ndarray:
+        """
+        Gives every pixel min_samples samples, then keeps sampling the noisiest pixels
+        until they converge, hit max_samples, or the budget runs out
+        :param mode: "recursive" samples through Scene.get_color one ray at a time, "path" through the path tracer,
+                     "wavefront" in batches
+        :param batch_size: Most pixels sampled between variance updates
+        :return: The image, same as Scene.render
+        """
+        self.scene.check_mode(mode, "render_adaptive")
+        cam = self.scene.cam
+        n_pixels = self.count.size
+        budget = self.sample_budget
+        every_pixel = np.arange(n_pixels)
+        for s in range(self.min_samples):
+            if budget < n_pixels:
+                break
+            self.add_samples(every_pixel, self.sample(every_pixel, n_bounces, n_incident_rays, mode))
+            budget -= n_pixels
+
+        while budget > 0:
+            err = self.error()
+            err[self.count >= self.max_samples] = 0
+            noisy = np.flatnonzero(err > self.error_threshold)
+            if noisy.size == 0:
+                break
+            # the worst first
+            noisy = noisy[np.argsort(-err[noisy], kind='stable')][:min(batch_size, budget)]
+            self.add_samples(noisy, self.sample(noisy, n_bounces, n_incident_rays, mode))
+            budget -= noisy.size
+
+        cam.image[:] = self.mean.reshape([cam.y_res, cam.x_res, -1]).transpose((1, 0, 2))
+        return cam.get_image()
+
+    def sample(self, pixels: np.ndarray, n_bounces: int, n_incident_rays: int, mode: str) -> np.ndarray:
+        # one new sample for each pixel, numbered by how many it already has
+        if mode == "wavefront":
+            return WavefrontRenderer(self.scene).render_pixels(pixels, n_bounces, n_incident_rays,
+                                                               first_sample=self.count[pixels])
+        x_res = self.scene.cam.x_res
+        tracer = PathTracer(self.scene) if mode == "path" else None
+        return np.array([self.scene.render_pixel(p % x_res, p // x_res, n_bounces, n_incident_rays, mode=mode,
+                                                 first_sample=self.count[p], tracer=tracer)
+                         for p in pixels]).reshape([-1, self.scene.color_channels])
+
+    def sample_map(self) -> np.ndarray:
+        # how many samples each pixel got, laid out like the image
+        return self.count.reshape([self.scene.cam.y_res, self.scene.cam.x_res])
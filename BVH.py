@@ -0,0 +1,308 @@
+import numpy as np
+from RayTraceInfo import HitInfo, MISS
+
+"""
+    Bounding volume hierarchy over axis aligned boxes
+    Built top down with binned surface area heuristic splits, stored as flat arrays of nodes
+    The BVH only knows about boxes, the caller supplies how to intersect the primitive behind a box
+"""
+
+
+def box_entry(lo: np.ndarray, hi: np.ndarray, origins: np.ndarray, inv_dirs: np.ndarray) -> np.ndarray:
+    """
+    Slab test of rays against one box
+    :param lo: [3, ] lower corner
+    :param hi: [3, ] upper corner
+    :param origins: [N, 3] or [3, ] ray origins
+    :param inv_dirs: 1/direction for each ray, same shape as origins
+    :return: distance along each ray to where it enters the box, np.inf if it never does
+    """
+    with np.errstate(invalid='ignore'):
+        t1 = (lo - origins) * inv_dirs
+        t2 = (hi - origins) * inv_dirs
+    # a ray running exactly along a slab face gives a nan, it lies inside that slab so the slab is skipped
+    along = np.isnan(t1) | np.isnan(t2)
+    t_near = np.where(along, -np.inf, np.minimum(t1, t2)).max(axis=-1)
+    t_far = np.where(along, np.inf, np.maximum(t1, t2)).min(axis=-1)
+    return np.where((t_near <= t_far) & (t_far >= 0), np.maximum(t_near, 0), np.inf)
+
+
+def round_out(lo: np.ndarray, hi: np.ndarray, dtype) -> tuple[np.ndarray, np.ndarray]:
+    # boxes stored as a smaller float type are rounded outward, so they still hold everything they held before
+    lo_out = lo.astype(dtype)
+    hi_out = hi.astype(dtype)
+    lo_out = np.where(lo_out > lo, np.nextafter(lo_out, -np.inf), lo_out).astype(dtype)
+    hi_out = np.where(hi_out < hi, np.nextafter(hi_out, np.inf), hi_out).astype(dtype)
+    return lo_out, hi_out
+
+
+def surface_area(lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    extent = np.maximum(hi - lo, 0)
+    return 2 * (extent[..., 0] * extent[..., 1] + extent[..., 1] * extent[..., 2] + extent[..., 2] * extent[..., 0])
+
+
+class BVH:
+    leaf_size: int = 4
+    n_bins: int = 16
+    dtype: np.dtype = np.dtype(np.float64)
+    node_lo: np.ndarray = None
+    node_hi: np.ndarray = None
+    node_left: np.ndarray = None
+    node_right: np.ndarray = None
+    node_start: np.ndarray = None
+    node_count: np.ndarray = None
+    prim_order: np.ndarray = None
+    __nodes: list = None
+
+    def __init__(self, lo: np.ndarray, hi: np.ndarray, leaf_size: int = 4, n_bins: int = 16, dtype=np.float64):
+        """
+        :param lo: [N, 3] lower corner of every primitive's box
+        :param hi: [N, 3] upper corner of every primitive's box
+        :param leaf_size: Most primitives a leaf will hold before the builder tries to split it
+        :param n_bins: Number of candidate split planes tried along each axis
+        :param dtype: Float type the node boxes are kept in, the tree is always built in float64
+        """
+        self.leaf_size = int(leaf_size)
+        self.n_bins = int(n_bins)
+        self.dtype = np.dtype(dtype)
+        self.build(lo, hi)
+
+    def __len__(self):
+        return self.prim_order.size
+
+    def build(self, lo: np.ndarray, hi: np.ndarray):
+        lo = np.array(lo, dtype=float).reshape([-1, 3])
+        hi = np.array(hi, dtype=float).reshape([-1, 3])
+        centroids = (lo + hi)/2
+        order = np.arange(lo.shape[0])
+
+        nodes_lo, nodes_hi, left, right, start, count = [], [], [], [], [], []
+
+        def new_node(first, n):
+            prims = order[first:first + n]
+            nodes_lo.append(lo[prims].min(axis=0) if n else np.zeros(3))
+            nodes_hi.append(hi[prims].max(axis=0) if n else np.zeros(3))
+            left.append(-1)
+            right.append(-1)
+            start.append(first)
+            count.append(n)
+            return len(start) - 1
+
+        # explicit stack, badly clustered scenes can go deeper than python's recursion limit
+        stack = [new_node(0, order.size)]
+        while stack:
+            node = stack.pop()
+            first, n = start[node], count[node]
+            if n <= self.leaf_size:
+                continue
+            prims = order[first:first + n]
+            split = self.__find_split(lo[prims], hi[prims], centroids[prims], nodes_lo[node], nodes_hi[node])
+            if split is None:
+                continue
+            axis, goes_left = split
+            order[first:first + n] = np.concatenate([prims[goes_left], prims[~goes_left]])
+            n_left = int(goes_left.sum())
+
+            left[node] = new_node(first, n_left)
+            right[node] = new_node(first + n_left, n - n_left)
+            stack.append(left[node])
+            stack.append(right[node])
+
+        nodes_lo = np.array(nodes_lo).reshape([-1, 3])
+        nodes_hi = np.array(nodes_hi).reshape([-1, 3])
+        self.node_lo, self.node_hi = round_out(nodes_lo, nodes_hi, self.dtype)
+        self.node_left = np.array(left)
+        self.node_right = np.array(right)
+        self.node_start = np.array(start)
+        self.node_count = np.array(count)
+        self.prim_order = order
+        self.__nodes = None
+
+    def __find_split(self, lo, hi, centroids, box_lo, box_hi):
+        """
+        Binned SAH, returns the best axis and which primitives go left,
+        or None when keeping the node as a leaf is cheaper than any split
+        """
+        n = centroids.shape[0]
+        best_cost = n * surface_area(box_lo, box_hi)
+        best = None
+        c_lo = centroids.min(axis=0)
+        c_hi = centroids.max(axis=0)
+        for axis in range(3):
+            extent = c_hi[axis] - c_lo[axis]
+            if extent <= 0:
+                continue
+            bins = np.minimum(((centroids[:, axis] - c_lo[axis])/extent * self.n_bins).astype(int), self.n_bins - 1)
+            bin_count = np.bincount(bins, minlength=self.n_bins)
+            bin_lo = np.full([self.n_bins, 3], np.inf)
+            bin_hi = np.full([self.n_bins, 3], -np.inf)
+            np.minimum.at(bin_lo, bins, lo)
+            np.maximum.at(bin_hi, bins, hi)
+
+            # bounds and counts of everything left of each split plane, and everything right of it
+            left_lo = np.minimum.accumulate(bin_lo, axis=0)[:-1]
+            left_hi = np.maximum.accumulate(bin_hi, axis=0)[:-1]
+            right_lo = np.minimum.accumulate(bin_lo[::-1], axis=0)[::-1][1:]
+            right_hi = np.maximum.accumulate(bin_hi[::-1], axis=0)[::-1][1:]
+            left_n = np.cumsum(bin_count)[:-1]
+            right_n = n - left_n
+
+            with np.errstate(invalid='ignore'):
+                cost = surface_area(left_lo, left_hi) * left_n + surface_area(right_lo, right_hi) * right_n
+            cost[(left_n == 0) | (right_n == 0)] = np.inf
+            plane = int(np.argmin(cost))
+            if cost[plane] < best_cost:
+                best_cost = cost[plane]
+                best = (axis, bins <= plane)
+
+        if best is None and n > 4 * self.leaf_size:
+            # nothing beats a leaf (all the centroids sit together), still keep leaves small
+            axis = int(np.argmax(box_hi - box_lo))
+            goes_left = np.zeros(n, dtype=bool)
+            goes_left[np.argsort(centroids[:, axis], kind='stable')[:n // 2]] = True
+            best = (axis, goes_left)
+        return best
+
+    def refit(self, lo: np.ndarray, hi: np.ndarray):
+        """
+        Updates the node boxes after primitives moved, keeping the tree as it is.
+        Children are always made after their parent, so walking the nodes backwards is bottom up
+        """
+        lo = np.array(lo, dtype=float).reshape([-1, 3])
+        hi = np.array(hi, dtype=float).reshape([-1, 3])
+        node_lo = self.node_lo.astype(float)
+        node_hi = self.node_hi.astype(float)
+        for node in range(self.node_start.size - 1, -1, -1):
+            if self.node_left[node] < 0:
+                prims = self.prim_order[self.node_start[node]:self.node_start[node] + self.node_count[node]]
+                if prims.size:
+                    node_lo[node] = lo[prims].min(axis=0)
+                    node_hi[node] = hi[prims].max(axis=0)
+            else:
+                l, r = self.node_left[node], self.node_right[node]
+                node_lo[node] = np.minimum(node_lo[l], node_lo[r])
+                node_hi[node] = np.maximum(node_hi[l], node_hi[r])
+        self.node_lo, self.node_hi = round_out(node_lo, node_hi, self.dtype)
+        self.__nodes = None
+
+    def __scalar_nodes(self) -> list:
+        # the nodes as plain python tuples, a single ray walks these much faster than numpy rows
+        if self.__nodes is None:
+            self.__nodes = [tuple(lo) + tuple(hi) + (left, right, [int(p) for p in self.prim_order[start:start + n]])
+                            for lo, hi, left, right, start, n in
+                            zip(self.node_lo.tolist(), self.node_hi.tolist(), self.node_left.tolist(),
+                                self.node_right.tolist(), self.node_start.tolist(), self.node_count.tolist())]
+        return self.__nodes
+
+    def closest_hit(self, origin: np.ndarray, direction: np.ndarray, intersect: callable,
+                    best_hit: HitInfo = None) -> HitInfo:
+        """
+        Closest hit for a single ray
+        :param origin: [3, ] ray origin
+        :param direction: [3, ] ray direction
+        :param intersect: intersect(prim) -> HitInfo for the primitive with that index
+        :param best_hit: Hit to beat, from primitives outside the BVH
+        :return: The closest hit with 0 < t, or best_hit (a miss if not given)
+        """
+        best = best_hit if best_hit is not None else MISS
+        best_t = best.t_hit
+        ox, oy, oz = origin.tolist()
+        # a ray running along an axis never crosses that axis' slabs, it is either between them or not
+        ix, iy, iz = [1/c if c != 0 else None for c in direction.tolist()]
+        nodes = self.__scalar_nodes()
+        stack = [0]
+        while stack:
+            lx, ly, lz, hx, hy, hz, left, right, prims = nodes[stack.pop()]
+            t_near, t_far = 0.0, best_t
+            for lo, hi, o, inv in ((lx, hx, ox, ix), (ly, hy, oy, iy), (lz, hz, oz, iz)):
+                if inv is None:
+                    if o < lo or o > hi:
+                        t_near = np.inf
+                        break
+                    continue
+                t1 = (lo - o) * inv
+                t2 = (hi - o) * inv
+                if t1 > t2:
+                    t1, t2 = t2, t1
+                if t1 > t_near:
+                    t_near = t1
+                if t2 < t_far:
+                    t_far = t2
+            if t_near > t_far:
+                continue
+            if left < 0:
+                for prim in prims:
+                    hit = intersect(prim)
+                    if hit.did_hit and 0 < hit.t_hit < best_t:
+                        best = hit
+                        best_t = hit.t_hit
+            else:
+                stack.append(right)
+                stack.append(left)
+        return best
+
+    def closest_hit_batch(self, origins: np.ndarray, directions: np.ndarray, intersect_batch: callable,
+                          best_t: np.ndarray = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Closest hit for a batch of rays, the rays that still might hit a node travel through it together
+        :param origins: [N, 3] ray origins
+        :param directions: [N, 3] unit ray directions
+        :param intersect_batch: intersect_batch(prim, origins, directions) -> [M, ] t for that primitive
+        :param best_t: [N, ] distances to beat, from primitives outside the BVH
+        :return: [N, ] closest t (np.inf for a miss), [N, ] primitive index (-1 for a miss)
+        """
+        n = origins.shape[0]
+        best_t = np.full(n, np.inf, dtype=origins.dtype) if best_t is None else np.array(best_t, dtype=origins.dtype)
+        best_prim = np.full(n, -1)
+        with np.errstate(divide='ignore'):
+            inv_dirs = 1/directions
+
+        stack = [(0, np.arange(n))]
+        while stack:
+            node, rays = stack.pop()
+            t_enter = box_entry(self.node_lo[node], self.node_hi[node], origins[rays], inv_dirs[rays])
+            rays = rays[t_enter < best_t[rays]]
+            if rays.size == 0:
+                continue
+            if self.node_left[node] < 0:
+                first = self.node_start[node]
+                for prim in self.prim_order[first:first + self.node_count[node]]:
+                    t = intersect_batch(prim, origins[rays], directions[rays])
+                    closer = t < best_t[rays]
+                    best_t[rays[closer]] = t[closer]
+                    best_prim[rays[closer]] = prim
+            else:
+                stack.append((self.node_right[node], rays))
+                stack.append((self.node_left[node], rays))
+        return best_t, best_prim
+
+    def nearest_batch(self, points: np.ndarray, distance_batch: callable,
+                      tolerance: float = 0.0) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Which primitive each of a batch of points lies on, for points found by intersecting the primitives
+        :param points: [N, 3] points
+        :param distance_batch: distance_batch(prim, points) -> [M, ] how far the points are from that primitive
+        :param tolerance: Boxes are grown by this much, a hit point can land a rounding error outside its box
+        :return: [N, ] smallest distance (np.inf if no box held the point), [N, ] primitive index (-1 if none did)
+        """
+        n = points.shape[0]
+        best_d = np.full(n, np.inf)
+        best_prim = np.full(n, -1)
+        stack = [(0, np.arange(n))]
+        while stack:
+            node, inside = stack.pop()
+            p = points[inside]
+            inside = inside[((p >= self.node_lo[node] - tolerance) & (p <= self.node_hi[node] + tolerance)).all(axis=1)]
+            if inside.size == 0:
+                continue
+            if self.node_left[node] < 0:
+                first = self.node_start[node]
+                for prim in self.prim_order[first:first + self.node_count[node]]:
+                    d = distance_batch(prim, points[inside])
+                    closer = d < best_d[inside]
+                    best_d[inside[closer]] = d[closer]
+                    best_prim[inside[closer]] = prim
+            else:
+                stack.append((self.node_right[node], inside))
+                stack.append((self.node_left[node], inside))
+        return best_d, best_prim
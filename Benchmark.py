@@ -0,0 +1,285 @@
+import argparse
+import json
+import os
+import tracemalloc
+import numpy as np
+import RayTracingObjects as rto
+from PIL import Image as im
+from time import perf_counter
+from Camera import Camera
+from Scene import Scene
+from Wavefront import WavefrontRenderer
+from PathTracer import PathTracer
+from Sampler import get_sampler
+from GBuffer import capture
+from Denoise import atrous
+
+"""
+    Benchmark suite, renders a fixed set of scenes and reports how fast they went
+    The canonical scenes rebuild the ones behind ray_traced_images, so their output can also be held
+    against those images. The stress scenes pile up random spheres to load the BVH
+
+    python Benchmark.py --resolutions 32 64 128 --bounces 1 3 5 --modes wavefront recursive --json results.json
+"""
+
+REFERENCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ray_traced_images")
+SKY = [.537, .812, .941]
+
+
+def table(plane_y: float = -.15, plane_specular: float = 0.0, lit: bool = True) -> list[rto.RTOType]:
+    # the grey table from testing.py, and the light behind the camera
+    objects = [rto.Plane(np.array([0, plane_y, 0]), np.array([0, .9, 0]), color=np.array([0.5, 0.5, 0.5]),
+                         specular_power=plane_specular)]
+    if lit:
+        objects.append(rto.Plane([0, 0, -1], [0, 0, 1],
+                                 light_source=True, light_strength=1.0, light_color=np.array([1, 1, 1])))
+    return objects
+
+
+def two_orbs(res: int, red_specular: float = 0.0, green_specular: float = 0.0, x: float = .25,
+             red_y: float = 0.0, plane_y: float = -.15, plane_specular: float = 0.0, lit: bool = True) -> Scene:
+    """
+    The red and green orb scene from testing.py, orbs sitting on a grey table lit from behind the camera
+    :param res: Camera resolution, both ways
+    :param x: How far each orb is from the middle
+    :param red_y: Height of the red orb
+    :param plane_y: Height of the table
+    :param lit: Put the light behind the camera, otherwise the sky is the only light
+    """
+    cam = Camera(np.array([0, 0, 0]), np.array([0, 0, 1]), x_res=res, y_res=res)
+    green = rto.Sphere(.15, np.array([x, 0, 1.5]), color=np.array([0, 1, 0]), specular_power=green_specular)
+    red = rto.Sphere(.15, np.array([-x, red_y, 1.5]), color=np.array([1, 0, 0]), specular_power=red_specular)
+    return Scene(cam, *table(plane_y, plane_specular, lit), green, red, color=SKY)
+
+
+def stress_scene(res: int, n_spheres: int, seed: int = 0) -> Scene:
+    # lots of small random orbs floating over the table, under the same light
+    rng = np.random.default_rng(seed)
+    cam = Camera(np.array([0, 0, 0]), np.array([0, 0, 1]), x_res=res, y_res=res)
+    orbs = [rto.Sphere(rng.uniform(.005, .03), rng.uniform([-1, -.15, 1], [1, .6, 3]),
+                       color=rng.uniform(0, 1, 3), specular_power=rng.uniform()) for k in range(n_spheres)]
+    return Scene(cam, *table(), *orbs, color=SKY)
+
+
+# name: (builder taking the resolution, reference image, (n_bounces, n_incident_rays) it was rendered with)
+SCENES = {
+    "three_touching": (lambda res: two_orbs(res, .5, .5, x=.15, plane_specular=.5),
+                       "5_bounces_3_touching_half_specular_power.png", (5, 50)),
+    "two_orbs_diffuse": (lambda res: two_orbs(res), "two_orbs_only_diffuse.png", (5, 50)),
+    "two_orbs_mirror": (lambda res: two_orbs(res, 1, 1), "two_orbs_perfectly_reflective.png", (5, 50)),
+    "two_orbs_one_mirror": (lambda res: two_orbs(res, 1, 0), "two_orbs_5_bounces_1_mirror.png", (5, 50)),
+    "mirror_table": (lambda res: two_orbs(res, 1, 0, red_y=-.35, plane_y=-.5, plane_specular=1),
+                     "two_orbs_5_bounces_1_shiny_orb_mirror_plane.png", (5, 50)),
+    "two_balls_and_plane": (lambda res: two_orbs(res, lit=False), "two_balls_and_plane.png", (2, 50)),
+    "stress_1k": (lambda res: stress_scene(res, 1000), None, None),
+    "stress_10k": (lambda res: stress_scene(res, 10000), None, None),
+}
+
+
+def render(scene: Scene, mode: str, n_bounces: int, n_incident_rays: int, n_rays: int,
+           backend: str = "auto", workers: int = None) -> tuple[np.ndarray, int]:
+    # renders the way Scene.render would, but keeps hold of the renderer to read its ray count
+    if mode == "preview":
+        image = scene.render(mode=mode, backend=backend)
+        return image, image.shape[0] * image.shape[1]
+    if workers is not None:
+        # the rays are counted in the workers, they don't come back
+        return scene.render(n_bounces, n_incident_rays, n_rays, mode=mode, workers=workers, backend=backend), None
+    if mode == "wavefront":
+        renderer = WavefrontRenderer(scene, backend=backend)
+        image = renderer.render(n_bounces, n_incident_rays, n_rays)
+        return image, renderer.rays_traced
+    if mode == "path":
+        renderer = PathTracer(scene)
+        image = renderer.render(n_bounces, n_incident_rays, n_rays)
+        return image, renderer.rays_traced
+    scene.rays_traced = 0
+    image = scene.render(n_bounces, n_incident_rays, n_rays, mode=mode)
+    return image, scene.rays_traced
+
+
+def run(name: str, res: int, n_bounces: int, mode: str = "wavefront", n_incident_rays: int = 1, n_rays: int = 1,
+        backend: str = "auto", workers: int = None, memory: bool = True, seed: int = 0,
+        precision: str = "float64") -> dict:
+    """
+    Benchmarks one scene at one setting
+    :param name: Key into SCENES
+    :param precision: "float64" or "float32", see Scene.set_precision
+    :param memory: Render a second time under tracemalloc for the peak memory,
+                   kept out of the timed render since tracing slows python code down
+    :return: The settings and measurements, rates are per second of render time
+    """
+    build, reference, reference_settings = SCENES[name]
+    start = perf_counter()
+    scene = build(res)
+    scene.set_precision(precision)
+    scene.compile()
+    setup_time = perf_counter() - start
+
+    np.random.seed(seed)
+    start = perf_counter()
+    image, total_rays = render(scene, mode, n_bounces, n_incident_rays, n_rays, backend, workers)
+    wall_time = perf_counter() - start
+
+    peak_memory = None
+    if memory:
+        np.random.seed(seed)
+        tracemalloc.start()
+        render(scene, mode, n_bounces, n_incident_rays, n_rays, backend, workers)
+        peak_memory = tracemalloc.get_traced_memory()[1]/2**20
+        tracemalloc.stop()
+
+    primary_rays = res * res * n_rays
+    return {"scene": name, "objects": len(scene.objects), "mode": mode, "precision": precision, "backend": backend,
+            "workers": workers,
+            "resolution": res, "n_bounces": n_bounces, "n_incident_rays": n_incident_rays, "n_rays": n_rays,
+            "setup_time": setup_time, "wall_time": wall_time,
+            "primary_rays": primary_rays, "total_rays": total_rays,
+            "primary_rays_per_s": primary_rays/wall_time,
+            "total_rays_per_s": total_rays/wall_time if total_rays is not None else None,
+            "peak_memory_mb": peak_memory}
+
+
+def block_means(image: np.ndarray, blocks: int = 16) -> np.ndarray:
+    # [blocks, blocks, 3] average color over a coarse grid, so images of different sizes can be held side by side
+    image = np.asarray(image, dtype=float)[..., :3]
+    rows = np.linspace(0, image.shape[0], blocks + 1).astype(int)
+    cols = np.linspace(0, image.shape[1], blocks + 1).astype(int)
+    return np.array([[image[rows[a]:rows[a + 1], cols[b]:cols[b + 1]].reshape([-1, 3]).mean(axis=0)
+                      for b in range(blocks)] for a in range(blocks)])
+
+
+def compare_to_reference(image: np.ndarray, reference: np.ndarray, blocks: int = 16, tolerance: float = 6.0) -> dict:
+    """
+    Holds a render against a reference image. Both are noisy and not the same size,
+    so they are compared as averages over a coarse grid of blocks rather than pixel for pixel
+    :param image: [y_res, x_res, 3] uint8 render
+    :param reference: [H, W, 3 or 4] uint8 reference
+    :param tolerance: Most the average block may be off by, in 0-255 levels
+    :return: Mean and 95th percentile block error, and whether it passed
+    """
+    error = np.abs(block_means(image, blocks) - block_means(reference, blocks))
+    mean_error = float(error.mean())
+    return {"mean_error": mean_error, "p95_error": float(np.percentile(error, 95)),
+            "passed": bool(mean_error <= tolerance)}
+
+
+def check_references(res: int = 64, mode: str = "wavefront", n_incident_rays: int = 16, backend: str = "auto",
+                     tolerance: float = 6.0, seed: int = 0) -> list[dict]:
+    # renders every canonical scene with the bounces its reference was made with, and compares the two
+    results = []
+    for name, (build, reference, reference_settings) in SCENES.items():
+        if reference is None:
+            continue
+        np.random.seed(seed)
+        image, total_rays = render(build(res), mode, reference_settings[0], n_incident_rays, 1, backend)
+        result = compare_to_reference(image, np.asarray(im.open(os.path.join(REFERENCE_DIR, reference))),
+                                      tolerance=tolerance)
+        result.update({"scene": name, "reference": reference, "resolution": res, "mode": mode})
+        results.append(result)
+    return results
+
+
+def convergence(name: str = "two_orbs_diffuse", res: int = 32, n_bounces: int = 2,
+                samplers: tuple = ("random", "stratified", "halton", "sobol"), sample_counts: tuple = (1, 4, 16, 64),
+                reference_samples: int = 1024, seed: int = 0, denoise: bool = False) -> list[dict]:
+    """
+    How far each sampler's wavefront render is from a converged one, at a few samples per pixel.
+    The error is the RMS difference in 0-1 colors, so a sampler that gets to an error with fewer samples wins
+    :param name: Key into SCENES
+    :param reference_samples: Samples per pixel of the converged render, made with a Sobol sampler of another seed
+    :param denoise: Also measure every render after Denoise.atrous, as the sampler name with "+denoise"
+    """
+    scene = SCENES[name][0](res)
+    pixels = np.arange(res * res)
+    gbuffer = capture(scene) if denoise else None
+    scene.sampler = get_sampler("sobol", seed + 1)
+    reference = WavefrontRenderer(scene).render_pixels(pixels, n_bounces, 1, reference_samples)
+    results = []
+    for sampler in samplers:
+        scene.sampler = get_sampler(sampler, seed)
+        for n in sample_counts:
+            colors = WavefrontRenderer(scene).render_pixels(pixels, n_bounces, 1, n)
+            results.append({"scene": name, "sampler": sampler, "samples": n,
+                            "rms_error": float(np.sqrt(np.mean((colors - reference)**2)))})
+            if denoise:
+                # pixels go row by row, the same layout as the G-buffer
+                denoised = atrous(colors.reshape([res, res, -1]), gbuffer).reshape(colors.shape)
+                results.append({"scene": name, "sampler": sampler + "+denoise", "samples": n,
+                                "rms_error": float(np.sqrt(np.mean((denoised - reference)**2)))})
+    return results
+
+
+def print_runs(results: list[dict]):
+    print(f"{'scene':20s} {'mode':10s} {'float':7s} {'res':>5s} {'bounces':>7s} {'wall s':>8s} {'primary/s':>11s} "
+          f"{'total/s':>11s} {'peak MB':>8s}")
+    for r in results:
+        total = f"{r['total_rays_per_s']:11.0f}" if r["total_rays_per_s"] is not None else f"{'-':>11s}"
+        memory = f"{r['peak_memory_mb']:8.2f}" if r["peak_memory_mb"] is not None else f"{'-':>8s}"
+        print(f"{r['scene']:20s} {r['mode']:10s} {r['precision']:7s} {r['resolution']:5d} {r['n_bounces']:7d} "
+              f"{r['wall_time']:8.3f} {r['primary_rays_per_s']:11.0f} {total} {memory}")
+
+
+def print_checks(checks: list[dict]):
+    print(f"{'scene':20s} {'mean err':>8s} {'p95 err':>8s}  result")
+    for c in checks:
+        print(f"{c['scene']:20s} {c['mean_error']:8.2f} {c['p95_error']:8.2f}  {'ok' if c['passed'] else 'FAIL'}")
+
+
+def print_convergence(results: list[dict]):
+    counts = sorted({r["samples"] for r in results})
+    print(f"{'sampler':18s} " + " ".join(f"{f'{n} spp':>9s}" for n in counts))
+    for sampler in dict.fromkeys(r["sampler"] for r in results):
+        errors = {r["samples"]: r["rms_error"] for r in results if r["sampler"] == sampler}
+        print(f"{sampler:18s} " + " ".join(f"{errors[n]:9.4f}" for n in counts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the renderer on the canonical and stress scenes")
+    parser.add_argument("--scenes", nargs="+", default=list(SCENES), choices=list(SCENES))
+    parser.add_argument("--resolutions", nargs="+", type=int, default=[32, 64, 128])
+    parser.add_argument("--bounces", nargs="+", type=int, default=[1, 3, 5])
+    parser.add_argument("--modes", nargs="+", default=["wavefront"],
+                        choices=["recursive", "wavefront", "path", "preview"])
+    parser.add_argument("--incident-rays", type=int, default=1)
+    parser.add_argument("--rays", type=int, default=1, help="camera rays per pixel")
+    parser.add_argument("--precision", nargs="+", default=["float64"], choices=["float64", "float32"],
+                        help="float types to render in, both to compare them")
+    parser.add_argument("--backend", default="auto", choices=["auto", "numpy", "numba"])
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass")
+    parser.add_argument("--check", action="store_true", help="compare the canonical scenes to their references")
+    parser.add_argument("--tolerance", type=float, default=6.0)
+    parser.add_argument("--convergence", action="store_true",
+                        help="compare how fast the samplers converge on the first scene")
+    parser.add_argument("--denoise", action="store_true", help="also measure the converging renders denoised")
+    parser.add_argument("--json", default=None, help="write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for name in args.scenes:
+        for mode in args.modes:
+            for precision in args.precision:
+                for res in args.resolutions:
+                    for n_bounces in args.bounces:
+                        results.append(run(name, res, n_bounces, mode, args.incident_rays, args.rays, args.backend,
+                                           args.workers, not args.no_memory, precision=precision))
+    checks = check_references(backend=args.backend, tolerance=args.tolerance) if args.check else []
+    converging = convergence(args.scenes[0], denoise=args.denoise) if args.convergence else []
+
+    print_runs(results)
+    if checks:
+        print()
+        print_checks(checks)
+    if converging:
+        print()
+        print_convergence(converging)
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump({"runs": results, "reference_checks": checks, "convergence": converging}, f, indent=2)
+    if not all(c["passed"] for c in checks):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
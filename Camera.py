@@ -1,7 +1,6 @@
 import numpy as np
 from Ray import Ray
 import forward_funcs as ff
-import FunctionMatrix as FMat
 from RayTraceInfo import RayColorInfo
 
 """
@@ -16,6 +15,8 @@ class Camera:
     to: np.ndarray = None
     dist: float = 0.0
     f: float = 0.0
+    fixed_focal_length: bool = False
+    up: np.ndarray = None
     num_channels: int = 3
     x_res: int = 256
     y_res: int = 256
@@ -23,16 +24,25 @@ class Camera:
     field_of_view_y: float = 0
     x_values: np.ndarray = None
     y_values: np.ndarray = None
+    x_steps: np.ndarray = None
+    y_steps: np.ndarray = None
     global_to_camera: np.ndarray = None
     camera_to_global: np.ndarray = None
+    pixel_grid: np.ndarray = None
+    image: np.ndarray = None
+    dtype: np.dtype = np.dtype(np.float64)
+    sample_sum: np.ndarray = None
+    sample_sq_sum: np.ndarray = None
+    sample_count: np.ndarray = None
 
     def __init__(self, origin, looking_at, x_res: int = 256, y_res: int = 256,
                  focal_length: float = 0.0, num_colors: int = 3, warped_lens: bool = False,
-                 field_of_view_x: float = np.pi/2, field_of_view_y: float = np.pi/2, radians: bool = True):
-        self.loc = np.array(origin).reshape([3, ])
-        self.to = np.array(looking_at).reshape([3, ])
-        self.dist = np.linalg.norm(self.to - self.loc)
-        self.f = float(focal_length) if focal_length > 0 else self.dist
+                 field_of_view_x: float = np.pi/2, field_of_view_y: float = np.pi/2, radians: bool = True,
+                 up=(0, 1, 0), keep_image: bool = True, dtype=np.float64):
+        self.fixed_focal_length = focal_length > 0
+        self.dtype = np.dtype(dtype)
+        self.f = float(focal_length)
+        self.up = np.array(up, dtype=float).reshape([3, ])
         self.num_channels = int(num_colors)
         self.x_res = int(x_res)
         self.y_res = int(y_res)
@@ -45,76 +55,183 @@ class Camera:
         else:
             self.x_values = np.linspace(-np.sin(self.field_of_view_x / 2), np.sin(self.field_of_view_x / 2), self.x_res)
             self.y_values = np.linspace(np.sin(self.field_of_view_y / 2), -np.sin(self.field_of_view_y / 2), self.y_res)
+        # how wide each pixel is on the focal plane, for rays jittered around the pixel's middle
+        self.x_steps = np.gradient(self.x_values) if self.x_res > 1 else np.full(1, 2 * np.sin(self.field_of_view_x/2))
+        self.y_steps = np.gradient(self.y_values) if self.y_res > 1 else np.full(1, -2 * np.sin(self.field_of_view_y/2))
+
+        # a camera that only streams its tiles out (TiledRenderer.render_to) never needs a full frame in memory
+        if keep_image:
+            self.image = np.zeros([self.x_res, self.y_res, self.num_channels], dtype=self.dtype)
 
-        self.image = np.zeros([self.x_res, self.y_res, self.num_channels])
+        self.set_pose(origin, looking_at)
+
+    def set_pose(self, origin, looking_at, up=None):
+        """
+        Moves the camera, keeping its resolution, lens, pixel grid and image buffer.
+        Cheap enough to call for every frame of an animation
+        :param origin: New camera location
+        :param looking_at: New point the camera looks at
+        :param up: New up vector, keeps the current one if not given
+        """
+        self.loc = np.array(origin, dtype=float).reshape([3, ])
+        self.to = np.array(looking_at, dtype=float).reshape([3, ])
+        if up is not None:
+            self.up = np.array(up, dtype=float).reshape([3, ])
+        self.dist = np.linalg.norm(self.to - self.loc)
+        if not self.fixed_focal_length:
+            self.f = self.dist
 
         self.__find_camera_frame()
+        # samples from the old pose don't belong to the new one
+        self.reset_samples()
+
+    def set_precision(self, dtype):
+        """
+        Float type of the image and of the batched camera rays, the frame itself is always worked out in float64
+        :param dtype: np.float32 or np.float64
+        """
+        self.dtype = np.dtype(dtype)
+        if self.image is not None:
+            self.image = self.image.astype(self.dtype)
 
-    def __find_camera_frame(self, alpha=0.1, min_d=1e-8):
+    def __find_camera_frame(self):
         """
-        Uses Gradient Descent to find the frame for the camera with respect to the global frame.
+        Builds the look-at frame for the camera with respect to the global frame.
+        Camera z points at the target, x to the right and y up, as close to self.up as z allows.
         The inverse of this can be used to determine where a point in the camera's coordinate system is
         in the global coordinate system. The latter is generally more useful,
         as it allows us to shoot beams with reckless abandon
 
-        :param: alpha: Accuracy and speed parameter for gradient descent
-                min_d: Highest acceptable tolerance
-        :return: initialized parameter in self.camera_frame and self.camera_to_global
+        :return: initialized parameter in self.global_to_camera and self.camera_to_global
         """
-        eye_loc = self.loc
-        look_to = self.to
-        direction = np.array(look_to - eye_loc).reshape([3, ])
-        direction = direction/np.linalg.norm(direction)
-
-        target = np.array([0, 0, 1]).reshape([3, ])
-
-        pos = lambda phi1, phi2, phi3: ff.rotate_3d(phi1, phi2, phi3) @ direction
-        dx = lambda phi1, phi2, phi3: target - pos(phi1, phi2, phi3)
+        forward = self.to - self.loc
+        forward = forward/np.linalg.norm(forward)
 
-        dist = lambda phi1, phi2, phi3: np.linalg.norm(dx(phi1, phi2, phi3))
+        right = np.cross(self.up, forward)
+        if np.linalg.norm(right) < 1e-12:
+            # looking straight along the up vector, any right angle to it will do
+            right = np.cross([1.0, 0.0, 0.0] if abs(forward[0]) < 0.9 else [0.0, 1.0, 0.0], forward)
+        right = right/np.linalg.norm(right)
+        up = np.cross(forward, right)
 
-        mat = FMat.FunctionMatrix(num_vars=3, funcs=dist)
-        cur_angs = np.array([0.0, 0.0, 0.0]).reshape([3, ])
+        rotation = np.stack([right, up, forward], axis=1)
+        self.camera_to_global = ff.homogenous_transform(rotation, self.loc.reshape([3, 1]))
+        self.global_to_camera = ff.homogenous_transform(rotation.T, -rotation.T @ self.loc.reshape([3, 1]))
 
-        # simple gradient descent algorithm to find the angles we need to rotate the original direction by
-        # that will place it at (0, 0, 1) wrt the camera
-        # we can invert this to take (0, 0, 1) wrt the camera and find the geometric coordinates
-        d = dist(*cur_angs)
-        i = 0
-        while d > min_d and i < 1000:
-            j = mat.jacobian_at_point(*cur_angs)
-            cur_angs = cur_angs - alpha * d * j.reshape([3, ])
-            d = dist(*cur_angs)
-            i += 1
-
-        self.global_to_camera = ff.homogenous_transform(ff.rotate_3d(*cur_angs), self.loc.reshape([3, 1]))
-        self.camera_to_global = np.linalg.inv(self.global_to_camera)
-
-    def get_geo_coords(self, x_pixel: int, y_pixel: int) -> np.ndarray:
+    def get_geo_coords(self, x_pixel: int, y_pixel: int, offset: tuple = None) -> np.ndarray:
         """
         Return the geometric coordinates associated with a given pixel number
         :param x_pixel: X pixel from the left to the right
         :param y_pixel: Y pixel from the top to the bottom
+        :param offset: (x, y) from the middle of the pixel, in pixels, the middle if not given
         :return: The global coordinates associated with that value as a [3, ] np array
         """
         # what is the point on the focal plane that we are looking to shoot through?
         # self.f is either specified, or defaults to dist
         # x_values is a range from sin(-fov_x/2) to sin(fov_x/2)
         # same with y_values, except using fov_y
-        to = self.f * np.array([self.x_values[x_pixel], self.y_values[y_pixel], 1]).reshape([3, ])
+        x, y = self.x_values[x_pixel], self.y_values[y_pixel]
+        if offset is not None:
+            x, y = x + offset[0] * self.x_steps[x_pixel], y + offset[1] * self.y_steps[y_pixel]
+        to = self.f * np.array([x, y, 1]).reshape([3, ])
 
         return ff.homo_to_points(self.camera_to_global @ ff.points_to_homo(to.reshape([3, 1]))).reshape([3, ])
 
-    def ray_through_pixel(self, x: int, y: int, num_bounces: int = 0) -> Ray:
-        # shoots a ray through a given pixel, starts full white
-        return Ray(self.loc, self.get_geo_coords(x, y), num_bounces,
+    def get_pixel_grid(self) -> np.ndarray:
+        """
+        The homogeneous camera-frame point one unit in front of the camera for every pixel, row first, then column.
+        Only depends on the resolution and lens, so it is built once and reused for every frame and pose
+        :return: [x_res * y_res, 4] array
+        """
+        if self.pixel_grid is None:
+            xs, ys = np.meshgrid(self.x_values, self.y_values)
+            self.pixel_grid = np.stack([xs.ravel(), ys.ravel(), np.ones(xs.size), np.ones(xs.size)], axis=1)
+        return self.pixel_grid
+
+    def primary_rays(self, samples_per_pixel: int = 1, pixels: np.ndarray = None,
+                     offsets: np.ndarray = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Every camera ray of the frame at once, the batched version of ray_through_pixel
+        :param samples_per_pixel: How many rays to shoot through each pixel, they sit next to each other
+        :param pixels: Flat pixel indices (j * x_res + i) to shoot through, every pixel if not given
+        :param offsets: [number of pixels, 2] where each ray crosses its pixel, (x, y) in pixels from its middle
+        :return: origins and unit directions, both [y_res * x_res * samples_per_pixel, 3],
+                 ordered row first, then column, then sample
+        """
+        if pixels is None and offsets is None:
+            grid = self.get_pixel_grid()
+        else:
+            # the same rows get_pixel_grid would have, without building the whole grid for a few pixels
+            pixels = np.asarray(pixels) if pixels is not None else np.arange(self.x_res * self.y_res)
+            i, j = pixels % self.x_res, pixels // self.x_res
+            xs, ys = self.x_values[i], self.y_values[j]
+            if offsets is not None:
+                xs, ys = xs + offsets[:, 0] * self.x_steps[i], ys + offsets[:, 1] * self.y_steps[j]
+            grid = np.stack([xs, ys, np.ones(xs.size), np.ones(xs.size)], axis=1)
+        targets = grid @ self.camera_to_global[:-1, :].T
+        directions = targets - self.loc
+        directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+        directions = directions.astype(self.dtype, copy=False)
+        if samples_per_pixel > 1:
+            directions = np.repeat(directions, samples_per_pixel, axis=0)
+        origins = np.broadcast_to(self.loc.astype(self.dtype), directions.shape)
+        return origins, directions
+
+    def ray_through_pixel(self, x: int, y: int, num_bounces: int = 0, offset: tuple = None) -> Ray:
+        # shoots a ray through a given pixel, offset from its middle if given, starts full white
+        return Ray(self.loc, self.get_geo_coords(x, y, offset), num_bounces,
                    RayColorInfo(self.num_channels, np.array([1, 1, 1])))
 
+    def tiles(self, tile_size: int = 32):
+        """
+        Splits the frame into square tiles, row first, then column
+        :param tile_size: Width and height of the tiles, the ones on the right and bottom edges may be smaller
+        :return: List of (x_start, x_stop, y_start, y_stop)
+        """
+        return [(x, min(x + tile_size, self.x_res), y, min(y + tile_size, self.y_res))
+                for y in range(0, self.y_res, tile_size) for x in range(0, self.x_res, tile_size)]
+
     def set_color(self, x: int, y: int, color: np.ndarray):
         # sets the color of a pixel
         c = color.reshape([self.num_channels, ])
         self.image[x, y, :] = c[:]
 
+    def reset_samples(self):
+        # forgets every accumulated sample, the buffers are made again on the next add_samples
+        self.sample_sum = None
+        self.sample_sq_sum = None
+        self.sample_count = None
+
+    def add_samples(self, pixels: np.ndarray, colors: np.ndarray):
+        """
+        Adds samples to the running per pixel sums, and puts the new averages in the image
+        :param pixels: Flat pixel indices (j * x_res + i), may repeat
+        :param colors: [len(pixels), C] sampled colors
+        """
+        if self.sample_count is None:
+            self.sample_sum = np.zeros([self.y_res * self.x_res, self.num_channels])
+            self.sample_sq_sum = np.zeros([self.y_res * self.x_res, self.num_channels])
+            self.sample_count = np.zeros([self.y_res * self.x_res, ], dtype=np.int64)
+        np.add.at(self.sample_sum, pixels, colors)
+        np.add.at(self.sample_sq_sum, pixels, colors**2)
+        np.add.at(self.sample_count, pixels, 1)
+
+        touched = np.unique(pixels)
+        mean = self.sample_sum[touched]/self.sample_count[touched, None]
+        self.image[touched % self.x_res, touched // self.x_res] = mean
+
+    def noise_level(self) -> float:
+        """
+        How far the accumulated image is from converged
+        :return: The standard error of the per pixel means, averaged over pixels and channels. np.inf until every
+                 pixel has at least two samples
+        """
+        if self.sample_count is None or self.sample_count.min() < 2:
+            return np.inf
+        n = self.sample_count[:, None]
+        variance = np.maximum(self.sample_sq_sum/n - (self.sample_sum/n)**2, 0) * n/(n - 1)
+        return float(np.sqrt(variance/n).mean())
+
     def get_image(self) -> np.ndarray:
         # returns the array
         return np.uint8(self.image.transpose((1, 0, 2)) * 255)
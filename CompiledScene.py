@@ -0,0 +1,297 @@
+import json
+import os
+import numpy as np
+import RayTracingObjects as rto
+from BVH import BVH
+from RayTraceInfo import RayColorInfo
+
+"""
+    Packed, read-only form of a scene for the batched renderers
+    Geometry is kept as struct-of-arrays per primitive type, materials as a table indexed by integer id,
+    so the hot loops never walk the python objects
+"""
+
+# what each object was packed as
+SPHERE = 0
+PLANE = 1
+OTHER = 2
+
+# on disk a compiled scene is a directory holding one .npy file per array, and a manifest describing them
+FILE_FORMAT = "raycasting-compiled-scene"
+FILE_VERSION = 1
+MANIFEST = "manifest.json"
+SCENE_ARRAYS = ("ambient", "object_kind", "object_index", "object_material",
+                "sphere_centers", "sphere_radii", "sphere_radii2", "sphere_object",
+                "plane_points", "plane_normals", "plane_offsets", "plane_object", "other_object",
+                "material_color", "material_emitted", "material_shown", "material_specular",
+                "bvh_object", "unbounded")
+BVH_ARRAYS = ("node_lo", "node_hi", "node_left", "node_right", "node_start", "node_count", "prim_order")
+
+
+def read_only(*arrays: np.ndarray):
+    for a in arrays:
+        a.setflags(write=False)
+
+
+class CompiledScene:
+    color_channels: int = 3
+    dtype: np.dtype = np.dtype(np.float64)
+    epsilon: float = rto.EPSILON
+    ambient: np.ndarray = None
+    object_kind: np.ndarray = None
+    object_index: np.ndarray = None
+    object_material: np.ndarray = None
+    sphere_centers: np.ndarray = None
+    sphere_radii: np.ndarray = None
+    sphere_radii2: np.ndarray = None
+    sphere_object: np.ndarray = None
+    plane_points: np.ndarray = None
+    plane_normals: np.ndarray = None
+    plane_offsets: np.ndarray = None
+    plane_object: np.ndarray = None
+    other_objects: list = []
+    other_object: np.ndarray = None
+    material_color: np.ndarray = None
+    material_emitted: np.ndarray = None
+    material_shown: np.ndarray = None
+    material_specular: np.ndarray = None
+    bvh: BVH = None
+    bvh_object: np.ndarray = None
+    unbounded: np.ndarray = None
+    # the directory it was loaded from, if it was
+    source: str = None
+    mmap_mode: str = None
+
+    def __init__(self, objects: list, ambient_color: np.ndarray, color_channels: int = 3, dtype=np.float64):
+        """
+        :param objects: The scene's RTOTypes, object k here is objects[k] there
+        :param ambient_color: Color of rays that miss everything
+        :param color_channels: Number of color channels
+        :param dtype: Float type of every packed array, np.float32 halves the memory traffic of a render
+        """
+        self.color_channels = int(color_channels)
+        self.dtype = np.dtype(dtype)
+        self.epsilon = rto.epsilon_for(self.dtype)
+        self.set_ambient(ambient_color)
+
+        kinds = [SPHERE if isinstance(o, rto.Sphere) else PLANE if isinstance(o, rto.Plane) else OTHER
+                 for o in objects]
+        self.object_kind = np.array(kinds, dtype=np.int8)
+        self.object_index = np.zeros([len(objects), ], dtype=np.int64)
+        for kind in (SPHERE, PLANE, OTHER):
+            of_kind = self.object_kind == kind
+            self.object_index[of_kind] = np.arange(of_kind.sum())
+        self.sphere_object = np.flatnonzero(self.object_kind == SPHERE)
+        self.plane_object = np.flatnonzero(self.object_kind == PLANE)
+        self.other_object = np.flatnonzero(self.object_kind == OTHER)
+        self.other_objects = [objects[k] for k in self.other_object]
+        read_only(self.object_kind, self.object_index, self.sphere_object, self.plane_object, self.other_object)
+
+        self.pack_geometry(objects)
+        self.pack_materials(objects)
+        self.__build_bvh()
+
+    def __len__(self):
+        return self.object_kind.size
+
+    def pack_geometry(self, objects: list):
+        # (re)reads where every sphere and plane is, the objects have to be the same ones, in the same order
+        spheres = [objects[k] for k in self.sphere_object]
+        planes = [objects[k] for k in self.plane_object]
+        # worked out in float64, then stored as dtype
+        centers = np.array([o.center for o in spheres], dtype=float).reshape([-1, 3])
+        radii = np.array([o.radius for o in spheres], dtype=float)
+        points = np.array([o.p for o in planes], dtype=float).reshape([-1, 3])
+        normals = np.array([o.norm for o in planes], dtype=float).reshape([-1, 3])
+        self.sphere_centers = centers.astype(self.dtype)
+        self.sphere_radii = radii.astype(self.dtype)
+        self.sphere_radii2 = (radii**2).astype(self.dtype)
+        self.plane_points = points.astype(self.dtype)
+        self.plane_normals = normals.astype(self.dtype)
+        self.plane_offsets = np.einsum('ij,ij->i', points, normals).astype(self.dtype)
+        read_only(self.sphere_centers, self.sphere_radii, self.sphere_radii2,
+                  self.plane_points, self.plane_normals, self.plane_offsets)
+
+    def set_ambient(self, ambient_color: np.ndarray):
+        # color of rays that miss everything, the way RayColorInfo shows it
+        self.ambient = RayColorInfo(self.color_channels, np.array(ambient_color)).ray_color.astype(self.dtype)
+        read_only(self.ambient)
+
+    def pack_materials(self, objects: list):
+        """
+        (Re)builds the material table, cheap enough to do before every render so material edits are picked up.
+        Objects sharing a MaterialInfo share a row
+        """
+        rows = dict()
+        infos = []
+        material = np.zeros([len(objects), ], dtype=np.int64)
+        for k, o in enumerate(objects):
+            info = o.get_color_info()
+            if id(info) not in rows:
+                rows[id(info)] = len(infos)
+                infos.append(info)
+            material[k] = rows[id(info)]
+
+        n, c, dtype = len(infos), self.color_channels, self.dtype
+        self.object_material = material
+        self.material_color = np.array([i.material_color for i in infos], dtype=dtype).reshape([n, c])
+        self.material_emitted = np.array([i.emitted_strength * i.emitted_color if i.emits_light else np.zeros(c)
+                                          for i in infos], dtype=dtype).reshape([n, c])
+        # the emitted light the way RayColorInfo shows it
+        self.material_shown = np.array([RayColorInfo(c, i).ray_color for i in infos], dtype=dtype).reshape([n, c])
+        self.material_specular = np.array([i.specular_probability for i in infos], dtype=dtype)
+        read_only(self.object_material, self.material_color, self.material_emitted,
+                  self.material_shown, self.material_specular)
+
+    def bounds(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # object ids, lower and upper corners of everything that has bounds, in float64
+        centers, radii = self.sphere_centers.astype(float), self.sphere_radii.astype(float)
+        lo = [centers - radii[:, None]]
+        hi = [centers + radii[:, None]]
+        ids = [self.sphere_object]
+        other_bounds = [o.bounds() for o in self.other_objects]
+        bounded_others = [k for k, b in enumerate(other_bounds) if b is not None]
+        if bounded_others:
+            lo.append(np.array([other_bounds[k][0] for k in bounded_others]).reshape([-1, 3]))
+            hi.append(np.array([other_bounds[k][1] for k in bounded_others]).reshape([-1, 3]))
+            ids.append(self.other_object[bounded_others])
+        return np.concatenate(ids), np.concatenate(lo), np.concatenate(hi)
+
+    def __build_bvh(self):
+        ids, lo, hi = self.bounds()
+        self.bvh_object = ids
+        self.unbounded = np.setdiff1d(np.arange(len(self)), ids)
+        self.bvh = BVH(lo, hi, dtype=self.dtype) if ids.size else None
+        read_only(self.bvh_object, self.unbounded)
+
+    def refit(self, objects: list):
+        # re-reads the geometry after objects moved, then refits the BVH around them instead of rebuilding it
+        self.pack_geometry(objects)
+        if self.bvh is not None:
+            ids, lo, hi = self.bounds()
+            self.bvh.refit(lo, hi)
+
+    def intersect_object(self, k: int, origins: np.ndarray, directions: np.ndarray, tests: list = None) -> np.ndarray:
+        # rays against object k, [N, ] t with np.inf for a miss, tests counts the rays tested against each kind
+        kind, i = self.object_kind[k], self.object_index[k]
+        if tests is not None:
+            tests[kind] += origins.shape[0]
+        if kind == SPHERE:
+            return rto.sphere_intersect_batch(self.sphere_centers[i], self.sphere_radii2[i], origins, directions,
+                                              self.epsilon)
+        if kind == PLANE:
+            return rto.plane_intersect_batch(self.plane_offsets[i], self.plane_normals[i], origins, directions,
+                                             self.epsilon)
+        return self.other_objects[i].intersect_batch(origins, directions)
+
+    def closest_hit_batch(self, origins: np.ndarray, directions: np.ndarray,
+                          tests: list = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Closest hit for a whole batch of rays
+        :param origins: [N, 3] ray origins
+        :param directions: [N, 3] unit ray directions
+        :param tests: If given, ray-object tests are added up here by kind (SPHERE, PLANE, OTHER)
+        :return: [N, ] nearest t (np.inf for a miss), [N, ] object id (-1 for a miss)
+        """
+        best_t = np.full(origins.shape[0], np.inf, dtype=origins.dtype)
+        best_obj = np.full(origins.shape[0], -1)
+        for k in self.unbounded:
+            t = self.intersect_object(k, origins, directions, tests)
+            closer = t < best_t
+            best_t[closer] = t[closer]
+            best_obj[closer] = k
+        if self.bvh is not None:
+            best_t, prim = self.bvh.closest_hit_batch(
+                origins, directions, lambda p, o, d: self.intersect_object(self.bvh_object[p], o, d, tests),
+                best_t)
+            best_obj = np.where(prim >= 0, self.bvh_object[np.maximum(prim, 0)], best_obj)
+        return best_t, best_obj
+
+    def normals(self, points: np.ndarray, obj: np.ndarray) -> np.ndarray:
+        # [N, 3] surface normals at points on the objects with the given ids
+        norms = np.zeros(points.shape, dtype=points.dtype)
+        kind = self.object_kind[obj]
+        index = self.object_index[obj]
+
+        on = kind == SPHERE
+        to_p = points[on] - self.sphere_centers[index[on]]
+        norms[on] = to_p/np.sqrt(rto.dot_rows(to_p, to_p))[:, None]
+        on = kind == PLANE
+        norms[on] = self.plane_normals[index[on]]
+        on = kind == OTHER
+        for i in np.unique(index[on]):
+            these = on & (index == i)
+            norms[these] = self.other_objects[i].get_norm_batch(points[these])
+        return norms
+
+    def save(self, path: str):
+        """
+        Writes the scene to a directory, see load_compiled.
+        Only spheres and planes can be stored, other objects only exist as python code
+        :param path: Directory to write into, made if it isn't there
+        """
+        if self.other_objects:
+            raise ValueError("CompiledScene save: Only spheres and planes can be saved, found ",
+                             [type(o) for o in self.other_objects])
+        os.makedirs(path, exist_ok=True)
+        arrays = {name: getattr(self, name) for name in SCENE_ARRAYS}
+        if self.bvh is not None:
+            arrays.update({"bvh_" + name: getattr(self.bvh, name) for name in BVH_ARRAYS})
+        for name, a in arrays.items():
+            np.save(os.path.join(path, name + ".npy"), np.ascontiguousarray(a))
+
+        manifest = {"format": FILE_FORMAT, "version": FILE_VERSION, "color_channels": self.color_channels,
+                    "dtype": self.dtype.name,
+                    "objects": len(self), "spheres": int(self.sphere_object.size),
+                    "planes": int(self.plane_object.size), "materials": int(self.material_color.shape[0]),
+                    "arrays": sorted(arrays),
+                    "bvh": None if self.bvh is None else {"leaf_size": self.bvh.leaf_size,
+                                                          "n_bins": self.bvh.n_bins,
+                                                          "nodes": int(self.bvh.node_start.size)}}
+        # the manifest goes last, a directory without one was never finished
+        with open(os.path.join(path, MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    def __reduce_ex__(self, protocol):
+        # one loaded from disk travels to worker processes as its path, and they map the same pages
+        if self.source is not None:
+            return load_compiled, (self.source, self.mmap_mode)
+        return super().__reduce_ex__(protocol)
+
+
+def load_compiled(path: str, mmap_mode: str = "r") -> CompiledScene:
+    """
+    Opens a scene written by CompiledScene.save. With mmap_mode the arrays are mapped rather than read,
+    so opening is instant whatever the size, and a render only pulls in the pages it touches
+    :param path: Directory the scene was saved to
+    :param mmap_mode: Passed on to np.load, None reads everything into memory
+    :return: The CompiledScene, its materials can't be repacked since there are no objects behind it
+    """
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+    if manifest.get("format") != FILE_FORMAT or manifest.get("version") != FILE_VERSION:
+        raise ValueError("CompiledScene load: Not a compiled scene this version can read, ", path)
+
+    def array(name):
+        a = np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+        read_only(a)
+        return a
+
+    compiled = CompiledScene.__new__(CompiledScene)
+    compiled.color_channels = int(manifest["color_channels"])
+    for name in SCENE_ARRAYS:
+        setattr(compiled, name, array(name))
+    compiled.dtype = compiled.sphere_centers.dtype
+    compiled.epsilon = rto.epsilon_for(compiled.dtype)
+    compiled.other_objects = []
+    if manifest["bvh"] is not None:
+        bvh = BVH.__new__(BVH)
+        bvh.leaf_size = int(manifest["bvh"]["leaf_size"])
+        bvh.n_bins = int(manifest["bvh"]["n_bins"])
+        bvh.dtype = compiled.dtype
+        for name in BVH_ARRAYS:
+            setattr(bvh, name, array("bvh_" + name))
+        compiled.bvh = bvh
+    compiled.source = os.path.abspath(path)
+    compiled.mmap_mode = mmap_mode
+    return compiled
@@ -0,0 +1,85 @@
+import numpy as np
+from GBuffer import GBuffer
+
+"""
+    Edge-avoiding a-trous wavelet filter (Dammertz et al. 2010) for noisy renders, guided by a G-buffer
+    Every pass blurs with a 5x5 B3 spline kernel whose taps are spread 2**pass pixels apart, so a few passes cover a
+    wide area. Each tap is weighted down when its color, normal or depth differ from the middle pixel's, or when
+    it lands on another object, so the noise on a surface is smoothed away while the edges between surfaces stay put
+    The colors are divided by the albedo first and multiplied back after, so flat colored surfaces are only smoothed
+    in the light they get, not their color
+"""
+
+# B3 spline
+KERNEL = np.array([1/16, 1/4, 3/8, 1/4, 1/16])
+# smallest albedo the colors are divided by, dark materials would blow up the light they got
+MIN_ALBEDO = 1e-2
+
+
+def shifted(image: np.ndarray, dy: int, dx: int) -> np.ndarray:
+    # image moved by (dy, dx), pixel [y, x] of the result is pixel [y + dy, x + dx] clamped to the edges
+    rows = np.clip(np.arange(image.shape[0]) + dy, 0, image.shape[0] - 1)
+    cols = np.clip(np.arange(image.shape[1]) + dx, 0, image.shape[1] - 1)
+    return image[rows][:, cols]
+
+
+def noise_level(light: np.ndarray, gbuffer: GBuffer) -> float:
+    """
+    Rough noise of an image, from how much side by side pixels on the same object differ.
+    Surfaces change slowly next to the noise of a low sample render, so most of that difference is noise
+    :param light: [y_res, x_res, C] colors
+    :return: Estimated standard deviation of a pixel's color, as the length of a C channel difference
+    """
+    same = (shifted(gbuffer.object_id, 0, 1) == gbuffer.object_id) & gbuffer.hit()
+    if not same.any():
+        return 0.0
+    diff = (shifted(light, 0, 1) - light)[same]
+    # the difference of two pixels carries the noise of both
+    return float(np.sqrt((diff**2).sum(axis=-1).mean()/2))
+
+
+def atrous(image: np.ndarray, gbuffer: GBuffer, iterations: int = 5, sigma_color: float = None,
+           sigma_normal: float = 0.1, sigma_depth: float = 0.05) -> np.ndarray:
+    """
+    Denoises an image with the edge-avoiding a-trous filter
+    :param image: [y_res, x_res, C] float colors, like Camera.get_image before it goes to uint8
+    :param gbuffer: First hits of the same camera, see GBuffer.capture
+    :param iterations: Filter passes, the last one reaches 2**(iterations + 1) pixels out
+    :param sigma_color: How different two colors may be before they stop mixing, halved every pass
+                        since the image gets smoother as it goes. By default the image's own noise_level,
+                        so a noisier render is smoothed harder
+    :param sigma_normal: Same for the distance between two normals
+    :param sigma_depth: Same for the difference in depth, relative to the middle pixel's depth
+    :return: [y_res, x_res, C] denoised colors
+    """
+    if image.shape[:2] != gbuffer.shape:
+        raise ValueError("Denoise atrous: The image and G-buffer are different sizes, ", (image.shape, gbuffer.shape))
+    hit = gbuffer.hit()
+    albedo = np.where(hit[..., None], np.maximum(gbuffer.albedo, MIN_ALBEDO), 1)
+    light = image/albedo
+    if sigma_color is None:
+        sigma_color = noise_level(light, gbuffer)
+    sigma_color = max(sigma_color, 1e-3)
+    normal = gbuffer.normal
+    depth = np.where(hit, gbuffer.depth, 0)
+    object_id = gbuffer.object_id
+    depth_scale = np.maximum(sigma_depth * depth, 1e-6)[..., None]
+
+    for i in range(int(iterations)):
+        step = 1 << i
+        color_scale = (sigma_color * 2.0**-i)**2
+        total = np.zeros(light.shape)
+        weights = np.zeros(light.shape[:2] + (1, ))
+        for a in range(-2, 3):
+            for b in range(-2, 3):
+                dy, dx = a * step, b * step
+                tap = shifted(light, dy, dx)
+                w = KERNEL[a + 2] * KERNEL[b + 2] * (shifted(object_id, dy, dx) == object_id)[..., None]
+                w = w * np.exp(-((tap - light)**2).sum(axis=-1, keepdims=True)/color_scale)
+                w = w * np.exp(-((shifted(normal, dy, dx) - normal)**2).sum(axis=-1, keepdims=True)/sigma_normal**2)
+                w = w * np.exp(-np.abs(shifted(depth, dy, dx) - depth)[..., None]/depth_scale)
+                total += w * tap
+                weights += w
+        # the middle tap always counts fully, so weights is never 0
+        light = total/weights
+    return light * albedo
@@ -0,0 +1,102 @@
+import numpy as np
+from time import perf_counter
+from Kernels import get_backend
+
+"""
+    Per pixel first hit data of the camera rays (a G-buffer), laid out like Camera.get_image, [y_res, x_res, ...]
+    Made with one batched intersection of the camera rays through the middle of every pixel,
+    so it costs about as much as a single bounce of a one sample render
+    The buffers double as AOVs, they can be saved next to a render for compositing
+"""
+
+# flat shading lights every surface this much no matter which way it faces, the rest comes from facing the camera
+FLAT_AMBIENT = .25
+
+
+class GBuffer:
+    normal: np.ndarray = None
+    depth: np.ndarray = None
+    albedo: np.ndarray = None
+    object_id: np.ndarray = None
+    facing: np.ndarray = None
+
+    def __init__(self, normal: np.ndarray, depth: np.ndarray, albedo: np.ndarray, object_id: np.ndarray,
+                 facing: np.ndarray):
+        """
+        :param normal: [y_res, x_res, 3] surface normal at the first hit, zero where nothing was hit
+        :param depth: [y_res, x_res] distance along the camera ray to the first hit, np.inf for a miss
+        :param albedo: [y_res, x_res, C] material color of the first hit, the ambient color for a miss
+        :param object_id: [y_res, x_res] index into scene.objects of the first hit, -1 for a miss
+        :param facing: [y_res, x_res] |cos| of the angle between the normal and the camera ray, 0 for a miss
+        """
+        self.normal = normal
+        self.depth = depth
+        self.albedo = albedo
+        self.object_id = object_id
+        self.facing = facing
+
+    @property
+    def shape(self) -> tuple:
+        return self.depth.shape
+
+    def hit(self) -> np.ndarray:
+        # [y_res, x_res] pixels whose camera ray hit something
+        return self.object_id >= 0
+
+    def flat_shaded(self) -> np.ndarray:
+        """
+        Quick look at the scene without any light transport, every surface in its own color,
+        darker the more it turns away from the camera
+        :return: [y_res, x_res, C] float colors, misses are the ambient color
+        """
+        light = np.where(self.hit(), FLAT_AMBIENT + (1 - FLAT_AMBIENT) * self.facing, 1)
+        return self.albedo * light[..., None]
+
+    def save(self, path: str):
+        # every buffer into one .npz, load_gbuffer reads it back
+        np.savez(path, normal=self.normal, depth=self.depth, albedo=self.albedo, object_id=self.object_id,
+                 facing=self.facing)
+
+
+def load_gbuffer(path: str) -> GBuffer:
+    with np.load(path) as buffers:
+        return GBuffer(buffers["normal"], buffers["depth"], buffers["albedo"], buffers["object_id"],
+                       buffers["facing"])
+
+
+def capture(scene, backend: str = "auto", stats=None) -> GBuffer:
+    """
+    Intersects every camera ray of the scene once, as one batch, and keeps what it hit
+    :param scene: Scene to look at, through its camera
+    :param backend: Kernels to intersect with, see Kernels.get_backend
+    :param stats: RenderStats to count the camera rays and time them in, if given
+    """
+    cam = scene.cam
+    compiled = scene.compile()
+    kernels = get_backend(backend)
+    start = perf_counter()
+    origins, directions = cam.primary_rays()
+    if stats is not None:
+        stats.add_time("primary", start)
+
+    start = perf_counter()
+    tests = stats.intersection_tests if stats is not None else None
+    t, obj = kernels.closest_hit(compiled, origins, directions, tests)
+    hit = obj >= 0
+    n_pixels = obj.size
+    normal = np.zeros([n_pixels, 3], dtype=directions.dtype)
+    normal[hit] = kernels.normals(compiled, origins[hit] + directions[hit] * t[hit, None], obj[hit])
+    if stats is not None:
+        stats.add_time("traversal", start)
+        stats.add_rays(0, n_pixels)
+        stats.hits += int(hit.sum())
+        stats.misses += int(n_pixels - hit.sum())
+
+    albedo = np.empty([n_pixels, compiled.color_channels], dtype=directions.dtype)
+    albedo[hit] = compiled.material_color[compiled.object_material[obj[hit]]]
+    albedo[~hit] = compiled.ambient
+    facing = np.abs((normal * directions).sum(axis=1))
+
+    shape = (cam.y_res, cam.x_res)
+    return GBuffer(normal.reshape(shape + (3, )), t.reshape(shape), albedo.reshape(shape + (-1, )), obj.reshape(shape),
+                   facing.reshape(shape))
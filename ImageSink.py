@@ -0,0 +1,155 @@
+import os
+import struct
+import zlib
+import numpy as np
+
+"""
+    Places finished tiles can go instead of the camera image, so a frame never has to fit in memory
+    Every sink takes tiles of float colors laid out like Camera.get_image ([rows, columns, C]), in any order,
+    and is closed once the last one is in, or aborted if the render fails
+"""
+
+
+def to_pixels(colors: np.ndarray) -> np.ndarray:
+    # the same conversion Camera.get_image does
+    return np.uint8(colors * 255)
+
+
+class NpySink:
+    path: str = None
+    x_res: int = 0
+    y_res: int = 0
+    channels: int = 3
+    dtype: np.dtype = np.uint8
+    image: np.ndarray = None
+
+    def __init__(self, path: str, x_res: int, y_res: int, channels: int = 3, dtype=np.uint8):
+        """
+        Writes into a memory mapped .npy file, np.load(path, mmap_mode="r") reads it back
+        :param path: File to write, [y_res, x_res, channels] like Camera.get_image
+        :param dtype: np.uint8 stores 0-255 like get_image, a float type stores the colors as they are
+        """
+        self.path = path
+        self.x_res = int(x_res)
+        self.y_res = int(y_res)
+        self.channels = int(channels)
+        self.dtype = np.dtype(dtype)
+        self.image = np.lib.format.open_memmap(path, mode="w+", dtype=self.dtype,
+                                               shape=(self.y_res, self.x_res, self.channels))
+
+    def write_tile(self, tile: tuple, colors: np.ndarray):
+        """
+        :param tile: (x_start, x_stop, y_start, y_stop)
+        :param colors: [y_stop - y_start, x_stop - x_start, C] colors
+        """
+        x0, x1, y0, y1 = tile
+        self.image[y0:y1, x0:x1] = to_pixels(colors) if self.dtype == np.uint8 else colors
+        # written pages go back to the file rather than piling up
+        self.image.flush()
+
+    def close(self):
+        if self.image is not None:
+            self.image.flush()
+            self.image = None
+
+    def abort(self):
+        # lets go of the file as it is, the tiles written so far stay in it
+        self.close()
+
+
+class PngSink:
+    path: str = None
+    x_res: int = 0
+    y_res: int = 0
+    channels: int = 3
+    next_row: int = 0
+    chunk_size: int = 1 << 16
+
+    # PNG color types by channel count, grey, grey and alpha, RGB, RGBA
+    COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+
+    def __init__(self, path: str, x_res: int, y_res: int, channels: int = 3, compression: int = 6):
+        """
+        Writes an 8 bit PNG one row at a time. Rows have to go out top to bottom,
+        so only rows that are still waiting on a tile are held, for tiles rendered a band at a time
+        that is one band of the image
+        :param path: File to write
+        :param compression: zlib level, 0-9
+        """
+        if channels not in self.COLOR_TYPES:
+            raise ValueError("PngSink: PNG can't store this many channels, ", channels)
+        self.path = path
+        self.x_res = int(x_res)
+        self.y_res = int(y_res)
+        self.channels = int(channels)
+        self.next_row = 0
+        self.__rows = dict()
+        self.__compressor = zlib.compressobj(compression)
+        self.__pending = []
+        self.__pending_size = 0
+        self.__file = open(path, "wb")
+        self.__file.write(b"\x89PNG\r\n\x1a\n")
+        self.__chunk(b"IHDR", struct.pack(">IIBBBBB", self.x_res, self.y_res, 8, self.COLOR_TYPES[self.channels],
+                                          0, 0, 0))
+
+    def __chunk(self, kind: bytes, data: bytes):
+        self.__file.write(struct.pack(">I", len(data)) + kind + data)
+        self.__file.write(struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+    def __compress(self, data: bytes):
+        # compressed data goes out in IDAT chunks of about chunk_size
+        self.__pending.append(data)
+        self.__pending_size += len(data)
+        if self.__pending_size >= self.chunk_size:
+            self.__chunk(b"IDAT", b"".join(self.__pending))
+            self.__pending = []
+            self.__pending_size = 0
+
+    def write_tile(self, tile: tuple, colors: np.ndarray):
+        """
+        :param tile: (x_start, x_stop, y_start, y_stop)
+        :param colors: [y_stop - y_start, x_stop - x_start, C] colors
+        """
+        x0, x1, y0, y1 = tile
+        pixels = to_pixels(colors)
+        for j in range(y0, y1):
+            if j not in self.__rows:
+                self.__rows[j] = [np.zeros([self.x_res, self.channels], dtype=np.uint8), 0]
+            row = self.__rows[j]
+            row[0][x0:x1] = pixels[j - y0]
+            row[1] += x1 - x0
+        # every row that is complete and next in line goes out, filter type 0 (none) in front of each
+        while self.next_row in self.__rows and self.__rows[self.next_row][1] >= self.x_res:
+            row = self.__rows.pop(self.next_row)[0]
+            self.__compress(self.__compressor.compress(b"\0" + row.tobytes()))
+            self.next_row += 1
+
+    def close(self):
+        if self.__file is None:
+            return
+        if self.next_row != self.y_res:
+            self.__file.close()
+            self.__file = None
+            raise ValueError("PngSink: Closed with rows still missing, from row ", self.next_row)
+        self.__compress(self.__compressor.flush())
+        if self.__pending:
+            self.__chunk(b"IDAT", b"".join(self.__pending))
+        self.__chunk(b"IEND", b"")
+        self.__file.close()
+        self.__file = None
+
+    def abort(self):
+        # lets go of the file without finishing it, what was written isn't a valid PNG
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+
+def open_sink(path: str, x_res: int, y_res: int, channels: int = 3):
+    # picks the sink from the file extension, .npy or .png
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".npy":
+        return NpySink(path, x_res, y_res, channels)
+    if extension == ".png":
+        return PngSink(path, x_res, y_res, channels)
+    raise ValueError("open_sink: Can only stream to .npy or .png, found ", extension)
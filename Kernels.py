@@ -0,0 +1,284 @@
+import numpy as np
+import warnings
+from CompiledScene import CompiledScene, SPHERE, PLANE
+from RayTracingObjects import dot_rows
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+"""
+    Compute kernels behind the wavefront renderer, picked by name when rendering
+    NumpyKernels is the reference, whole batches at a time as numpy arrays
+    NumbaKernels runs the same math one ray at a time in compiled loops, so there are no temporaries,
+    and is only there when numba is installed. Random numbers are always drawn by the caller,
+    and the loops do every sum in the same order and float type numpy does, so for a fixed seed both give the same
+    image in either precision
+"""
+
+
+def scale_rows(colors: np.ndarray) -> np.ndarray:
+    # same scaling as RayColorInfo, every row with a channel above 1 is divided by its largest channel
+    max_c = colors.max(axis=1, keepdims=True)
+    return np.where(max_c > 1, colors/np.maximum(max_c, 1), colors)
+
+
+class NumpyKernels:
+    name: str = "numpy"
+
+    def closest_hit(self, compiled: CompiledScene, origins: np.ndarray, directions: np.ndarray,
+                    tests: list = None) -> tuple[np.ndarray, np.ndarray]:
+        # [N, ] nearest t (np.inf for a miss), [N, ] object id (-1 for a miss), see CompiledScene.closest_hit_batch
+        return compiled.closest_hit_batch(origins, directions, tests)
+
+    def normals(self, compiled: CompiledScene, points: np.ndarray, obj: np.ndarray) -> np.ndarray:
+        return compiled.normals(points, obj)
+
+    def shade(self, throughput: np.ndarray, material: np.ndarray, material_color: np.ndarray,
+              emitted: np.ndarray) -> np.ndarray:
+        # tints each ray with the material it hit and adds that material's light, scaled like RayColorInfo
+        return scale_rows(material_color[material] * throughput + emitted[material])
+
+    def bounce(self, directions: np.ndarray, norms: np.ndarray, specular: np.ndarray,
+               random_normals: np.ndarray) -> np.ndarray:
+        """
+        Next direction of every ray
+        :param directions: [N, 3] incoming unit directions
+        :param norms: [N, 3] surface normals at the hits
+        :param specular: [N, ] which rays reflect, the rest scatter diffusely
+        :param random_normals: [number of diffuse rays, 3] isotropic draws, e.g. standard normals, in ray order
+        :return: [N, 3] unit directions
+        """
+        new_d = np.empty(directions.shape, dtype=directions.dtype)
+        d, n = directions[specular], norms[specular]
+        new_d[specular] = d - 2 * dot_rows(d, n)[:, None] * n
+
+        diffuse = ~specular
+        n = norms[diffuse]
+        rand_d = random_normals * np.sign(dot_rows(n, random_normals))[:, None]
+        new_d[diffuse] = rand_d/np.sqrt(dot_rows(rand_d, rand_d))[:, None] + n
+        return new_d/np.sqrt(dot_rows(new_d, new_d))[:, None]
+
+
+# the loops are compiled when numba is around, and stay plain (slow, but still correct) python when it isn't
+if numba is not None:
+    _kernel = numba.njit(cache=True, error_model='numpy')
+else:
+    def _kernel(func):
+        return func
+
+
+@_kernel
+def _object_t(k, ox, oy, oz, dx, dy, dz, object_kind, object_index, sphere_centers, sphere_radii2,
+              plane_normals, plane_offsets, epsilon):
+    # t of one ray against object k, same math as sphere_intersect_batch and plane_intersect_batch
+    i = object_index[k]
+    if object_kind[k] == SPHERE:
+        cx = ox - sphere_centers[i, 0]
+        cy = oy - sphere_centers[i, 1]
+        cz = oz - sphere_centers[i, 2]
+        b = dx * cx + dy * cy + dz * cz
+        c = (cx * cx + cy * cy + cz * cz) - sphere_radii2[i]
+        discriminant = b * b - c
+        if discriminant >= 0:
+            t = -b - np.sqrt(discriminant)
+            if t > epsilon:
+                return t
+        return np.inf
+    if object_kind[k] == PLANE:
+        nx, ny, nz = plane_normals[i, 0], plane_normals[i, 1], plane_normals[i, 2]
+        facing = dx * nx + dy * ny + dz * nz
+        if facing != 0:
+            t = (plane_offsets[i] - (ox * nx + oy * ny + oz * nz))/facing
+            if t > epsilon:
+                return t
+    return np.inf
+
+
+@_kernel
+def _closest_hit_loop(origins, directions, inv_dirs, unbounded, bvh_object, node_lo, node_hi, node_left,
+                      node_right, node_start, node_count, prim_order, object_kind, object_index, sphere_centers,
+                      sphere_radii2, plane_normals, plane_offsets, epsilon):
+    n = origins.shape[0]
+    best_t = np.full(n, np.inf, origins.dtype)
+    best_obj = np.full(n, -1, dtype=np.int64)
+    stack = np.empty(max(node_lo.shape[0], 1), dtype=np.int64)
+    for r in range(n):
+        ox, oy, oz = origins[r, 0], origins[r, 1], origins[r, 2]
+        dx, dy, dz = directions[r, 0], directions[r, 1], directions[r, 2]
+        for k in unbounded:
+            t = _object_t(k, ox, oy, oz, dx, dy, dz, object_kind, object_index, sphere_centers, sphere_radii2,
+                          plane_normals, plane_offsets, epsilon)
+            if t < best_t[r]:
+                best_t[r] = t
+                best_obj[r] = k
+        if node_lo.shape[0] == 0:
+            continue
+
+        # depth first, left child first, the order BVH.closest_hit_batch visits nodes in
+        stack[0] = 0
+        top = 1
+        while top > 0:
+            top -= 1
+            node = stack[top]
+            t_near = 0.0
+            t_far = best_t[r]
+            for a in range(3):
+                t1 = (node_lo[node, a] - origins[r, a]) * inv_dirs[r, a]
+                t2 = (node_hi[node, a] - origins[r, a]) * inv_dirs[r, a]
+                # a ray running along a slab face gives a nan, it lies inside that slab so the slab is skipped
+                if t1 != t1 or t2 != t2:
+                    continue
+                if t1 > t2:
+                    t1, t2 = t2, t1
+                if t1 > t_near:
+                    t_near = t1
+                if t2 < t_far:
+                    t_far = t2
+            if t_near > t_far or t_near >= best_t[r]:
+                continue
+            if node_left[node] < 0:
+                for p in range(node_start[node], node_start[node] + node_count[node]):
+                    k = bvh_object[prim_order[p]]
+                    t = _object_t(k, ox, oy, oz, dx, dy, dz, object_kind, object_index, sphere_centers,
+                                  sphere_radii2, plane_normals, plane_offsets, epsilon)
+                    if t < best_t[r]:
+                        best_t[r] = t
+                        best_obj[r] = k
+            else:
+                stack[top] = node_right[node]
+                stack[top + 1] = node_left[node]
+                top += 2
+    return best_t, best_obj
+
+
+@_kernel
+def _normals_loop(points, obj, object_kind, object_index, sphere_centers, plane_normals):
+    norms = np.zeros_like(points)
+    for r in range(points.shape[0]):
+        i = object_index[obj[r]]
+        if object_kind[obj[r]] == SPHERE:
+            x = points[r, 0] - sphere_centers[i, 0]
+            y = points[r, 1] - sphere_centers[i, 1]
+            z = points[r, 2] - sphere_centers[i, 2]
+            length = np.sqrt(x * x + y * y + z * z)
+            norms[r, 0] = x/length
+            norms[r, 1] = y/length
+            norms[r, 2] = z/length
+        elif object_kind[obj[r]] == PLANE:
+            norms[r, 0] = plane_normals[i, 0]
+            norms[r, 1] = plane_normals[i, 1]
+            norms[r, 2] = plane_normals[i, 2]
+    return norms
+
+
+@_kernel
+def _shade_loop(throughput, material, material_color, emitted):
+    out = np.empty_like(throughput)
+    for r in range(throughput.shape[0]):
+        m = material[r]
+        max_c = -np.inf
+        for c in range(throughput.shape[1]):
+            out[r, c] = material_color[m, c] * throughput[r, c] + emitted[m, c]
+            if out[r, c] > max_c:
+                max_c = out[r, c]
+        if max_c > 1:
+            for c in range(throughput.shape[1]):
+                out[r, c] = out[r, c]/max_c
+    return out
+
+
+@_kernel
+def _bounce_loop(directions, norms, specular, random_normals):
+    # every step stays in the arrays' float type, and goes through new_d where numpy stores its temporaries,
+    # so float32 rounds the way NumpyKernels.bounce does
+    new_d = np.empty_like(directions)
+    k = 0
+    for r in range(directions.shape[0]):
+        nx, ny, nz = norms[r, 0], norms[r, 1], norms[r, 2]
+        if specular[r]:
+            dot = directions[r, 0] * nx + directions[r, 1] * ny + directions[r, 2] * nz
+            twice = dot + dot
+            new_d[r, 0] = directions[r, 0] - twice * nx
+            new_d[r, 1] = directions[r, 1] - twice * ny
+            new_d[r, 2] = directions[r, 2] - twice * nz
+        else:
+            x, y, z = random_normals[k, 0], random_normals[k, 1], random_normals[k, 2]
+            k += 1
+            facing = nx * x + ny * y + nz * z
+            if facing < 0:
+                x, y, z = -x, -y, -z
+            elif not facing > 0:
+                # zero or nan, what np.sign gives back
+                x, y, z = x * facing, y * facing, z * facing
+            length = np.sqrt(x * x + y * y + z * z)
+            new_d[r, 0] = x/length + nx
+            new_d[r, 1] = y/length + ny
+            new_d[r, 2] = z/length + nz
+        x, y, z = new_d[r, 0], new_d[r, 1], new_d[r, 2]
+        length = np.sqrt(x * x + y * y + z * z)
+        new_d[r, 0] = x/length
+        new_d[r, 1] = y/length
+        new_d[r, 2] = z/length
+    return new_d
+
+
+class NumbaKernels(NumpyKernels):
+    name: str = "numba"
+
+    def __init__(self):
+        if numba is None:
+            raise ImportError("NumbaKernels: numba is not installed")
+
+    def closest_hit(self, compiled: CompiledScene, origins: np.ndarray, directions: np.ndarray,
+                    tests: list = None) -> tuple[np.ndarray, np.ndarray]:
+        # objects that aren't spheres or planes only have their python intersect_batch,
+        # and the compiled loop doesn't count its tests
+        if compiled.other_objects or tests is not None:
+            return super().closest_hit(compiled, origins, directions, tests)
+        bvh = compiled.bvh
+        if bvh is None:
+            no_nodes = np.zeros([0, 3], dtype=compiled.dtype)
+            no_ints = np.zeros([0, ], dtype=np.int64)
+            nodes = (no_nodes, no_nodes, no_ints, no_ints, no_ints, no_ints, no_ints)
+        else:
+            nodes = (bvh.node_lo, bvh.node_hi, bvh.node_left, bvh.node_right, bvh.node_start, bvh.node_count,
+                     bvh.prim_order)
+        with np.errstate(divide='ignore'):
+            inv_dirs = 1/directions
+        return _closest_hit_loop(origins, directions, inv_dirs, compiled.unbounded, compiled.bvh_object, *nodes,
+                                 compiled.object_kind, compiled.object_index, compiled.sphere_centers,
+                                 compiled.sphere_radii2, compiled.plane_normals, compiled.plane_offsets,
+                                 compiled.epsilon)
+
+    def normals(self, compiled: CompiledScene, points: np.ndarray, obj: np.ndarray) -> np.ndarray:
+        if compiled.other_objects:
+            return super().normals(compiled, points, obj)
+        return _normals_loop(points, obj, compiled.object_kind, compiled.object_index, compiled.sphere_centers,
+                             compiled.plane_normals)
+
+    def shade(self, throughput: np.ndarray, material: np.ndarray, material_color: np.ndarray,
+              emitted: np.ndarray) -> np.ndarray:
+        return _shade_loop(throughput, material, material_color, emitted)
+
+    def bounce(self, directions: np.ndarray, norms: np.ndarray, specular: np.ndarray,
+               random_normals: np.ndarray) -> np.ndarray:
+        return _bounce_loop(directions, norms, specular, random_normals)
+
+
+def get_backend(name: str = "auto") -> NumpyKernels:
+    """
+    :param name: "numpy", "numba", or "auto" for numba when it is installed and numpy otherwise
+    :return: The kernels to render with
+    """
+    if name == "auto":
+        return NumbaKernels() if numba is not None else NumpyKernels()
+    if name == "numpy":
+        return NumpyKernels()
+    if name == "numba":
+        if numba is None:
+            warnings.warn("numba is not installed, rendering with the numpy kernels instead")
+            return NumpyKernels()
+        return NumbaKernels()
+    raise ValueError("Kernels: Unknown backend ", name)
@@ -0,0 +1,38 @@
+import numpy as np
+from RayTracingObjects import TriangleMesh
+
+"""
+    Reads Wavefront .obj files into TriangleMesh objects
+    Only the vertex positions (v) and faces (f) are read, texture coordinates, normals, groups and materials are skipped
+"""
+
+
+def read_obj(path: str) -> tuple[np.ndarray, np.ndarray]:
+    """
+    :param path: .obj file
+    :return: [V, 3] vertices, [T, 3] 0 based vertex indices of every triangle, polygons split into fans
+    """
+    vertices = []
+    faces = []
+    with open(path) as f:
+        for line in f:
+            if line.startswith("v "):
+                vertices.append(line.split()[1:4])
+            elif line.startswith("f "):
+                # corners are v, v/vt, v//vn or v/vt/vn, 1 based, negative ones count back from the last vertex so far
+                corners = [int(c.split("/", 1)[0]) for c in line.split()[1:]]
+                corners = [c - 1 if c > 0 else len(vertices) + c for c in corners]
+                faces.extend((corners[0], corners[k], corners[k + 1]) for k in range(1, len(corners) - 1))
+    return np.array(vertices, dtype=float).reshape([-1, 3]), np.array(faces, dtype=np.int64).reshape([-1, 3])
+
+
+def load_obj(path: str, **material) -> TriangleMesh:
+    """
+    :param path: .obj file
+    :param material: Passed on to TriangleMesh, color, specular_power, light_source and so on
+    :return: One mesh holding every face in the file
+    """
+    vertices, faces = read_obj(path)
+    if faces.size == 0:
+        raise ValueError("load_obj: No faces found in ", path)
+    return TriangleMesh(vertices, faces, **material)
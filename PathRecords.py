@@ -0,0 +1,45 @@
+import numpy as np
+
+"""
+    Which objects the paths of every pixel touched, so an edit to an object can be traced back to the pixels it shows up
+    in. Kept as (pixel, object) pairs, one per object a pixel's paths hit no matter how many times
+"""
+
+
+class PathRecords:
+    pixel: np.ndarray = None
+    obj: np.ndarray = None
+
+    def __init__(self):
+        self.pixel = np.zeros(0, dtype=np.int64)
+        self.obj = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return self.pixel.size
+
+    def add(self, touched: list):
+        """
+        :param touched: (pixels, objects) array pairs, as WavefrontRenderer.render_pixels fills them in
+        """
+        if not touched:
+            return
+        pairs = np.concatenate([np.stack([self.pixel, self.obj], axis=1)] +
+                               [np.stack([np.asarray(p, dtype=np.int64), np.asarray(o, dtype=np.int64)], axis=1)
+                                for p, o in touched])
+        pairs = np.unique(pairs, axis=0)
+        self.pixel, self.obj = pairs[:, 0].copy(), pairs[:, 1].copy()
+
+    def forget(self, pixels: np.ndarray):
+        # drops what these pixels touched, before they are traced again
+        keep = ~np.isin(self.pixel, pixels)
+        self.pixel, self.obj = self.pixel[keep], self.obj[keep]
+
+    def pixels_touching(self, objects) -> np.ndarray:
+        # [M, ] pixels whose paths hit any of these object ids
+        return np.unique(self.pixel[np.isin(self.obj, objects)])
+
+    def remove_object(self, k: int):
+        # object k is gone from the scene, the ones after it move down one
+        keep = self.obj != k
+        self.pixel, self.obj = self.pixel[keep], self.obj[keep]
+        self.obj[self.obj > k] -= 1
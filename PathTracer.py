@@ -0,0 +1,204 @@
+import numpy as np
+from random import random
+from time import perf_counter
+from Ray import Ray, cosine_ray, specular_ray
+from RayTraceInfo import HitInfo, MaterialInfo, RayColorInfo
+from Sampler import Sampler
+
+"""
+    Iterative path tracer, follows one path per sample with a throughput weight
+    instead of recursing and branching at every bounce like Scene.get_color
+    At diffuse hits it also aims a shadow ray at one of the scene's emitters (next event estimation),
+    and weighs that against the light the bounce itself finds with multiple importance sampling
+"""
+
+
+def power_heuristic(pdf_a: float, pdf_b: float) -> float:
+    # MIS weight for a sample drawn from strategy a, when strategy b could have drawn it too
+    if pdf_a <= 0:
+        return 0.0
+    return pdf_a**2/(pdf_a**2 + pdf_b**2)
+
+
+class PathTracer:
+    scene = None
+    rr_depth: int = 2
+    next_event: bool = True
+    rays_traced: int = 0
+
+    def __init__(self, scene, rr_depth: int = 2, next_event: bool = True):
+        """
+        :param scene: Scene to render
+        :param rr_depth: Bounces a path always gets before russian roulette may end it
+        :param next_event: Sample the scene's emitters directly at diffuse hits
+        """
+        self.scene = scene
+        self.rr_depth = int(rr_depth)
+        self.next_event = bool(next_event)
+        # only emitters with a finite size can be aimed at, the rest are found by bouncing into them
+        self.lights = [o for o in scene.emitters if o.bounds() is not None] if self.next_event else []
+        self.ambient = RayColorInfo(scene.color_channels, scene.ambient_color).ray_color
+        self.__shown = dict()
+
+    def render(self, n_bounces: int = 1, n_incident_rays: int = 1, n_rays: int = 1) -> np.ndarray:
+        """
+        Renders the scene's camera
+        :param n_bounces: Most bounces a path may take
+        :param n_incident_rays: Paths continued from the first hit of every camera ray,
+                                the only place a path branches
+        :param n_rays: Camera rays per pixel
+        :return: The image, same as Scene.render
+        """
+        self.rays_traced = 0
+        cam = self.scene.cam
+        stats = self.scene.stats
+        for i, j in cam:
+            color = self.render_pixel(i, j, n_bounces, n_incident_rays, n_rays)
+            start = perf_counter() if stats is not None else 0.0
+            cam.set_color(i, j, color)
+            if stats is not None:
+                stats.add_time("framebuffer", start)
+        start = perf_counter()
+        image = cam.get_image()
+        if stats is not None:
+            stats.add_time("framebuffer", start)
+        return image
+
+    def render_pixel(self, i: int, j: int, n_bounces: int = 1, n_incident_rays: int = 1,
+                     n_rays: int = 1, first_sample: int = 0) -> np.ndarray:
+        # first_sample is the number of camera samples the pixel already has, see Scene.render_pixel
+        stats = self.scene.stats
+        pixel = j * self.scene.cam.x_res + i
+        pix_color = np.zeros([self.scene.color_channels, ])
+        sampler = self.scene.sampler
+        for r in range(n_rays):
+            start = perf_counter() if stats is not None else 0.0
+            offset = sampler.pixel_offset_one(pixel, int(first_sample) + r) if sampler is not None else None
+            ray = self.scene.cam.ray_through_pixel(i, j, n_bounces, offset)
+            if stats is not None:
+                stats.add_time("primary", start)
+            pix_color += self.trace(ray, n_incident_rays, (pixel, int(first_sample) + r))
+        return pix_color/n_rays
+
+    def trace(self, ray: Ray, n_incident_rays: int = 1, key: tuple = None) -> np.ndarray:
+        """
+        Color seen along a camera ray. Light picked up along a path is weighted by the throughput,
+        the product of the material colors it bounced off so far
+        :param ray: The camera ray, ray.bounces is how many bounces its paths may take
+        :param n_incident_rays: Paths continued from the first hit
+        :param key: (pixel, camera sample) of the ray, its paths draw from the scene's sampler with it if there is one
+        :return: [C, ] color
+        """
+        self.rays_traced += 1
+        if self.scene.stats is not None:
+            self.scene.stats.add_rays(0)
+        hit = self.scene.closest_hit(ray)
+        if not hit.did_hit:
+            return self.ambient.copy()
+
+        color = self.shown(hit.color_info).copy()
+        if ray.bounces > 0:
+            incoming = np.zeros([self.scene.color_channels, ])
+            for k in range(n_incident_rays):
+                path_key = None
+                if key is not None and self.scene.sampler is not None:
+                    # numbered like the wavefront renderer numbers its paths
+                    path_key = (key[0], key[1] * n_incident_rays + k)
+                incoming += self.follow(ray, hit, path_key)
+            color += incoming/n_incident_rays
+
+        # make sure we don't overflow the color
+        return RayColorInfo(self.scene.color_channels, color).ray_color
+
+    def follow(self, ray: Ray, hit: HitInfo, key: tuple = None) -> np.ndarray:
+        """
+        Continues a path from a hit until it misses, runs out of bounces, or loses the roulette
+        :param key: (pixel, path) to draw the path's numbers from the scene's sampler with, python's random if None
+        """
+        color = np.zeros([self.scene.color_channels, ])
+        throughput = np.ones([self.scene.color_channels, ])
+        stats = self.scene.stats
+        sampler = self.scene.sampler
+        depth = 0
+        while ray.bounces > 0:
+            info = hit.color_info
+            # specular choice, roulette and which light to aim at, python's random draws them one by one instead
+            decisions = sampler.uniform_one(*key, depth, Sampler.DECISIONS) if key is not None else None
+            specular = (random() if key is None else decisions[0]) < info.specular_probability
+            if stats is not None:
+                stats.specular += specular
+                stats.diffuse += not specular
+            if not specular and self.lights:
+                # the point on the light comes from a stream of its own
+                u = None if key is None else (decisions[2], *sampler.uniform_one(*key, depth, Sampler.LIGHT)[:2])
+                color += throughput * info.material_color * self.sample_lights(hit, depth + 1, u)
+
+            throughput = throughput * info.material_color
+            if depth >= self.rr_depth:
+                # dim paths carry little light, end most of them and boost the ones that survive to make up for it
+                survive = min(1.0, float(throughput.max()))
+                if (random() if key is None else decisions[1]) >= survive:
+                    break
+                throughput = throughput/survive
+            if not throughput.any():
+                break
+
+            p, norm = hit.p_hit, hit.norm
+            if specular:
+                ray = specular_ray(p, norm, ray, ray.bounces - 1)
+            else:
+                random_normal = sampler.sphere_one(*key, depth, Sampler.DIRECTION) if key is not None else None
+                ray = cosine_ray(p, norm, ray, ray.bounces - 1, random_normal)
+            self.rays_traced += 1
+            if stats is not None:
+                stats.add_rays(depth + 1)
+            hit = self.scene.closest_hit(ray)
+            if not hit.did_hit:
+                color += throughput * self.ambient
+                break
+
+            weight = 1.0
+            if not specular and hit.obj in self.lights:
+                # the light sampler could have picked this direction too
+                bsdf_pdf = max(float(np.dot(norm, ray.dir)), 0.0)/np.pi
+                weight = power_heuristic(bsdf_pdf, hit.obj.light_pdf(p, ray.dir)/len(self.lights))
+            color += throughput * self.shown(hit.color_info) * weight
+            depth += 1
+        return color
+
+    def sample_lights(self, hit: HitInfo, depth: int = 1, u: tuple = None) -> np.ndarray:
+        """
+        Light reaching a diffuse hit straight from one randomly picked emitter, MIS weighted
+        :param depth: Depth the shadow ray is counted at in the scene's RenderStats
+        :param u: Three uniform numbers, one to pick the light and two for the point on it. Drawn if not given
+        :return: [C, ] incoming light times the diffuse falloff, still to be tinted by the material
+        """
+        if u is None:
+            u = (random(), random(), random())
+        light = self.lights[int(u[0] * len(self.lights)) % len(self.lights)]
+        sample = light.sample_light(hit.p_hit, u[1], u[2])
+        if sample is None:
+            return np.zeros([self.scene.color_channels, ])
+        direction, light_pdf = sample
+        cos_surface = float(np.dot(hit.norm, direction))
+        if cos_surface <= 0:
+            return np.zeros([self.scene.color_channels, ])
+
+        self.rays_traced += 1
+        if self.scene.stats is not None:
+            self.scene.stats.add_rays(depth)
+        shadow = self.scene.closest_hit(Ray(hit.p_hit, hit.p_hit + direction))
+        if shadow.obj is not light:
+            return np.zeros([self.scene.color_channels, ])
+
+        light_pdf = light_pdf/len(self.lights)
+        bsdf_pdf = cos_surface/np.pi
+        weight = power_heuristic(light_pdf, bsdf_pdf)
+        return self.shown(light.color_info) * (bsdf_pdf/light_pdf) * weight
+
+    def shown(self, info: MaterialInfo) -> np.ndarray:
+        # the light a material gives off, the way Scene.get_color sees it
+        key = id(info)
+        if key not in self.__shown:
+            self.__shown[key] = RayColorInfo(self.scene.color_channels, info).ray_color
+        return self.__shown[key]
@@ -1,5 +1,6 @@
 import numpy as np
-from RayTraceInfo import RayColorInfo
+from math import sqrt
+from RayTraceInfo import RayColorInfo, vec3
 
 """
     Ray object for raytracing
@@ -7,18 +8,19 @@ from RayTraceInfo import RayColorInfo
 
 
 class Ray:
-    o: np.ndarray = np.array([[0], [0], [0]])
-    t: np.ndarray = np.array([[1], [0], [0]])
-    d: np.ndarray = t - o
-    dir: np.ndarray = d / np.linalg.norm(d)
-    bounces: int = 0
-    color: RayColorInfo = None
+    __slots__ = ('o', 't', 'd', 'dir', 'bounces', 'color')
+    o: np.ndarray
+    t: np.ndarray
+    d: np.ndarray
+    dir: np.ndarray
+    bounces: int
+    color: RayColorInfo
 
     def __init__(self, origin, towards, num_bounces=0, color_info: RayColorInfo = None):
-        self.o = np.array(origin).reshape([3, ])
-        self.t = np.array(towards).reshape([3, ])
+        self.o = vec3(origin)
+        self.t = vec3(towards)
         self.d = self.t - self.o
-        self.dir = self.d / np.linalg.norm(self.d)
+        self.dir = self.d / sqrt(self.d.dot(self.d))
         self.bounces = num_bounces
         self.color = color_info
 
@@ -32,19 +34,31 @@ class Ray:
         self.color = color
 
 
-def ray_in_hemisphere(p: np.ndarray, norm: np.ndarray, ray: Ray, num_bounces: int = 0) -> Ray:
-    # generates a ray in a hemisphere around the norm
+def ray_in_hemisphere(p: np.ndarray, norm: np.ndarray, ray: Ray, num_bounces: int = 0,
+                      random_normal: np.ndarray = None) -> Ray:
+    # generates a ray in a hemisphere around the norm, from random_normal if given (any isotropic draw)
 
-    new_direction = np.random.standard_normal(norm.shape)
+    new_direction = np.random.standard_normal(norm.shape) if random_normal is None else random_normal
 
-    new_direction = new_direction * np.sign(np.dot(norm, new_direction))
-    new_direction = new_direction / np.linalg.norm(new_direction) + norm
+    if new_direction.dot(norm) < 0:
+        new_direction = -new_direction
+    new_direction = new_direction / sqrt(new_direction.dot(new_direction)) + norm
+
+    return Ray(p, p + new_direction, num_bounces, ray.color)
+
+
+def cosine_ray(p: np.ndarray, norm: np.ndarray, ray: Ray, num_bounces: int = 0,
+               random_normal: np.ndarray = None) -> Ray:
+    # generates a ray around the norm, more likely the closer it is to the norm (pdf = cos(angle)/pi)
+    # a point on the unit sphere pushed out by the norm lands in exactly that distribution
+    new_direction = np.random.standard_normal(norm.shape) if random_normal is None else random_normal
+    new_direction = new_direction / sqrt(new_direction.dot(new_direction)) + norm
 
     return Ray(p, p + new_direction, num_bounces, ray.color)
 
 
 def specular_ray(p: np.ndarray, norm: np.ndarray, ray: Ray, num_bounces: int = 0) -> Ray:
     # returns a ray reflected across the norm
-    new_direction = ray.d - 2 * np.dot(ray.d, norm) * norm
+    new_direction = ray.d - (2 * ray.d.dot(norm)) * norm
 
     return Ray(p, p + new_direction, num_bounces, ray.color)
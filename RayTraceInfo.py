@@ -1,62 +1,87 @@
 import numpy as np
 
 
+def vec3(v) -> np.ndarray:
+    # v as a [3, ] float array, without copying it when it already is one
+    if type(v) is np.ndarray and v.shape == (3, ) and v.dtype == np.float64:
+        return v
+    return np.array(v, dtype=float).reshape([3, ])
+
+
 class RayColorInfo:
-    channels: int = 3
-    ray_color: np.ndarray = np.zeros([3, ])
+    __slots__ = ('channels', 'ray_color')
+    channels: int
+    ray_color: np.ndarray
 
     def __init__(self, channels: int, color):
         self.channels = int(channels)
+        # always holds its own array, so the in-place operators never touch anyone else's color
         if isinstance(color, np.ndarray):
-            self.ray_color = np.array(color).reshape([self.channels, ])
+            self.ray_color = np.array(color, dtype=float).reshape([self.channels, ])
         elif isinstance(color, MaterialInfo):
             if color.emits_light:
-                self.ray_color = np.array(color.emitted_strength * color.emitted_color).reshape([self.channels, ])
+                self.ray_color = np.array(color.emitted_strength * color.emitted_color,
+                                          dtype=float).reshape([self.channels, ])
             else:
                 self.ray_color = np.zeros([self.channels, ])
 
         elif isinstance(color, RayColorInfo):
-            self.ray_color = color.ray_color
+            self.ray_color = color.ray_color.copy()
         else:
             raise TypeError("Could not get color info from: " + str(type(color)))
-        self.ray_color = self.__scale(self.ray_color)
+        self.__scale()
 
-    def __scale(self, color: np.ndarray = ray_color):
-        # scales a numpy array to be below 0
-        scaled = color
-        if np.max(scaled) > 1:
-            scaled = scaled / np.max(scaled)
-        return scaled
+    def __scale(self):
+        # scales the color in place so no channel is above 1
+        max_c = self.ray_color.max()
+        if max_c > 1:
+            self.ray_color /= max_c
 
     def __add__(self, other):
         # add some various options together, make sure to normalize using __scale
         # handles RayColorInfo, MaterialInfo, numpy arrays, and ints
         # for material info, does ray_color * material_color + emitted_light
+        if isinstance(other, MaterialInfo):
+            total_light = np.multiply(other.material_color, self.ray_color)
+            if other.emits_light:
+                total_light += other.emitted_color * other.emitted_strength
+            return RayColorInfo(self.channels, total_light)
+        combo = RayColorInfo(self.channels, self.ray_color)
+        combo += other
+        return combo
+
+    def __iadd__(self, other):
+        # same as +, but accumulates into this color instead of making a new one
         if isinstance(other, RayColorInfo):
-            return RayColorInfo(self.channels, self.__scale(self.ray_color + other.ray_color))
-        elif isinstance(other, MaterialInfo):
-            if not other.emits_light:
-                emitted_light = np.zeros([self.channels, ])
-            else:
-                emitted_light = other.emitted_color * other.emitted_strength
-
-            total_light = np.multiply(other.material_color, self.ray_color) + emitted_light
-            return RayColorInfo(self.channels, self.__scale(total_light))
+            self.ray_color += other.ray_color
         elif isinstance(other, np.ndarray):
-            combo_ray = self.ray_color + other.reshape([self.channels, ])
-            return RayColorInfo(self.channels, self.__scale(combo_ray))
+            self.ray_color += other.reshape([self.channels, ])
         elif isinstance(other, int):
-            return RayColorInfo(self.channels, self.__scale(self.ray_color + other))
+            self.ray_color += other
+        elif isinstance(other, MaterialInfo):
+            self.ray_color *= other.material_color
+            if other.emits_light:
+                self.ray_color += other.emitted_color * other.emitted_strength
         else:
             raise TypeError("Cannot add RayColorInfo and " + str(type(other)))
+        self.__scale()
+        return self
 
     def __mul__(self, other):
+        product = RayColorInfo(self.channels, self.ray_color)
+        product *= other
+        return product
+
+    def __imul__(self, other):
+        # same as *, but scales this color instead of making a new one
         if isinstance(other, int):
-            return RayColorInfo(self.channels, self.ray_color * other)
+            self.ray_color *= other
         elif isinstance(other, RayColorInfo):
-            return RayColorInfo(self.channels, np.multiply(self.ray_color, other.ray_color))
+            self.ray_color *= other.ray_color
         else:
             raise TypeError("Cannot multiply RayColorInfo and " + str(type(other)))
+        self.__scale()
+        return self
 
 
 class MaterialInfo:
@@ -79,23 +104,29 @@ class MaterialInfo:
 
 
 class HitInfo:
-    did_hit: bool = False
-    t_hit: float = np.PINF
-    p_hit: np.ndarray = np.zeros([3, ])
-    norm: np.ndarray = np.zeros([3, ])
-
-    color_info: MaterialInfo = None
-
-    def __init__(self, did: bool = False, t: float = np.PINF, p: np.ndarray = np.zeros([3, ]),
-                 norm: np.ndarray = np.zeros([3, ]), color_info: MaterialInfo = None):
+    __slots__ = ('did_hit', 't_hit', 'p_hit', 'norm', 'color_info', 'obj')
+    did_hit: bool
+    t_hit: float
+    p_hit: np.ndarray
+    norm: np.ndarray
+    color_info: MaterialInfo
+
+    def __init__(self, did: bool = False, t: float = np.inf, p: np.ndarray = np.zeros([3, ]),
+                 norm: np.ndarray = np.zeros([3, ]), color_info: MaterialInfo = None, obj=None):
         self.did_hit = bool(did)
         self.t_hit = float(t)
-        self.p_hit = np.array(p).reshape([3, ])
+        self.p_hit = vec3(p)
         self.color_info = color_info
         self.norm = norm
+        # the RTOType that was hit
+        self.obj = obj
 
     def __str__(self):
         if self.did_hit:
             return f"Hit @ t={self.t_hit}, p={self.p_hit}, color={self.color_info.material_color}"
         else:
             return f"No Hit"
+
+
+# every miss is the same, intersections hand back this one instead of making a new HitInfo. Don't modify it
+MISS = HitInfo()
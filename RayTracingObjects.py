@@ -1,6 +1,9 @@
 import numpy as np
+import forward_funcs as ff
 from Ray import Ray
-from RayTraceInfo import MaterialInfo, HitInfo
+from math import sqrt
+from BVH import BVH
+from RayTraceInfo import MaterialInfo, HitInfo, MISS
 
 """ 
     Package holding various objects for raytracing (plane, sphere) derived from a super type
@@ -8,6 +11,78 @@ from RayTraceInfo import MaterialInfo, HitInfo
     A struct-like class, HitInfo, which holds stuff like, color, and if/when/where the intersection happened
 """
 
+# smallest t accepted by the batched intersections, keeps bounced rays from hitting the surface they left
+EPSILON = 1e-9
+# float32 hit points are only good to about 1e-7 of the scene's size, so bounced rays need a wider berth
+EPSILON_FLOAT32 = 1e-4
+
+
+def epsilon_for(dtype) -> float:
+    # the EPSILON to use for rays and geometry stored as dtype
+    return EPSILON_FLOAT32 if np.dtype(dtype) == np.float32 else EPSILON
+
+
+def dot_rows(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # dot product along the last axis, summed x, y then z so the compiled kernels can match it exactly
+    return a[..., 0] * b[..., 0] + a[..., 1] * b[..., 1] + a[..., 2] * b[..., 2]
+
+
+def sphere_intersect_batch(center: np.ndarray, radius2: float, origins: np.ndarray,
+                           directions: np.ndarray, epsilon: float = EPSILON) -> np.ndarray:
+    """
+    Rays against one sphere, only the near root counts (a ray leaving the surface misses it)
+    :param center: [3, ] center
+    :param radius2: radius squared
+    :param origins: [N, 3] ray origins
+    :param directions: [N, 3] unit ray directions
+    :param epsilon: Smallest t that counts as a hit, see epsilon_for
+    :return: [N, ] t of the hit, np.inf for a miss, in the rays' dtype
+    """
+    c_to_e = origins - center
+    b = dot_rows(directions, c_to_e)
+    c = dot_rows(c_to_e, c_to_e) - radius2
+
+    discriminant = b**2 - c
+    t = np.full(origins.shape[0], np.inf, dtype=discriminant.dtype)
+    hit = discriminant >= 0
+    t_near = -b[hit] - np.sqrt(discriminant[hit])
+    t[hit] = np.where(t_near > epsilon, t_near, np.inf)
+    return t
+
+
+def plane_intersect_batch(offset: float, norm: np.ndarray, origins: np.ndarray, directions: np.ndarray,
+                          epsilon: float = EPSILON) -> np.ndarray:
+    """
+    Rays against one plane, the points p with dot(p, norm) == offset
+    :return: [N, ] t of the hit, np.inf for a miss
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (offset - dot_rows(origins, norm))/dot_rows(directions, norm)
+    return np.where(t > epsilon, t, np.inf)
+
+
+def triangle_intersect_batch(v0: np.ndarray, e1: np.ndarray, e2: np.ndarray, origins: np.ndarray,
+                             directions: np.ndarray, epsilon: float = EPSILON) -> np.ndarray:
+    """
+    Rays against one triangle, Moller-Trumbore. Both sides count, and the directions don't have to be unit length,
+    t is always in units of the direction given
+    :param v0: [3, ] first corner
+    :param e1: [3, ] second corner - first corner
+    :param e2: [3, ] third corner - first corner
+    :return: [N, ] t of the hit, np.inf for a miss
+    """
+    p = np.cross(directions, e2)
+    det = p @ e1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inv_det = 1/det
+        to_o = origins - v0
+        u = dot_rows(to_o, p) * inv_det
+        q = np.cross(to_o, e1)
+        v = dot_rows(directions, q) * inv_det
+        t = (q @ e2) * inv_det
+        hit = (det != 0) & (u >= 0) & (v >= 0) & (u + v <= 1) & (t > epsilon)
+    return np.where(hit, t, np.inf)
+
 
 class RTOType:
     color_info: MaterialInfo = None
@@ -19,11 +94,43 @@ class RTOType:
         return self.color_info.material_color
 
     def intersect(self, ray: Ray) -> HitInfo:
-        return HitInfo()
+        return MISS
 
     def get_norm(self, p) -> np.ndarray:
         return np.zeros([3, ])
 
+    def bounds(self):
+        # axis aligned box around the object as ([3, ] low corner, [3, ] high corner), None if it is unbounded
+        return None
+
+    def sample_light(self, p: np.ndarray, u1: float, u2: float):
+        """
+        Picks a direction from p towards the object, for objects that give off light
+        :param p: [3, ] point being lit
+        :param u1: uniform random number in [0, 1)
+        :param u2: uniform random number in [0, 1)
+        :return: ([3, ] unit direction, pdf of that direction per unit solid angle),
+                 None if the object can't be sampled from p (unbounded, or p is inside it)
+        """
+        return None
+
+    def light_pdf(self, p: np.ndarray, direction: np.ndarray) -> float:
+        # pdf (per unit solid angle) that sample_light picks the unit direction from p, 0 if it never would
+        return 0.0
+
+    def intersect_batch(self, origins: np.ndarray, directions: np.ndarray) -> np.ndarray:
+        """
+        Intersects a whole batch of rays with the object at once
+        :param origins: [N, 3] ray origins
+        :param directions: [N, 3] unit ray directions
+        :return: [N, ] distances along each ray to the hit, np.inf where the ray missed
+        """
+        return np.full(origins.shape[0], np.inf)
+
+    def get_norm_batch(self, points: np.ndarray) -> np.ndarray:
+        # [N, 3] normals for [N, 3] points on the surface
+        return np.zeros(points.shape)
+
 
 class Sphere(RTOType):
     radius = 0.0
@@ -38,25 +145,65 @@ class Sphere(RTOType):
                                        emitted_strength=light_strength, specular_probability=specular_power)
 
     def intersect(self, ray: Ray) -> HitInfo:
+        # t is measured along the unit direction, the same one pos_at_t walks along, so a == 1
         c_to_e = ray.o - self.center
-        a = np.dot(ray.d, ray.d)
-        b = 2 * np.dot(ray.d, c_to_e)
-        c = np.dot(c_to_e, c_to_e) - self.radius**2
+        b = 2 * ray.dir.dot(c_to_e)
+        c = c_to_e.dot(c_to_e) - self.radius**2
 
-        discriminant = b**2 - 4 * a * c
+        discriminant = b*b - 4 * c
         if discriminant < 0:
-            return HitInfo()
+            return MISS
 
-        t1 = (-b + np.sqrt(discriminant))/(2 * a)
-        t2 = (-b - np.sqrt(discriminant))/(2 * a)
-        t = min(t1, t2)
-        p = ray.pos_at_t(t)
+        # the near root, a hit behind the ray counts as a miss
+        t = (-b - sqrt(discriminant))/2
+        if t <= 0:
+            return MISS
+        p = ray.o + ray.dir * t
 
-        return HitInfo(True, t, p, self.get_norm(p), self.get_color_info())
+        return HitInfo(True, t, p, self.get_norm(p), self.color_info, self)
 
     def get_norm(self, p) -> np.ndarray:
-        point = np.array(p).reshape([3, ])
-        return (point - self.center)/np.linalg.norm(point - self.center)
+        to_p = p - self.center if type(p) is np.ndarray else np.array(p).reshape([3, ]) - self.center
+        return to_p/sqrt(to_p.dot(to_p))
+
+    def bounds(self):
+        return self.center - self.radius, self.center + self.radius
+
+    def __cone(self, p: np.ndarray):
+        # unit vector from p to the center, and the cosine of the widest angle the sphere covers as seen from p
+        to_c = self.center - p
+        dist2 = np.dot(to_c, to_c)
+        if dist2 <= self.radius**2:
+            return None, 1.0
+        return to_c/np.sqrt(dist2), np.sqrt(1 - self.radius**2/dist2)
+
+    def sample_light(self, p: np.ndarray, u1: float, u2: float):
+        # uniform over the cone of directions that reach the sphere
+        w, cos_max = self.__cone(p)
+        if w is None:
+            return None
+        cos_t = 1 - u1 * (1 - cos_max)
+        sin_t = np.sqrt(max(0.0, 1 - cos_t**2))
+        phi = 2 * np.pi * u2
+        # any two vectors at right angles to w finish the frame
+        u = np.cross([1.0, 0.0, 0.0] if abs(w[0]) < 0.9 else [0.0, 1.0, 0.0], w)
+        u = u/np.linalg.norm(u)
+        v = np.cross(w, u)
+        direction = sin_t * np.cos(phi) * u + sin_t * np.sin(phi) * v + cos_t * w
+        return direction, 1/(2 * np.pi * (1 - cos_max))
+
+    def light_pdf(self, p: np.ndarray, direction: np.ndarray) -> float:
+        w, cos_max = self.__cone(p)
+        if w is None or np.dot(direction, w) < cos_max:
+            return 0.0
+        return 1/(2 * np.pi * (1 - cos_max))
+
+    def intersect_batch(self, origins: np.ndarray, directions: np.ndarray) -> np.ndarray:
+        return sphere_intersect_batch(self.center, self.radius**2, origins, directions)
+
+    def get_norm_batch(self, points: np.ndarray) -> np.ndarray:
+        to_p = points - self.center
+        return to_p/np.linalg.norm(to_p, axis=1, keepdims=True)
 
 
 class Plane(RTOType):
@@ -85,12 +232,205 @@ class Plane(RTOType):
                                        emitted_strength=light_strength, specular_probability=specular_power)
 
     def intersect(self, ray: Ray) -> HitInfo:
-        t = np.dot(self.p - ray.o, self.norm)/np.dot(ray.dir, self.norm)
-        if t < 0:
-            return HitInfo()
-        p = ray.pos_at_t(t)
-        return HitInfo(True, t, p, self.get_norm(p), self.get_color_info())
+        facing = ray.dir.dot(self.norm)
+        if facing == 0:
+            return MISS
+        t = (self.p - ray.o).dot(self.norm)/facing
+        if t < EPSILON:
+            return MISS
+        p = ray.o + ray.dir * t
+        return HitInfo(True, t, p, self.norm, self.color_info, self)
 
     def get_norm(self, p) -> np.ndarray:
         return self.norm
 
+    def intersect_batch(self, origins: np.ndarray, directions: np.ndarray) -> np.ndarray:
+        return plane_intersect_batch(np.dot(self.p, self.norm), self.norm, origins, directions)
+
+    def get_norm_batch(self, points: np.ndarray) -> np.ndarray:
+        return np.broadcast_to(self.norm, points.shape).copy()
+
+
+class TriangleMesh(RTOType):
+    vertices: np.ndarray = None
+    faces: np.ndarray = None
+    face_normals: np.ndarray = None
+    bvh: BVH = None
+
+    def __init__(self, vertices, faces, color: np.ndarray = np.zeros([3, ]), channels: int = 3,
+                 light_source: bool = False, light_color: np.ndarray = np.zeros([3, ]),
+                 light_strength: float = 0.0, specular_power: float = 0.0, leaf_size: int = 4):
+        """
+        A surface made of triangles sharing one material, kept as packed arrays under its own BVH
+        :param vertices: [V, 3] corner positions
+        :param faces: [T, 3] indices into vertices of every triangle's corners.
+                      Counter-clockwise corners (seen from outside) make the normal point outward
+        :param leaf_size: Most triangles in a leaf of the mesh's BVH
+        """
+        self.vertices = np.array(vertices, dtype=float).reshape([-1, 3])
+        self.faces = np.array(faces, dtype=np.int64).reshape([-1, 3])
+        if self.faces.size == 0:
+            raise ValueError("TriangleMesh: A mesh needs at least one face, found ", self.faces.shape)
+        if self.faces.min() < 0 or self.faces.max() >= self.vertices.shape[0]:
+            raise ValueError("TriangleMesh: Face indices out of range of the vertices, ",
+                             (int(self.faces.min()), int(self.faces.max())))
+        corners = self.vertices[self.faces]
+        # the corners every intersection needs, worked out once
+        self.v0 = corners[:, 0]
+        self.e1 = corners[:, 1] - corners[:, 0]
+        self.e2 = corners[:, 2] - corners[:, 0]
+        normals = np.cross(self.e1, self.e2)
+        length = np.linalg.norm(normals, axis=1, keepdims=True)
+        # degenerate triangles have no normal, nothing ever hits them either
+        self.face_normals = np.divide(normals, length, out=np.zeros(normals.shape), where=length > 0)
+        self.bvh = BVH(corners.min(axis=1), corners.max(axis=1), leaf_size=leaf_size)
+        # hit points can be a rounding error off their triangle, more so for float32 rays
+        self.tolerance = 1e-5 * max(float(np.ptp(corners.reshape([-1, 3]), axis=0).max()), 1.0)
+
+        self.color_info = MaterialInfo(channels, color, emits_light=light_source, emitted_color=light_color,
+                                       emitted_strength=light_strength, specular_probability=specular_power)
+
+    def __len__(self):
+        return self.faces.shape[0]
+
+    def closest_triangles(self, origins: np.ndarray, directions: np.ndarray,
+                          epsilon: float = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Closest triangle along each of a batch of rays, the directions don't have to be unit length
+        :param epsilon: Smallest t that counts, the one for the rays' dtype if not given
+        :return: [N, ] t (np.inf for a miss), [N, ] triangle index (-1 for a miss)
+        """
+        epsilon = epsilon_for(origins.dtype) if epsilon is None else epsilon
+        return self.bvh.closest_hit_batch(origins, directions, lambda prim, o, d: triangle_intersect_batch(
+            self.v0[prim], self.e1[prim], self.e2[prim], o, d, epsilon))
+
+    def closest_hit(self, origin: np.ndarray, direction: np.ndarray) -> HitInfo:
+        """
+        Closest triangle along a single ray, direction doesn't have to be unit length
+        :return: HitInfo with t in units of direction, the hit point and the triangle's normal
+        """
+        o = np.asarray(origin, dtype=float)
+        d = np.asarray(direction, dtype=float)
+
+        def intersect(prim: int) -> HitInfo:
+            t = triangle_intersect_batch(self.v0[prim], self.e1[prim], self.e2[prim], o[None], d[None])[0]
+            if t == np.inf:
+                return MISS
+            return HitInfo(True, t, o + d * t, self.face_normals[prim], self.color_info, self)
+        return self.bvh.closest_hit(o, d, intersect)
+
+    def intersect(self, ray: Ray) -> HitInfo:
+        return self.closest_hit(ray.o, ray.dir)
+
+    def triangles_at(self, points: np.ndarray) -> np.ndarray:
+        # [N, ] triangle each point lies on, -1 for points on none of them
+        tolerance = self.tolerance
+
+        def distance(prim: int, p: np.ndarray) -> np.ndarray:
+            # how far off the triangle's plane, np.inf if the point is beside the triangle rather than over it
+            e1, e2 = self.e1[prim], self.e2[prim]
+            to_p = p - self.v0[prim]
+            d00, d01, d11 = e1 @ e1, e1 @ e2, e2 @ e2
+            d20, d21 = to_p @ e1, to_p @ e2
+            denom = d00 * d11 - d01 * d01
+            if denom == 0:
+                return np.full(p.shape[0], np.inf)
+            v = (d11 * d20 - d01 * d21)/denom
+            w = (d00 * d21 - d01 * d20)/denom
+            inside = (v >= -1e-4) & (w >= -1e-4) & (v + w <= 1 + 1e-4)
+            return np.where(inside, np.abs(to_p @ self.face_normals[prim]), np.inf)
+        return self.bvh.nearest_batch(np.asarray(points, dtype=float), distance, tolerance)[1]
+
+    def get_norm(self, p) -> np.ndarray:
+        return self.get_norm_batch(np.array(p, dtype=float).reshape([1, 3]))[0]
+
+    def bounds(self):
+        # the BVH's root box, rounded out a hair when it was stored
+        return self.bvh.node_lo[0].copy(), self.bvh.node_hi[0].copy()
+
+    def intersect_batch(self, origins: np.ndarray, directions: np.ndarray) -> np.ndarray:
+        return self.closest_triangles(origins, directions)[0]
+
+    def get_norm_batch(self, points: np.ndarray) -> np.ndarray:
+        tri = self.triangles_at(points)
+        norms = self.face_normals[np.maximum(tri, 0)]
+        norms[tri < 0] = 0
+        return norms.astype(points.dtype, copy=False)
+
+
+class Instance(RTOType):
+    mesh: TriangleMesh = None
+    transform: np.ndarray = None
+    inverse: np.ndarray = None
+
+    def __init__(self, mesh: TriangleMesh, transform: np.ndarray = np.eye(4), color: np.ndarray = None,
+                 channels: int = 3, light_source: bool = False, light_color: np.ndarray = np.zeros([3, ]),
+                 light_strength: float = 0.0, specular_power: float = 0.0):
+        """
+        A copy of a mesh placed somewhere else, all copies share the mesh's arrays and BVH
+        :param mesh: The TriangleMesh to place
+        :param transform: [4, 4] homogeneous object to world transform, e.g.
+                          ff.homogenous_transform(ff.rotate_y(90, True), np.array([[x], [y], [z]]))
+        :param color: The copy's own material color, if not given it shares the mesh's MaterialInfo
+        """
+        if not isinstance(mesh, TriangleMesh):
+            raise TypeError("Instance initialization: Was expecting TriangleMesh, found ", type(mesh))
+        self.mesh = mesh
+        self.set_transform(transform)
+        if color is None:
+            self.color_info = mesh.color_info
+        else:
+            self.color_info = MaterialInfo(channels, color, emits_light=light_source, emitted_color=light_color,
+                                           emitted_strength=light_strength, specular_probability=specular_power)
+
+    def set_transform(self, transform: np.ndarray):
+        self.transform = np.array(transform, dtype=float).reshape([4, 4])
+        self.inverse = np.linalg.inv(self.transform)
+
+    def move(self, offset):
+        # slides the copy over without turning it
+        transform = self.transform.copy()
+        transform[:3, 3] += np.array(offset, dtype=float).reshape([3, ])
+        self.set_transform(transform)
+
+    def to_object(self, points: np.ndarray) -> np.ndarray:
+        # [N, 3] world points in the mesh's own frame
+        return ff.homo_to_points(self.inverse @ ff.points_to_homo(points.T)).T
+
+    def to_object_directions(self, directions: np.ndarray) -> np.ndarray:
+        # directions only turn and stretch, they don't move, and aren't unit length afterwards
+        return directions @ ff.homo_to_trans(self.inverse).T
+
+    def to_world_normals(self, normals: np.ndarray) -> np.ndarray:
+        # normals go through the inverse transpose to stay at right angles to a stretched surface
+        normals = normals @ ff.homo_to_trans(self.inverse)
+        length = np.linalg.norm(normals, axis=-1, keepdims=True)
+        return np.divide(normals, length, out=np.zeros(normals.shape), where=length > 0)
+
+    def intersect(self, ray: Ray) -> HitInfo:
+        # t along the mesh's frame ray is the same t along the world ray, the two are the same line
+        hit = self.mesh.closest_hit(self.to_object(ray.o[None])[0], self.to_object_directions(ray.dir[None])[0])
+        if not hit.did_hit:
+            return MISS
+        p = ray.o + ray.dir * hit.t_hit
+        return HitInfo(True, hit.t_hit, p, self.to_world_normals(hit.norm), self.color_info, self)
+
+    def get_norm(self, p) -> np.ndarray:
+        return self.get_norm_batch(np.array(p, dtype=float).reshape([1, 3]))[0]
+
+    def bounds(self):
+        # the box around the mesh's box once it is placed
+        lo, hi = self.mesh.bounds()
+        corners = np.array([[x, y, z] for x in (lo[0], hi[0]) for y in (lo[1], hi[1]) for z in (lo[2], hi[2])])
+        corners = ff.homo_to_points(self.transform @ ff.points_to_homo(corners.T)).T
+        return corners.min(axis=0), corners.max(axis=0)
+
+    def intersect_batch(self, origins: np.ndarray, directions: np.ndarray) -> np.ndarray:
+        # worked out in float64 in the mesh's frame, keeping the epsilon of the rays' own precision
+        o = self.to_object(origins.astype(float))
+        d = self.to_object_directions(directions.astype(float))
+        return self.mesh.closest_triangles(o, d, epsilon_for(origins.dtype))[0].astype(origins.dtype, copy=False)
+
+    def get_norm_batch(self, points: np.ndarray) -> np.ndarray:
+        norms = self.mesh.get_norm_batch(self.to_object(points.astype(float)))
+        return self.to_world_normals(norms).astype(points.dtype, copy=False)
@@ -0,0 +1,112 @@
+import hashlib
+import numpy as np
+from time import perf_counter
+from Wavefront import WavefrontRenderer
+
+"""
+    Relighting, re-renders a scene after material and light edits without intersecting the camera rays again
+    The first render keeps what every camera ray hit. Later renders start their paths from those hits,
+    as long as the geometry and the camera are still the same, and the colors, specular probabilities, emission
+    and ambient color are all read fresh. Moving an object or the camera is noticed and the hits are found again
+"""
+
+
+def fingerprint(*values) -> str:
+    # hash of a mix of arrays and plain values, arrays count by their bytes, everything else by its repr
+    h = hashlib.blake2b(digest_size=16)
+    for value in values:
+        if isinstance(value, np.ndarray):
+            h.update(str((value.dtype.str, value.shape)).encode())
+            h.update(np.ascontiguousarray(value).tobytes())
+        else:
+            h.update(repr(value).encode())
+    return h.hexdigest()
+
+
+def camera_fingerprint(cam) -> str:
+    # everything that decides where the camera rays go
+    return fingerprint(cam.loc, cam.to, cam.up, cam.f, cam.x_values, cam.y_values, cam.dtype.str)
+
+
+def sampler_fingerprint(sampler) -> tuple:
+    # which numbers a sampler hands out, None for the global numpy stream
+    if sampler is None:
+        return None
+    return type(sampler).__name__, sampler.seed, sampler.jitter, getattr(sampler, "grid", None)
+
+
+def geometry_fingerprint(scene) -> str:
+    """
+    Changes whenever an object is added, removed, swapped or changed in anything but its material.
+    Every attribute of every object counts, other than its MaterialInfo
+    """
+    values = [len(scene.objects), scene.dtype.str]
+    for o in scene.objects:
+        values.append((type(o).__name__, id(o)))
+        for name, value in sorted(vars(o).items()):
+            if name == "color_info":
+                continue
+            values.append(name)
+            values.append(np.asarray(value) if isinstance(value, (np.ndarray, list, tuple)) else value)
+    if scene.compiled is not None and len(scene.compiled) != len(scene.objects):
+        # a scene loaded from a file has no objects, its geometry can't change
+        values.append(scene.compiled.source)
+    return fingerprint(*values)
+
+
+class RelightSession:
+    scene = None
+    renderer: WavefrontRenderer = None
+    hits: tuple = None
+    key: tuple = None
+    refreshes: int = 0
+    geometry: str = None
+
+    def __init__(self, scene, backend: str = "auto", chunk_size: int = 1 << 16):
+        """
+        :param scene: Scene to keep relighting, renders go through the wavefront mode
+        :param backend: Kernels to trace with, see Kernels
+        :param chunk_size: Most paths traced together, see WavefrontRenderer
+        """
+        self.scene = scene
+        self.renderer = WavefrontRenderer(scene, chunk_size, backend)
+        self.hits = None
+        self.key = None
+        self.refreshes = 0
+        self.geometry = None
+
+    def invalidate(self):
+        # forgets the cached hits, the next render finds them again
+        self.hits = None
+        self.key = None
+
+    def cache_key(self, n_rays: int) -> tuple:
+        # what the cached hits depend on, the sampler decides where jittered camera rays go
+        geometry = geometry_fingerprint(self.scene)
+        return geometry, camera_fingerprint(self.scene.cam), int(n_rays), sampler_fingerprint(self.scene.sampler)
+
+    def render(self, n_bounces: int = 1, n_incident_rays: int = 1, n_rays: int = 1) -> np.ndarray:
+        """
+        Renders like Scene.render(mode="wavefront"), reusing the camera rays' hits from the last render
+        if nothing they depend on has changed
+        :return: The image as a [y_res, x_res, C] uint8 array
+        """
+        scene, cam = self.scene, self.scene.cam
+        key = self.cache_key(n_rays)
+        if self.hits is None or key != self.key:
+            if self.geometry is not None and key[0] != self.geometry:
+                # objects moved in place, the BVH has to follow them before anything is intersected
+                scene.refit_bvh()
+            self.hits = self.renderer.first_hits(np.arange(cam.x_res * cam.y_res), n_rays)
+            self.key = key
+            self.geometry = key[0]
+            self.refreshes += 1
+
+        colors = self.renderer.render_pixels(np.arange(cam.x_res * cam.y_res), n_bounces, n_incident_rays, n_rays,
+                                             first_hits=self.hits)
+        start = perf_counter()
+        cam.image[:] = colors.reshape([cam.y_res, cam.x_res, -1]).transpose((1, 0, 2))
+        image = cam.get_image()
+        if scene.stats is not None:
+            scene.stats.add_time("framebuffer", start)
+        return image
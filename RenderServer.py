@@ -0,0 +1,419 @@
+import argparse
+import asyncio
+import base64
+import json
+import multiprocessing
+import itertools
+import numpy as np
+import RayTracingObjects as rto
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from Camera import Camera
+from Scene import Scene
+from Kernels import get_backend
+from Sampler import get_sampler
+from ObjLoader import load_obj
+from ImageSink import open_sink
+
+"""
+    Local render service, keeps a pool of warm worker processes around so a render doesn't pay for starting python,
+    importing numpy and building its scene every time
+    Clients connect over TCP to localhost and send one JSON object per line, either
+        {"op": "render", "job": {...}}   queue a render, see build_scene and run_job for what a job holds
+        {"op": "cancel", "id": "..."}    drop a queued job, or stop a progressive one after its current pass,
+                                         an id that is neither gets an error
+        {"op": "status"}                 how many jobs are waiting and running
+    Job ids are strings, a number given as an id comes back as one
+    and get JSON events back one per line: queued, started, progress (every pass of a progressive render, with the
+    estimate so far), then done, error or cancelled. Jobs with a higher "priority" go first, equal ones in the order
+    they came in
+
+    python RenderServer.py --port 8765 --workers 4
+"""
+
+# events after which a job has nothing more to say
+FINAL_EVENTS = ("done", "error", "cancelled")
+# scenes each worker keeps built, by their description, for jobs that only move the camera or change settings
+SCENE_CACHE_SIZE = 8
+
+# per worker state
+_scenes: OrderedDict = OrderedDict()
+_meshes: dict = dict()
+
+
+def build_camera(description: dict) -> Camera:
+    """
+    :param description: {"origin": [3], "looking_at": [3], and optionally "x_res", "y_res", "up", "focal_length",
+                         "field_of_view_x", "field_of_view_y" (radians), "num_colors", "precision"}
+    """
+    return Camera(np.array(description["origin"], dtype=float), np.array(description["looking_at"], dtype=float),
+                  x_res=description.get("x_res", 256), y_res=description.get("y_res", 256),
+                  focal_length=description.get("focal_length", 0.0), num_colors=description.get("num_colors", 3),
+                  field_of_view_x=description.get("field_of_view_x", np.pi/2),
+                  field_of_view_y=description.get("field_of_view_y", np.pi/2), up=description.get("up", (0, 1, 0)),
+                  dtype=description.get("precision", "float64"))
+
+
+def build_objects(description: dict) -> list[rto.RTOType]:
+    """
+    :param description: One object, its "type" and what that type is made from, plus the material
+                        ("color", "specular_power", "light_source", "light_color", "light_strength").
+                        "sphere": "radius", "center"
+                        "plane": "point", "normal"
+                        "mesh": "path" to an .obj, and optionally "instances", a list of [4, 4] transforms
+                        to place copies of it instead of the mesh itself
+    :return: The objects it describes
+    """
+    material = {key: description[key] for key in ("color", "specular_power", "light_source", "light_color",
+                                                  "light_strength") if key in description}
+    kind = description.get("type")
+    if kind == "sphere":
+        return [rto.Sphere(description["radius"], description["center"], **material)]
+    if kind == "plane":
+        return [rto.Plane(np.array(description["point"], dtype=float), np.array(description["normal"], dtype=float),
+                          **material)]
+    if kind == "mesh":
+        key = (description["path"], json.dumps(material, sort_keys=True))
+        # a mesh is read once per worker, every job after that shares its arrays
+        if key not in _meshes:
+            _meshes[key] = load_obj(description["path"], **material)
+        mesh = _meshes[key]
+        if "instances" in description:
+            return [rto.Instance(mesh, transform) for transform in description["instances"]]
+        return [mesh]
+    raise ValueError("RenderServer build_objects: Unknown object type ", kind)
+
+
+def build_scene(job: dict) -> Scene:
+    """
+    :param job: {"camera": see build_camera, "objects": list, see build_objects, "ambient": [C] color}
+    :return: The scene, reused from the last few jobs with the same objects and ambient color
+    """
+    camera = build_camera(job["camera"])
+    key = json.dumps([job["objects"], job.get("ambient"), camera.num_channels, str(camera.dtype)], sort_keys=True)
+    if key in _scenes:
+        _scenes.move_to_end(key)
+        scene = _scenes[key]
+        scene.cam = camera
+        return scene
+    objects = [o for description in job["objects"] for o in build_objects(description)]
+    scene = Scene(camera, *objects, color=job.get("ambient", np.zeros(camera.num_channels)))
+    _scenes[key] = scene
+    if len(_scenes) > SCENE_CACHE_SIZE:
+        _scenes.popitem(last=False)
+    return scene
+
+
+def warm_worker():
+    # runs once in every worker as it starts, a tiny render gets the kernels loaded (and compiled, with numba)
+    get_backend("auto")
+    cam = Camera(np.array([0, 0, 0]), np.array([0, 0, 1]), x_res=2, y_res=2)
+    Scene(cam, rto.Sphere(.5, [0, 0, 2]), rto.Plane([0, -1, 0], [0, 1, 0])).render(1, 1, mode="wavefront")
+
+
+def ping() -> bool:
+    return True
+
+
+def finite(value: float):
+    # JSON has no infinity
+    return float(value) if np.isfinite(value) else None
+
+
+def run_job(job: dict, events, cancelled) -> str:
+    """
+    Renders one job in a worker, putting its progress and its result on events
+    :param job: {"id", "camera", "objects", "ambient", see build_scene, and optionally
+                 "render": {"mode", "n_bounces", "n_incident_rays", "n_rays", "backend", "seed"},
+                 "sampler": {"name", "seed"}, "passes": progressive passes (each pass one sample per pixel),
+                 "target_noise", "time_budget": when to stop passing early, "denoise": true,
+                 "output": .png or .npy path to write, the pixels come back in the progress and done events
+                 otherwise}
+    :param events: Queue the events go on, shared with the server
+    :param cancelled: Ids of jobs the server has been asked to cancel
+    :return: The final event's name
+    """
+    job_id = job["id"]
+    start = perf_counter()
+    scene = build_scene(job)
+    settings = job.get("render", dict())
+    mode = settings.get("mode", "wavefront")
+    n_bounces = settings.get("n_bounces", 1)
+    n_incident_rays = settings.get("n_incident_rays", 1)
+    backend = settings.get("backend", "auto")
+    sampler = job.get("sampler")
+    scene.sampler = get_sampler(sampler.get("name", "random"), sampler.get("seed", 0)) if sampler else None
+    np.random.seed(settings.get("seed", 0))
+
+    passes = int(job.get("passes", 1))
+    if passes > 1:
+        for p, image in enumerate(scene.render_progressive(n_bounces, n_incident_rays, mode, job.get("target_noise"),
+                                                           job.get("time_budget"), passes)):
+            events.put(deliver({"event": "progress", "id": job_id, "pass": p + 1, "passes": passes,
+                                "noise": finite(scene.cam.noise_level()), "elapsed": perf_counter() - start},
+                               job, scene, image))
+            if job_id in cancelled:
+                events.put({"event": "cancelled", "id": job_id, "pass": p + 1})
+                return "cancelled"
+    else:
+        image = scene.render(n_bounces, n_incident_rays, settings.get("n_rays", 1), mode=mode, backend=backend,
+                             seed=settings.get("seed", 0))
+    if job.get("denoise"):
+        image = scene.denoise(backend=backend)
+
+    events.put(deliver({"event": "done", "id": job_id, "elapsed": perf_counter() - start}, job, scene, image))
+    return "done"
+
+
+def deliver(event: dict, job: dict, scene: Scene, image: np.ndarray) -> dict:
+    """
+    Attaches the image to a progress or done event, either written to the job's output, every pass overwriting
+    the last one's estimate, or as base64 pixels in the event itself
+    :param image: [y_res, x_res, C] uint8 image, scene's camera holds the same estimate unquantized
+    :return: The event
+    """
+    event["shape"] = list(image.shape)
+    if job.get("output"):
+        cam = scene.cam
+        sink = open_sink(job["output"], cam.x_res, cam.y_res, cam.num_channels)
+        sink.write_tile((0, cam.x_res, 0, cam.y_res), cam.image.transpose((1, 0, 2)))
+        sink.close()
+        event["path"] = job["output"]
+    else:
+        event["pixels"] = base64.b64encode(image.tobytes()).decode()
+    return event
+
+
+def decode_image(event: dict) -> np.ndarray:
+    # the [y_res, x_res, C] uint8 image out of a progress or done event
+    return np.frombuffer(base64.b64decode(event["pixels"]), dtype=np.uint8).reshape(event["shape"])
+
+
+class RenderServer:
+    host: str = "127.0.0.1"
+    port: int = 8765
+    workers: int = 1
+    running: set = set()
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8765, workers: int = None):
+        """
+        :param host: Address to listen on, keep it local, jobs can read and write any path the server can
+        :param port: Port to listen on, 0 picks a free one (read it back from port after start)
+        :param workers: Worker processes, one per core if not given
+        """
+        self.host = host
+        self.port = int(port)
+        self.workers = max(1, int(workers or multiprocessing.cpu_count()))
+        self.running = set()
+        self.__listeners = dict()
+        self.__ids = itertools.count()
+        self.__tasks = []
+        self.__connections = set()
+
+    async def start(self):
+        # starts the workers and waits for all of them to be warm, then starts listening
+        loop = asyncio.get_running_loop()
+        self.__manager = multiprocessing.Manager()
+        self.__events = self.__manager.Queue()
+        self.__cancelled = self.__manager.dict()
+        self.__pool = ProcessPoolExecutor(self.workers, initializer=warm_worker)
+        await asyncio.gather(*[loop.run_in_executor(self.__pool, ping) for _ in range(self.workers)])
+        self.__queue = asyncio.PriorityQueue()
+        self.__tasks = [asyncio.create_task(self.__dispatch()) for _ in range(self.workers)]
+        self.__tasks.append(asyncio.create_task(self.__forward_events()))
+        self.__server = await asyncio.start_server(self.__handle, self.host, self.port)
+        self.port = self.__server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self.__server.serve_forever()
+        finally:
+            await self.close()
+
+    async def close(self):
+        self.__server.close()
+        # connections still open are dropped, along with whatever they were waiting on
+        for task in self.__tasks + list(self.__connections):
+            task.cancel()
+        await asyncio.gather(*self.__tasks, *self.__connections, return_exceptions=True)
+        await self.__server.wait_closed()
+        # wakes the thread waiting on the event queue so it can finish
+        self.__events.put(None)
+        self.__pool.shutdown(cancel_futures=True)
+        self.__manager.shutdown()
+
+    def __emit(self, event: dict):
+        listener = self.__listeners.get(event["id"])
+        if listener is not None:
+            listener.put_nowait(event)
+
+    async def __forward_events(self):
+        # the workers' events come through a process queue, they are handed to whoever submitted the job
+        loop = asyncio.get_running_loop()
+        while True:
+            event = await loop.run_in_executor(None, self.__events.get)
+            if event is None:
+                return
+            self.__emit(event)
+
+    async def __dispatch(self):
+        # one of these per worker, so a job only leaves the queue once a worker is free for it
+        loop = asyncio.get_running_loop()
+        while True:
+            priority, number, job = await self.__queue.get()
+            job_id = job["id"]
+            if job_id in self.__cancelled:
+                self.__emit({"event": "cancelled", "id": job_id})
+                self.__forget(job_id)
+                continue
+            self.running.add(job_id)
+            self.__emit({"event": "started", "id": job_id})
+            try:
+                await loop.run_in_executor(self.__pool, run_job, job, self.__events, self.__cancelled)
+            except Exception as e:
+                self.__emit({"event": "error", "id": job_id, "message": repr(e)})
+            finally:
+                self.running.discard(job_id)
+                self.__forget(job_id)
+
+    def __forget(self, job_id):
+        # a job whose client went away is cancelled with nobody listening, nothing else would clear it
+        if job_id not in self.__listeners:
+            self.__cancelled.pop(job_id, None)
+
+    async def __handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # one connection can send any number of requests, the events of its jobs come back interleaved
+        lock = asyncio.Lock()
+        requests = []
+        connection = asyncio.current_task()
+        self.__connections.add(connection)
+
+        async def send(event: dict):
+            async with lock:
+                writer.write((json.dumps(event) + "\n").encode())
+                await writer.drain()
+
+        async def render(job: dict):
+            number = next(self.__ids)
+            job = dict(job)
+            job.setdefault("id", str(number))
+            if not isinstance(job["id"], (str, int)):
+                await send({"event": "error", "id": None, "message": "A job id is a string or a number"})
+                return
+            # ids are kept as strings, so 5 and "5" are the same job and the running ones can be sorted
+            job_id = job["id"] = str(job["id"])
+            try:
+                priority = -float(job.get("priority", 0))
+            except (TypeError, ValueError):
+                await send({"event": "error", "id": job_id, "message": "A job priority is a number"})
+                return
+            if job_id in self.__listeners:
+                await send({"event": "error", "id": job_id, "message": "A job with this id is already queued"})
+                return
+            listener = asyncio.Queue()
+            self.__listeners[job_id] = listener
+            finished = False
+            try:
+                self.__queue.put_nowait((priority, number, job))
+                await send({"event": "queued", "id": job_id, "waiting": self.__queue.qsize()})
+                while True:
+                    event = await listener.get()
+                    await send(event)
+                    if event["event"] in FINAL_EVENTS:
+                        finished = True
+                        return
+            finally:
+                del self.__listeners[job_id]
+                if finished:
+                    self.__cancelled.pop(job_id, None)
+                else:
+                    # nobody is left to hear about it, the job is dropped from the queue or stopped after its pass
+                    self.__cancelled[job_id] = True
+
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                except json.JSONDecodeError as e:
+                    await send({"event": "error", "id": None, "message": "Not JSON: " + str(e)})
+                    continue
+                if not isinstance(request, dict):
+                    await send({"event": "error", "id": None, "message": "A request is a JSON object"})
+                    continue
+                op = request.get("op", "render")
+                if op == "render":
+                    if not isinstance(request.get("job"), dict):
+                        await send({"event": "error", "id": None, "message": "A render request needs a job object"})
+                        continue
+                    requests.append(asyncio.create_task(render(request["job"])))
+                elif op == "cancel":
+                    if not isinstance(request.get("id"), (str, int)):
+                        await send({"event": "error", "id": None, "message": "A cancel request needs a job id"})
+                        continue
+                    job_id = str(request["id"])
+                    if job_id not in self.__listeners:
+                        # remembering it would cancel the next job to come in with this id
+                        await send({"event": "error", "id": job_id,
+                                    "message": "No job with this id is queued or running"})
+                        continue
+                    self.__cancelled[job_id] = True
+                    await send({"event": "cancelling", "id": job_id})
+                elif op == "status":
+                    await send({"event": "status", "id": None, "waiting": self.__queue.qsize(),
+                                "running": sorted(self.running), "workers": self.workers})
+                else:
+                    await send({"event": "error", "id": None, "message": "Unknown op " + str(op)})
+            await asyncio.gather(*requests)
+        except (ConnectionError, asyncio.CancelledError):
+            for request in requests:
+                request.cancel()
+        finally:
+            self.__connections.discard(connection)
+            writer.close()
+
+
+async def submit(job: dict, host: str = "127.0.0.1", port: int = 8765):
+    """
+    Sends one job to a RenderServer and yields its events as they come, the last one is done, error or cancelled
+    :param job: See run_job
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write((json.dumps({"op": "render", "job": job}) + "\n").encode())
+        await writer.drain()
+        while line := await reader.readline():
+            event = json.loads(line)
+            yield event
+            if event["event"] in FINAL_EVENTS:
+                return
+    finally:
+        writer.close()
+
+
+def render_remote(job: dict, host: str = "127.0.0.1", port: int = 8765) -> dict:
+    # blocks until the job is finished, returns its final event, decode_image gets the image out of a done event
+    async def last_event():
+        event = None
+        async for event in submit(job, host, port):
+            pass
+        return event
+    return asyncio.run(last_event())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves renders to local clients from a pool of warm workers")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    server = RenderServer(args.host, args.port, args.workers)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
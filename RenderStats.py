@@ -0,0 +1,89 @@
+import json
+from time import perf_counter
+
+"""
+    Opt-in counters and timers for a render
+    Attach one to a scene (Scene.render(..., stats=RenderStats()) or scene.stats = ...) and the renderers fill it in.
+    Every renderer checks for it once per ray or batch, so it costs next to nothing when it isn't there
+"""
+
+# the kinds CompiledScene packs objects as, indexed by its SPHERE, PLANE and OTHER
+PRIMITIVE_NAMES = ("sphere", "plane", "other")
+# where the time goes, shading is whatever is left over once the others are taken out of the total
+STAGES = ("primary", "traversal", "shading", "framebuffer", "denoise")
+
+
+class RenderStats:
+    n_bounces: int = 0
+    rays_per_depth: list[int] = []
+    intersection_tests: list[int] = []
+    hits: int = 0
+    misses: int = 0
+    specular: int = 0
+    diffuse: int = 0
+    timings: dict[str, float] = dict()
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self, n_bounces: int = 0):
+        """
+        Zeroes every counter and timer
+        :param n_bounces: Bounces the render allows, ray depth is counted from the camera
+        """
+        self.n_bounces = int(n_bounces)
+        self.rays_per_depth = [0] * (self.n_bounces + 1)
+        self.intersection_tests = [0] * len(PRIMITIVE_NAMES)
+        self.hits = 0
+        self.misses = 0
+        self.specular = 0
+        self.diffuse = 0
+        self.timings = {stage: 0.0 for stage in STAGES + ("total",)}
+
+    def add_rays(self, depth: int, n: int = 1):
+        # n rays spawned at this depth, 0 being the camera rays
+        depth = max(int(depth), 0)
+        while depth >= len(self.rays_per_depth):
+            self.rays_per_depth.append(0)
+        self.rays_per_depth[depth] += int(n)
+
+    def add_time(self, stage: str, start: float):
+        # adds the time since start, a perf_counter() reading, to a stage
+        self.timings[stage] += perf_counter() - start
+
+    def merge(self, other: "RenderStats"):
+        # adds in the counts and times of another collector, e.g. one that came back from a worker process
+        for depth, n in enumerate(other.rays_per_depth):
+            self.add_rays(depth, n)
+        self.intersection_tests = [a + b for a, b in zip(self.intersection_tests, other.intersection_tests)]
+        self.hits += other.hits
+        self.misses += other.misses
+        self.specular += other.specular
+        self.diffuse += other.diffuse
+        for stage, t in other.timings.items():
+            self.timings[stage] += t
+
+    def to_dict(self) -> dict:
+        timings = dict(self.timings)
+        measured = sum(timings[stage] for stage in STAGES if stage != "shading")
+        timings["shading"] = max(timings["total"] - measured, 0.0)
+        return {"n_bounces": self.n_bounces,
+                "rays_per_depth": list(self.rays_per_depth),
+                "total_rays": sum(self.rays_per_depth),
+                "intersection_tests": dict(zip(PRIMITIVE_NAMES, self.intersection_tests)),
+                "hits": self.hits,
+                "misses": self.misses,
+                "specular": self.specular,
+                "diffuse": self.diffuse,
+                "timings": timings}
+
+    def to_json(self, path: str = None) -> str:
+        """
+        :param path: Also write it to this file if given
+        :return: The stats as a JSON string
+        """
+        text = json.dumps(self.to_dict(), indent=2)
+        if path is not None:
+            with open(path, "w") as f:
+                f.write(text)
+        return text
@@ -0,0 +1,343 @@
+import numpy as np
+from math import cos, pi, sin, sqrt
+
+"""
+    Counter-based random numbers, drawn in bulk and keyed by what they are for instead of by call order
+    Every draw is a function of the counter (pixel, sample, bounce, stream) and the seed,
+    so any pixel, sample or bounce can be reproduced on its own, no matter which process renders it,
+    what order the tiles come in, or how the rays were batched
+    Attach one as scene.sampler and every render mode draws from it instead of the global random state,
+    and jitters its camera rays inside their pixels
+
+    Sampler is plain random numbers (Philox4x32-10). The others spread the samples of a pixel out more evenly:
+    StratifiedSampler puts them in shuffled cells of a grid, HaltonSampler uses the Halton sequence,
+    and SobolSampler an Owen scrambled Sobol sequence, which converges the fastest
+    Every counter gives four numbers, and the math below works the same on python ints and uint64 arrays,
+    so a single ray and a whole batch get the same numbers
+"""
+
+# Philox4x32 round multipliers and key schedule (Weyl) constants, from Random123
+PHILOX_M0 = 0xD2511F53
+PHILOX_M1 = 0xCD9E8D57
+PHILOX_W0 = 0x9E3779B9
+PHILOX_W1 = 0xBB67AE85
+PHILOX_ROUNDS = 10
+MASK32 = 0xFFFFFFFF
+# uint32 to [0, 1)
+TO_UNIT = 2.0**-32
+# the key is xor'd with this for the numbers that scramble a sequence, so they don't repeat the plain ones
+SCRAMBLE_KEY = 0x5BD1E995
+
+# Sobol direction numbers of the first four dimensions, from the Joe and Kuo primitive polynomials
+# (degree, polynomial coefficients, initial m values)
+SOBOL_POLYNOMIALS = ((1, 0, (1, )), (2, 1, (1, 3)), (3, 1, (1, 3, 1)))
+# Halton bases, four to each (bounce, stream)
+PRIMES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53,
+          59, 61, 67, 71, 73, 79, 83, 89, 97, 101, 103, 107, 109, 113, 127, 131)
+
+
+def philox_words(c0, c1, c2, c3, k0: int, k1: int) -> tuple:
+    """
+    Philox4x32-10 of the counter (c0, c1, c2, c3) under the key (k0, k1)
+    :param c0: Python ints or uint64 arrays, only the low 32 bits are used
+    :return: Four random 32 bit words, ints or uint64 arrays like the counter
+    """
+    c0, c1, c2, c3 = c0 & MASK32, c1 & MASK32, c2 & MASK32, c3 & MASK32
+    k0, k1 = int(k0) & MASK32, int(k1) & MASK32
+    for r in range(PHILOX_ROUNDS):
+        # both products fit in 64 bits, the high half is the part that gets mixed back in
+        p0 = c0 * PHILOX_M0
+        p1 = c2 * PHILOX_M1
+        c0, c1, c2, c3 = (p1 >> 32) ^ c1 ^ k0, p1 & MASK32, (p0 >> 32) ^ c3 ^ k1, p0 & MASK32
+        k0 = (k0 + PHILOX_W0) & MASK32
+        k1 = (k1 + PHILOX_W1) & MASK32
+    return c0, c1, c2, c3
+
+
+def philox(counters: np.ndarray, key: tuple) -> np.ndarray:
+    """
+    Philox4x32-10 of a batch of counters, every row is hashed on its own
+    :param counters: [N, 4] unsigned integers, only the low 32 bits of each are used
+    :param key: Two 32 bit words
+    :return: [N, 4] uint32 random words
+    """
+    c = np.asarray(counters, dtype=np.uint64)
+    return np.stack(philox_words(c[:, 0], c[:, 1], c[:, 2], c[:, 3], *key), axis=1).astype(np.uint32)
+
+
+def reverse_bits(x):
+    # reverses the low 32 bits
+    x = ((x >> 1) & 0x55555555) | ((x & 0x55555555) << 1)
+    x = ((x >> 2) & 0x33333333) | ((x & 0x33333333) << 2)
+    x = ((x >> 4) & 0x0F0F0F0F) | ((x & 0x0F0F0F0F) << 4)
+    x = ((x >> 8) & 0x00FF00FF) | ((x & 0x00FF00FF) << 8)
+    return ((x >> 16) & 0xFFFF) | ((x & 0xFFFF) << 16)
+
+
+def owen_scramble(x, seed):
+    """
+    Nested uniform (Owen) scrambling of 32 bit fractions, the hash based version from Burley 2020,
+    "Practical Hash-based Owen Scrambling". Every bit is flipped depending only on the bits above it,
+    so points that were spread evenly over the power of two intervals stay that way
+    """
+    x = reverse_bits(x)
+    # Laine-Karras style hash, each step only carries bits upward
+    x = (x + seed) & MASK32
+    x ^= (x * 0x6C50B47C) & MASK32
+    x ^= (x * 0xB82F1E52) & MASK32
+    x ^= (x * 0xC7AFE638) & MASK32
+    x ^= (x * 0x8D22F6E6) & MASK32
+    return reverse_bits(x)
+
+
+def sobol_matrices() -> list[list[int]]:
+    # the 32 direction numbers of each of the first four Sobol dimensions, the first is van der Corput
+    matrices = [[1 << (31 - b) for b in range(32)]]
+    for degree, coefficients, m_init in SOBOL_POLYNOMIALS:
+        m = list(m_init)
+        for b in range(degree, 32):
+            value = m[b - degree] ^ (m[b - degree] << degree)
+            for k in range(1, degree):
+                if (coefficients >> (degree - 1 - k)) & 1:
+                    value ^= m[b - k] << k
+            m.append(value)
+        matrices.append([m[b] << (31 - b) for b in range(32)])
+    return matrices
+
+
+def sobol_tables(matrices: list[list[int]]) -> list[list[list[int]]]:
+    # every dimension's matrix times each possible byte of the index, so a point takes 4 lookups per dimension
+    tables = []
+    for matrix in matrices:
+        dim_tables = []
+        for byte in range(4):
+            table = [0] * 256
+            for value in range(1, 256):
+                low = value & -value
+                table[value] = table[value ^ low] ^ matrix[8 * byte + low.bit_length() - 1]
+            dim_tables.append(table)
+        tables.append(dim_tables)
+    return tables
+
+
+SOBOL_TABLES = sobol_tables(sobol_matrices())
+SOBOL_ARRAYS = np.array(SOBOL_TABLES, dtype=np.uint64)
+
+
+def sobol_words(index) -> tuple:
+    # the index-th point of the first four Sobol dimensions, as 32 bit fractions
+    tables = SOBOL_ARRAYS if isinstance(index, np.ndarray) else SOBOL_TABLES
+    index_bytes = [(index >> (8 * byte)) & 255 for byte in range(4)]
+    return tuple(t[0][index_bytes[0]] ^ t[1][index_bytes[1]] ^ t[2][index_bytes[2]] ^ t[3][index_bytes[3]]
+                 for t in tables)
+
+
+def scrambled_radical_inverse(index, base, seed):
+    """
+    index written in a prime base and mirrored around the radix point, to about float64 precision.
+    Each digit goes through a random affine map d -> (a * d + c) % base, with a and c hashed from the seed and the
+    digits before it, a nested linear scramble like Matousek's. The points keep their spread, but the few samples
+    a pixel gets no longer bunch up in one corner of the large bases
+    """
+    result = index * 0.0
+    scale = 1.0/base
+    prefix = seed
+    n_digits = min(32, int(np.ceil(53/np.log2(np.min(base)))))
+    for digit in range(n_digits):
+        # multiplicative hashing, the high bits of the product are the well mixed ones
+        prefix = (prefix * 0x9E3779B1 + 0x7F4A7C15) & MASK32
+        # a is never 0, so every map is one to one for a prime base
+        d = ((index % base) * (1 + (prefix >> 20) % (base - 1)) + (prefix >> 8) % base) % base
+        result = result + d * scale
+        prefix = prefix ^ d
+        index = index // base
+        scale = scale/base
+    return result
+
+
+def permute(x, bits: int, seed):
+    # a bijection of the integers below 2**bits picked by seed, xor, odd multiply and xorshift are all invertible
+    mask = (1 << bits) - 1
+    shift = max(bits // 2, 1)
+    x = (x ^ seed) & mask
+    for r in range(3):
+        x = (x * ((seed >> (8 * r)) | 1)) & mask
+        x ^= x >> shift
+    return x
+
+
+class Sampler:
+    seed: int = 0
+    key: tuple = (0, 0)
+    jitter: bool = True
+
+    # streams the renderers draw from, each counter gives four numbers
+    # the path tracer takes both of its light sample numbers from LIGHT, the camera jitters its rays with PIXEL,
+    # and the recursive mode gives every branch of the tree its own pair of streams from PATH on
+    DECISIONS = 0
+    DIRECTION = 1
+    LIGHT = 2
+    PIXEL = 3
+    PATH = 4
+
+    def __init__(self, seed: int = 0, jitter: bool = True):
+        """
+        :param seed: Picks the key, two renders with the same seed draw the same numbers for every pixel
+        :param jitter: Spread each pixel's camera rays over the pixel instead of all going through its middle
+        """
+        self.seed = int(seed)
+        self.key = (self.seed & MASK32, (self.seed >> 32) & MASK32)
+        self.jitter = bool(jitter)
+
+    def __repr__(self):
+        return f"{type(self).__name__}(seed={self.seed})"
+
+    def random_words(self, pixel, sample, bounce, stream) -> tuple:
+        # the plain random words of a counter
+        return philox_words(pixel, sample, bounce, stream, *self.key)
+
+    def scramble_words(self, pixel, bounce, stream, word: int = 0) -> tuple:
+        # random words that stay the same over every sample of a pixel, for shuffling and scrambling its sequence
+        return philox_words(pixel, word, bounce, stream, self.key[0] ^ SCRAMBLE_KEY, self.key[1])
+
+    def point(self, pixel, sample, bounce, stream) -> tuple:
+        """
+        The four numbers of one counter, every sampler overrides this
+        :param pixel: Flat pixel index (j * x_res + i)
+        :param sample: Which sample of the pixel, every path through a pixel has its own
+        :param bounce: Depth along the path
+        :param stream: Which draw at that bounce, so one bounce can take as many numbers as it needs
+        :return: Four numbers in [0, 1), python floats for int arguments, arrays for uint64 arrays
+        """
+        return tuple(w * TO_UNIT for w in self.random_words(pixel, sample, bounce, stream))
+
+    def uniform(self, pixels, samples, bounce, stream=0) -> np.ndarray:
+        # [N, 4] numbers in [0, 1) for a batch of counters, every argument is broadcast against the others
+        counters = np.broadcast_arrays(*[np.asarray(a, dtype=np.uint64).reshape(-1)
+                                         for a in (pixels, samples, bounce, stream)])
+        if counters[0].size == 0:
+            return np.zeros([0, 4])
+        return np.stack(self.point(*counters), axis=1)
+
+    def uniform_one(self, pixel: int, sample: int, bounce: int, stream: int = 0) -> tuple:
+        # the four numbers of one counter, as python floats, for tracing one ray at a time
+        return self.point(int(pixel), int(sample), int(bounce), int(stream))
+
+    def sphere(self, pixels, samples, bounce, stream=DIRECTION) -> np.ndarray:
+        """
+        [N, 3] points spread evenly over the unit sphere from the first two numbers of each counter.
+        The mapping keeps areas, so samples spread evenly over the square stay spread over the sphere.
+        Any direction only draw works in place of a standard normal one, see ray_in_hemisphere and Kernels.bounce
+        """
+        u = self.uniform(pixels, samples, bounce, stream)
+        z = 1 - 2 * u[:, 0]
+        r = np.sqrt(np.maximum(1 - z * z, 0))
+        phi = 2 * np.pi * u[:, 1]
+        return np.stack([r * np.cos(phi), r * np.sin(phi), z], axis=1)
+
+    def sphere_one(self, pixel: int, sample: int, bounce: int, stream: int = DIRECTION) -> np.ndarray:
+        # [3, ] point on the unit sphere of one counter, see sphere
+        u = self.uniform_one(pixel, sample, bounce, stream)
+        z = 1 - 2 * u[0]
+        r = sqrt(max(1 - z * z, 0.0))
+        phi = 2 * pi * u[1]
+        return np.array([r * cos(phi), r * sin(phi), z])
+
+    def pixel_offsets(self, pixels, samples) -> np.ndarray:
+        # [N, 2] where each camera ray goes through its pixel, in pixels from the middle, all zero without jitter
+        if not self.jitter:
+            return np.zeros([np.broadcast(np.asarray(pixels), np.asarray(samples)).size, 2])
+        return self.uniform(pixels, samples, 0, self.PIXEL)[:, :2] - .5
+
+    def pixel_offset_one(self, pixel: int, sample: int) -> tuple:
+        # the offset of one camera ray, see pixel_offsets, None (the middle) without jitter
+        if not self.jitter:
+            return None
+        u = self.uniform_one(pixel, sample, 0, self.PIXEL)
+        return u[0] - .5, u[1] - .5
+
+
+class StratifiedSampler(Sampler):
+    grid: int = 4
+
+    def __init__(self, seed: int = 0, jitter: bool = True, grid: int = 4):
+        """
+        Every grid * grid samples of a pixel land one in each cell of a grid, in a shuffled order
+        and at a random spot inside the cell. Best when the pixel gets a multiple of grid * grid samples
+        :param grid: Cells along each side, a power of two
+        """
+        super().__init__(seed, jitter)
+        if grid < 1 or grid & (grid - 1):
+            raise ValueError("StratifiedSampler: grid has to be a power of two, found ", grid)
+        self.grid = int(grid)
+
+    def __repr__(self):
+        return f"{type(self).__name__}(seed={self.seed}, grid={self.grid})"
+
+    def point(self, pixel, sample, bounce, stream) -> tuple:
+        side_bits = self.grid.bit_length() - 1
+        bits = 2 * side_bits
+        # each round of grid * grid samples is shuffled on its own, both pairs of numbers with a different order
+        cell, rounds = sample & ((1 << bits) - 1), sample >> bits
+        shuffle = philox_words(pixel, rounds, bounce, stream, self.key[0] ^ SCRAMBLE_KEY, self.key[1])
+        jitter = self.random_words(pixel, sample, bounce, stream)
+        out = []
+        for pair in range(2):
+            c = permute(cell, bits, shuffle[pair])
+            x, y = c & ((1 << side_bits) - 1), c >> side_bits
+            out.append((x + jitter[2 * pair] * TO_UNIT)/self.grid)
+            out.append((y + jitter[2 * pair + 1] * TO_UNIT)/self.grid)
+        return tuple(out)
+
+
+class HaltonSampler(Sampler):
+
+    def point(self, pixel, sample, bounce, stream) -> tuple:
+        """
+        Scrambled Halton points, the k-th sample of a pixel is the k-th point of the sequence.
+        Each (bounce, stream) takes the next four primes, the camera jitter the smallest. Two streams can't share
+        bases, the same sequence scrambled twice lines up with itself, so once PRIMES runs out
+        (the deeper bounces, and the recursive mode's branches) the numbers are plain random ones.
+        Every pixel scrambles its digits with its own seeds, see scrambled_radical_inverse
+        """
+        dims = (bounce * self.PATH + (stream + 1) % self.PATH) * 4
+        dims = dims + (stream >= self.PATH) * len(PRIMES)
+        seeds = self.scramble_words(pixel, bounce, stream)
+        random = super().point(pixel, sample, bounce, stream)
+        if not isinstance(dims, np.ndarray):
+            if dims >= len(PRIMES):
+                return random
+            return tuple(scrambled_radical_inverse(sample, PRIMES[dims + j], seeds[j]) for j in range(4))
+        # python ints for a single ray above, mixing them with numpy scalars would turn the digits into floats
+        halton = dims < len(PRIMES)
+        dims = np.where(halton, dims, 0).astype(np.int64)
+        bases = np.asarray(PRIMES, dtype=np.uint64)
+        return tuple(np.where(halton, scrambled_radical_inverse(sample, bases[dims + j], seeds[j]), random[j])
+                     for j in range(4))
+
+
+class SobolSampler(Sampler):
+
+    def point(self, pixel, sample, bounce, stream) -> tuple:
+        """
+        Owen scrambled Sobol points, the 4D padding of Burley 2020. Every (pixel, bounce, stream) shuffles
+        the order of the sequence and scrambles each of the four dimensions with its own seeds,
+        so different bounces aren't correlated, while the first 2**k samples of a pixel stay evenly spread
+        """
+        seeds = self.scramble_words(pixel, bounce, stream)
+        index = owen_scramble(sample, seeds[0])
+        words = sobol_words(index)
+        # a fifth seed for the last dimension, the first four words already went to the shuffle and three others
+        last = self.scramble_words(pixel, bounce, stream, 1)[0]
+        return tuple(owen_scramble(w, s) * TO_UNIT for w, s in zip(words, seeds[1:] + (last, )))
+
+
+def get_sampler(name: str = "random", seed: int = 0, jitter: bool = True) -> Sampler:
+    """
+    :param name: "random", "stratified", "halton" or "sobol"
+    :return: The sampler, to attach as scene.sampler
+    """
+    samplers = {"random": Sampler, "stratified": StratifiedSampler, "halton": HaltonSampler, "sobol": SobolSampler}
+    if name not in samplers:
+        raise ValueError("Sampler: Unknown sampler ", name)
+    return samplers[name](seed, jitter)
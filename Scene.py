@@ -1,9 +1,22 @@
 import numpy as np
 import RayTracingObjects as rto
 from Camera import Camera
-from RayTraceInfo import HitInfo, MaterialInfo, RayColorInfo
+from BVH import BVH, box_entry
+from CompiledScene import CompiledScene, load_compiled
+from RayTraceInfo import HitInfo, MaterialInfo, RayColorInfo, MISS
 from Ray import Ray, ray_in_hemisphere, specular_ray
+from Wavefront import WavefrontRenderer
+from TiledRender import TiledRenderer
+from AdaptiveSampler import AdaptiveSampler
+from PathTracer import PathTracer
+from RenderStats import RenderStats
+from Sampler import Sampler
+from GBuffer import GBuffer, capture
+from Denoise import atrous
+from PathRecords import PathRecords
+from Relight import camera_fingerprint, sampler_fingerprint
 from random import random
+from time import perf_counter
 
 """
     Holds all the objects for the scene
@@ -14,14 +27,31 @@ class Scene:
     objects: list[rto.RTOType] = []
     cam: Camera = None
     ambient_color: np.ndarray = np.zeros([3, ])
+    emitters: list[rto.RTOType] = []
+    compiled: CompiledScene = None
+    bvh_objects: list[rto.RTOType] = []
+    unbounded_objects: list[rto.RTOType] = []
+    rays_traced: int = 0
+    stats: RenderStats = None
+    sampler: Sampler = None
+    gbuffer: GBuffer = None
+    path_records: PathRecords = None
+    # pixels edits have made stale since the last render_incremental, None until it has run
+    dirty: np.ndarray = None
+    __incremental_key: tuple = None
+    dtype: np.dtype = np.dtype(np.float64)
 
     def __init__(self, camera: Camera, *obj: rto.RTOType, color=np.zeros([3, ])):
+        self.objects = []
+        self.emitters = []
         self.color_channels = int(camera.num_channels)
         self.ambient_color = np.array(color).reshape([self.color_channels, ])
         if isinstance(camera, Camera):
             self.cam = camera
         else:
             raise TypeError("Scene initialization: Was expecting Camera, found ", type(camera))
+        # the scene renders in whatever precision its camera was made with
+        self.dtype = self.cam.dtype
         self.add_obj(obj)
 
     def __iter__(self):
@@ -29,41 +59,483 @@ class Scene:
             yield o
 
     def add_obj(self, obj=...):
+        if self.compiled is not None and len(self.compiled) != len(self.objects):
+            # the loaded geometry only exists packed, there are no objects to add to
+            raise ValueError("Scene add_obj: Objects can't be added to a scene loaded from a file, found ", obj)
         for o in obj:
             if isinstance(o, rto.RTOType):
                 self.objects.append(o)
+                # light sources are kept in their own list for the path tracer to aim at
+                if o.get_color_info().emits_light:
+                    self.emitters.append(o)
             else:
                 raise TypeError("Scene appending: Was expecting RayTracingObject, found ", type(o))
+            self.mark_dirty(self.pixels_seeing(o))
+        # the packed scene no longer covers every object, it gets rebuilt the next time it is needed
+        self.compiled = None
 
-    def render(self, n_bounces: int = 1, n_incident_rays: int = 1, n_rays: int = 1) -> np.ndarray:
-        for i, j in self.cam:
-            # for each pixel
-            pix_color = np.zeros([self.color_channels, ])
-            for r in range(n_rays):
-                # get the color each ray that we are shooting out finds
-                pix_color += self.get_color(self.cam.ray_through_pixel(i, j, n_bounces),
-                                            n_incident_rays=n_incident_rays,
-                                            n_channels=self.color_channels).ray_color
-            # average them and set the color
-            self.cam.set_color(i, j, pix_color/n_rays)
-        return self.cam.get_image()
+    def remove_obj(self, obj):
+        """
+        Takes an object out of the scene, the pixels its paths touched are marked dirty
+        :param obj: The RTOType, or its index in self.objects
+        """
+        if self.compiled is not None and len(self.compiled) != len(self.objects):
+            raise ValueError("Scene remove_obj: Objects can't be removed from a scene loaded from a file, found ", obj)
+        k, obj = self.__find(obj, "remove_obj")
+        touched = self.__touching(k)
+        del self.objects[k]
+        self.emitters = [o for o in self.emitters if o is not obj]
+        if self.path_records is not None:
+            self.path_records.remove_object(k)
+        self.compiled = None
+        self.mark_dirty(touched)
+
+    def move_object(self, obj, offset):
+        """
+        Moves a sphere, plane or mesh instance, marking dirty the pixels its paths touched
+        and the pixels whose camera rays pass through where it is now
+        :param obj: The RTOType, or its index in self.objects
+        :param offset: [3, ] how far to move it
+        """
+        k, obj = self.__find(obj, "move_object")
+        offset = np.array(offset, dtype=float).reshape([3, ])
+        if isinstance(obj, rto.Sphere):
+            obj.center = obj.center + offset
+        elif isinstance(obj, rto.Plane):
+            obj.p = obj.p + offset
+        elif isinstance(obj, rto.Instance):
+            obj.move(offset)
+        else:
+            raise TypeError("Scene move_object: Can only move spheres, planes and instances, found ", type(obj))
+        self.refit_bvh()
+        self.mark_dirty(self.__touching(k))
+        self.mark_dirty(self.pixels_seeing(obj))
+
+    def recolor_object(self, obj, color=None, specular_probability: float = None, emitted_strength: float = None,
+                       emitted_color=None):
+        """
+        Changes an object's material, marking dirty the pixels whose paths touched it.
+        Objects sharing the MaterialInfo change with it, so their pixels are marked too
+        :param obj: The RTOType, or its index in self.objects
+        :param color: New material color, kept if not given
+        :param specular_probability: New chance of a specular bounce, kept if not given
+        :param emitted_strength: New emitted light strength, kept if not given. Above 0 the object is a light source,
+                                 0 turns it off
+        :param emitted_color: New emitted light color, kept if not given
+        """
+        k, obj = self.__find(obj, "recolor_object")
+        info = obj.get_color_info()
+        if color is not None:
+            info.material_color = np.array(color).reshape([info.channels, ])
+        if specular_probability is not None:
+            info.specular_probability = float(specular_probability)
+        if emitted_color is not None:
+            info.emitted_color = np.array(emitted_color).reshape([3, ])
+        if emitted_strength is not None:
+            info.emitted_strength = emitted_strength
+            info.emits_light = bool(np.any(np.asarray(emitted_strength) > 0))
+            # the path tracer aims at the emitters, they have to follow the edit
+            self.emitters = [o for o in self.objects if o.get_color_info().emits_light]
+        self.mark_dirty(self.__touching([j for j, o in enumerate(self.objects) if o.get_color_info() is info]))
+
+    def __find(self, obj, caller: str) -> tuple[int, rto.RTOType]:
+        # the index and the object, from either one
+        if isinstance(obj, (int, np.integer)):
+            if not 0 <= obj < len(self.objects):
+                raise ValueError("Scene " + caller + ": No object with index ", obj)
+            return int(obj), self.objects[obj]
+        for k, o in enumerate(self.objects):
+            if o is obj:
+                return k, o
+        raise ValueError("Scene " + caller + ": The object isn't in the scene ", obj)
+
+    def __touching(self, objects) -> np.ndarray:
+        # pixels whose recorded paths hit any of these object ids
+        if self.path_records is None:
+            return np.zeros(0, dtype=np.int64)
+        return self.path_records.pixels_touching(objects)
+
+    def mark_dirty(self, pixels):
+        # pixels for the next render_incremental to trace again, nothing to do before the first one
+        if self.dirty is not None:
+            self.dirty[pixels] = True
+
+    def pixels_seeing(self, obj: rto.RTOType) -> np.ndarray:
+        """
+        Pixels whose camera ray passes through the object's bounding box, grown by a pixel all around
+        since jittered rays can land anywhere in their pixel
+        :return: Flat pixel indices, every pixel for an object without bounds
+        """
+        cam = self.cam
+        if self.dirty is None:
+            return np.zeros(0, dtype=np.int64)
+        bounds = obj.bounds()
+        if bounds is None:
+            return np.arange(cam.x_res * cam.y_res)
+        origins, directions = cam.primary_rays()
+        with np.errstate(divide='ignore'):
+            inv_dirs = 1/directions.astype(float)
+        seen = (box_entry(np.asarray(bounds[0], dtype=float), np.asarray(bounds[1], dtype=float),
+                          origins.astype(float), inv_dirs) < np.inf).reshape([cam.y_res, cam.x_res])
+        grown = seen.copy()
+        grown[1:] |= seen[:-1]
+        grown[:-1] |= seen[1:]
+        seen = grown.copy()
+        grown[:, 1:] |= seen[:, :-1]
+        grown[:, :-1] |= seen[:, 1:]
+        return np.flatnonzero(grown)
+
+    def compile(self) -> CompiledScene:
+        """
+        The packed, read-only form of the scene used by the batched renderers and worker processes.
+        Geometry and the BVH are built once after the scene changes, materials and the ambient color are packed
+        again every call so edits to a MaterialInfo or to ambient_color show up in the next render
+        :return: The CompiledScene, whose object k is self.objects[k]
+        """
+        if self.compiled is None:
+            self.compiled = CompiledScene(self.objects, self.ambient_color, self.color_channels, self.dtype)
+            # the same split as plain lists of objects, for single rays
+            self.bvh_objects = [self.objects[k] for k in self.compiled.bvh_object]
+            self.unbounded_objects = [self.objects[k] for k in self.compiled.unbounded]
+        elif len(self.objects) == len(self.compiled):
+            self.compiled.pack_materials(self.objects)
+            self.compiled.set_ambient(self.ambient_color)
+        return self.compiled
+
+    def set_precision(self, dtype):
+        """
+        Float type the batched renderers work in, np.float32 or np.float64.
+        float32 halves the memory every ray buffer and packed array takes, at the cost of a coarser intersection
+        epsilon. The recursive and path modes trace python floats, which are always float64
+        :param dtype: The new float type, the scene is compiled again in it the next time it is needed
+        """
+        dtype = np.dtype(dtype)
+        if dtype not in (np.float32, np.float64):
+            raise ValueError("Scene set_precision: Only float32 and float64 are supported, found ", dtype)
+        if self.compiled is not None and len(self.compiled) != len(self.objects) and dtype != self.compiled.dtype:
+            raise ValueError("Scene set_precision: A scene loaded from a file keeps the precision it was saved in ",
+                             self.compiled.dtype)
+        self.dtype = dtype
+        self.cam.set_precision(dtype)
+        if self.compiled is not None and self.compiled.dtype != dtype:
+            self.compiled = None
 
-    def get_color(self, ray: Ray, n_incident_rays: int = 1, n_channels: int = 3) -> RayColorInfo:
-        best_hit: HitInfo = HitInfo()
-        for o in self:
-            # try to find a hit
+    def save(self, path: str):
+        # writes the compiled scene to a directory, load_scene opens it again
+        self.compile().save(path)
+
+    def get_bvh(self) -> BVH:
+        """
+        The BVH over every bounded object in the scene, see CompiledScene.
+        Objects without bounds (planes) are tested against every ray instead
+        :return: The BVH, whose primitive k is self.objects[self.compile().bvh_object[k]]. None if nothing is bounded
+        """
+        if self.compiled is None:
+            self.compile()
+        return self.compiled.bvh
+
+    def refit_bvh(self):
+        # call after moving objects in place, cheaper than a rebuild but keeps the old tree shape
+        if self.compiled is not None:
+            self.compiled.refit(self.objects)
+
+    def closest_hit(self, ray: Ray, tests: list = None) -> HitInfo:
+        """
+        The closest hit in front of the ray, a miss if there is none
+        :param tests: If given, ray-object tests are added up here by kind (SPHERE, PLANE, OTHER),
+                      the scene's stats are used when it has them
+        """
+        self.rays_traced += 1
+        stats = self.stats
+        if stats is not None:
+            start = perf_counter()
+            if tests is None:
+                tests = stats.intersection_tests
+        bvh = self.get_bvh()
+        kind = self.compiled.object_kind
+        best_hit: HitInfo = MISS
+        for k, o in zip(self.compiled.unbounded, self.unbounded_objects):
+            if tests is not None:
+                tests[kind[k]] += 1
             current_hit: HitInfo = o.intersect(ray)
-            if not current_hit.did_hit:
-                continue
-            # if it is better than our current hit, take note of it
-            elif 0 < current_hit.t_hit < best_hit.t_hit:
+            if current_hit.did_hit and 0 < current_hit.t_hit < best_hit.t_hit:
                 best_hit = current_hit
+        if bvh is not None:
+            bvh_object, bvh_objects = self.compiled.bvh_object, self.bvh_objects
+            if tests is None:
+                def intersect(prim: int) -> HitInfo:
+                    return bvh_objects[prim].intersect(ray)
+            else:
+                def intersect(prim: int) -> HitInfo:
+                    tests[kind[bvh_object[prim]]] += 1
+                    return bvh_objects[prim].intersect(ray)
+            best_hit = bvh.closest_hit(ray.o, ray.dir, intersect, best_hit)
+        if stats is not None:
+            if best_hit.did_hit:
+                stats.hits += 1
+            else:
+                stats.misses += 1
+            stats.add_time("traversal", start)
+        return best_hit
+
+    def check_mode(self, mode: str, caller: str):
+        # a scene loaded from a file has no python objects, the modes that trace them can't render it
+        loaded = self.compiled is not None and len(self.compiled) != len(self.objects)
+        if loaded and mode not in ("wavefront", "preview"):
+            raise ValueError("Scene " + caller + ": A scene loaded from a file only has the wavefront and preview "
+                             "modes, ", mode)
+
+    def closest_hit_batch(self, origins: np.ndarray, directions: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Closest hit for a whole batch of rays
+        :param origins: [N, 3] ray origins
+        :param directions: [N, 3] unit ray directions
+        :return: [N, ] nearest t (np.inf for a miss), [N, ] index into self.objects (-1 for a miss)
+        """
+        if self.compiled is None:
+            self.compile()
+        return self.compiled.closest_hit_batch(origins, directions)
+
+    def render(self, n_bounces: int = 1, n_incident_rays: int = 1, n_rays: int = 1,
+               mode: str = "recursive", workers: int = None, seed: int = 0, backend: str = "auto",
+               stats: RenderStats = None, denoise: bool = False) -> np.ndarray:
+        """
+        Renders the scene through the camera
+        :param n_bounces: How many times a ray may bounce
+        :param n_incident_rays: Rays gathered at every bounce ("recursive"), or paths per camera ray ("wavefront")
+        :param n_rays: Rays shot through every pixel
+        :param mode: "recursive" traces one Ray at a time through get_color,
+                     "wavefront" traces every ray of a bounce together as numpy arrays,
+                     "path" follows one path per sample without recursing, branching only at the first hit,
+                     "preview" only finds what every camera ray hits first, see Scene.preview
+        :param workers: If given, splits the frame into tiles rendered by this many processes
+        :param seed: Seeds every tile when rendering with workers, the image only depends on it
+        :param backend: Kernels the wavefront mode traces with, "numpy", "numba" or "auto", see Kernels
+        :param stats: Cleared, then filled in with ray counts and timings for this render.
+                      A RenderStats already attached as scene.stats keeps adding up over renders instead
+        :param denoise: Runs the finished image through Scene.denoise, so far fewer rays give a clean image
+        :return: The rendered image as a [y_res, x_res, C] uint8 array
+        """
+        if mode not in ("recursive", "wavefront", "path", "preview"):
+            raise ValueError("Scene render: Unknown render mode ", mode)
+        self.check_mode(mode, "render")
+        attached = self.stats
+        if stats is not None:
+            stats.reset(n_bounces)
+            self.stats = stats
+        stats = self.stats
+        if stats is not None:
+            stats.n_bounces = int(n_bounces)
+        start = perf_counter()
+        try:
+            if mode == "preview":
+                # one batch of camera rays, splitting it over workers would cost more than it saves
+                image = self.preview(backend=backend)
+            elif workers is not None:
+                image = TiledRenderer(self, workers).render(n_bounces, n_incident_rays, n_rays, mode=mode, seed=seed,
+                                                            backend=backend)
+            elif mode == "wavefront":
+                image = WavefrontRenderer(self, backend=backend).render(n_bounces, n_incident_rays, n_rays)
+            elif mode == "path":
+                image = PathTracer(self).render(n_bounces, n_incident_rays, n_rays)
+            else:
+                for i, j in self.cam:
+                    # for each pixel, average the rays and set the color
+                    color = self.render_pixel(i, j, n_bounces, n_incident_rays, n_rays)
+                    write_start = perf_counter() if stats is not None else 0.0
+                    self.cam.set_color(i, j, color)
+                    if stats is not None:
+                        stats.add_time("framebuffer", write_start)
+                write_start = perf_counter()
+                image = self.cam.get_image()
+                if stats is not None:
+                    stats.add_time("framebuffer", write_start)
+            if denoise:
+                image = self.denoise(backend=backend)
+            return image
+        finally:
+            self.stats = attached
+            # the workers time their own tiles
+            if stats is not None and workers is None:
+                stats.add_time("total", start)
+
+    def preview(self, backend: str = "auto") -> np.ndarray:
+        """
+        Casts every camera ray once, as one batch, with no bounces or lighting, for checking a scene's layout.
+        The first hits are kept as scene.gbuffer (depth, normal, object id and albedo AOVs, see GBuffer),
+        and the camera image is set to their flat shading
+        :param backend: Kernels to intersect with, see Kernels
+        :return: The flat shaded image as a [y_res, x_res, C] uint8 array
+        """
+        self.gbuffer = capture(self, backend, self.stats)
+        start = perf_counter()
+        self.cam.image[:] = self.gbuffer.flat_shaded().transpose((1, 0, 2))
+        image = self.cam.get_image()
+        if self.stats is not None:
+            self.stats.add_time("framebuffer", start)
+        return image
+
+    def denoise(self, backend: str = "auto", **filter_args) -> np.ndarray:
+        """
+        Smooths the noise out of the camera's image, keeping the edges between surfaces, see Denoise.atrous.
+        Works on whatever the camera holds, a finished render or the running average of render_pass
+        :param backend: Kernels the G-buffer is intersected with, see Kernels
+        :param filter_args: Passed on to Denoise.atrous, iterations and the sigmas
+        :return: The denoised image as a [y_res, x_res, C] uint8 array, also left in the camera
+        """
+        start = perf_counter()
+        self.gbuffer = capture(self, backend)
+        image = self.cam.image.transpose((1, 0, 2))
+        denoised = atrous(image, self.gbuffer, **filter_args)
+        self.cam.image[:] = denoised.transpose((1, 0, 2))
+        if self.stats is not None:
+            self.stats.add_time("denoise", start)
+        return self.cam.get_image()
+
+    def render_incremental(self, n_bounces: int = 1, n_incident_rays: int = 1, n_rays: int = 1,
+                           backend: str = "auto") -> np.ndarray:
+        """
+        Renders with the wavefront mode, recording which objects every pixel's paths hit. After the first time, only
+        the pixels that move_object, recolor_object, add_obj and remove_obj marked dirty are traced again,
+        the rest of the camera image is kept. Changing the camera, the sampler or the settings renders everything.
+        Edits made any other way aren't seen, and a moved object only dirties the pixels that hit it before or
+        whose camera rays pass it now, so a shadow or reflection it newly casts elsewhere is missed
+        :return: The image as a [y_res, x_res, C] uint8 array
+        """
+        cam = self.cam
+        n_pixels = cam.x_res * cam.y_res
+        key = (camera_fingerprint(cam), sampler_fingerprint(self.sampler), int(n_bounces), int(n_incident_rays),
+               int(n_rays))
+        if self.path_records is None or self.dirty is None or key != self.__incremental_key:
+            self.path_records = PathRecords()
+            pixels = np.arange(n_pixels)
+        else:
+            pixels = np.flatnonzero(self.dirty)
+        self.dirty = np.zeros(n_pixels, dtype=bool)
+        self.__incremental_key = key
+
+        if pixels.size:
+            touched = []
+            colors = WavefrontRenderer(self, backend=backend).render_pixels(pixels, n_bounces, n_incident_rays,
+                                                                            n_rays, touched=touched)
+            self.path_records.forget(pixels)
+            self.path_records.add(touched)
+            cam.image[pixels % cam.x_res, pixels // cam.x_res] = colors
+        return cam.get_image()
+
+    def render_to(self, sink, n_bounces: int = 1, n_incident_rays: int = 1, n_rays: int = 1,
+                  mode: str = "recursive", workers: int = 1, seed: int = 0, backend: str = "auto",
+                  tile_size: int = 32):
+        """
+        Renders tile by tile straight into an ImageSink (a .npy memmap or a streamed PNG, see ImageSink)
+        instead of the camera image, for frames too big to hold in memory.
+        Give the camera keep_image=False so it doesn't allocate a frame it won't use
+        :param sink: Where the image goes, closed once it is done, or aborted if a tile fails
+        :param workers: Processes rendering tiles
+        :param tile_size: Width and height of the tiles, memory grows with this rather than the frame
+        :return: The sink
+        """
+        if mode not in ("recursive", "wavefront", "path"):
+            raise ValueError("Scene render_to: Unknown render mode ", mode)
+        self.check_mode(mode, "render_to")
+        return TiledRenderer(self, workers, tile_size).render_to(sink, n_bounces, n_incident_rays, n_rays, mode=mode,
+                                                                 seed=seed, backend=backend)
+
+    def render_pass(self, n_bounces: int = 1, n_incident_rays: int = 1, mode: str = "wavefront") -> np.ndarray:
+        """
+        Adds one more sample to every pixel of the camera's running average
+        :param mode: "recursive", "wavefront" or "path", see render
+        :return: The current estimate as a [y_res, x_res, C] uint8 array
+        """
+        pixels = np.arange(self.cam.x_res * self.cam.y_res)
+        # every pass is the next camera sample, so a sampler gives it new numbers
+        first = self.cam.sample_count if self.cam.sample_count is not None else np.zeros(pixels.size, dtype=np.int64)
+        self.check_mode(mode, "render_pass")
+        if mode == "wavefront":
+            colors = WavefrontRenderer(self).render_pixels(pixels, n_bounces, n_incident_rays, first_sample=first)
+        elif mode in ("recursive", "path"):
+            tracer = PathTracer(self) if mode == "path" else None
+            colors = np.array([self.render_pixel(p % self.cam.x_res, p // self.cam.x_res, n_bounces, n_incident_rays,
+                                                 mode=mode, first_sample=first[p], tracer=tracer) for p in pixels])
+        else:
+            raise ValueError("Scene render_pass: Unknown render mode ", mode)
+        self.cam.add_samples(pixels, colors)
+        return self.cam.get_image()
+
+    def render_progressive(self, n_bounces: int = 1, n_incident_rays: int = 1, mode: str = "wavefront",
+                           target_noise: float = None, time_budget: float = None, max_passes: int = 1024):
+        """
+        Keeps adding passes to the camera until the image is good enough or time runs out.
+        Yields the estimate after every pass, so previews can be shown while it converges
+
+        :param target_noise: Stop once Camera.noise_level() drops to this
+        :param time_budget: Stop once this many seconds have gone by
+        :param max_passes: Stop after this many passes no matter what
+        :return: Generator of [y_res, x_res, C] uint8 images, one per pass
+        """
+        self.cam.reset_samples()
+        start = perf_counter()
+        for p in range(max_passes):
+            yield self.render_pass(n_bounces, n_incident_rays, mode)
+            if target_noise is not None and self.cam.noise_level() <= target_noise:
+                break
+            if time_budget is not None and perf_counter() - start >= time_budget:
+                break
+
+    def render_adaptive(self, n_bounces: int = 1, n_incident_rays: int = 1, mode: str = "recursive",
+                        min_samples: int = 4, max_samples: int = 64, sample_budget: int = None,
+                        error_threshold: float = 0.01) -> np.ndarray:
+        # renders with more samples where the image is noisy and fewer where it has settled, see AdaptiveSampler
+        sampler = AdaptiveSampler(self, min_samples, max_samples, sample_budget, error_threshold)
+        return sampler.render(n_bounces, n_incident_rays, mode)
+
+    def render_pixel(self, i: int, j: int, n_bounces: int = 1, n_incident_rays: int = 1,
+                     n_rays: int = 1, mode: str = "recursive", first_sample: int = 0,
+                     tracer: PathTracer = None) -> np.ndarray:
+        """
+        The average color of n_rays rays shot through pixel (i, j)
+        :param first_sample: Camera samples the pixel already has, picks which of the sampler's numbers are drawn
+        :param tracer: PathTracer for the "path" mode, made for this pixel if not given.
+                       Pass one in when rendering many pixels, it gathers the emitters and materials when it is made
+        """
+        if mode == "path":
+            tracer = tracer if tracer is not None else PathTracer(self)
+            return tracer.render_pixel(i, j, n_bounces, n_incident_rays, n_rays, first_sample)
+        stats = self.stats
+        pix_color = np.zeros([self.color_channels, ])
+        for r in range(n_rays):
+            start = perf_counter() if stats is not None else 0.0
+            key = (j * self.cam.x_res + i, int(first_sample) + r) if self.sampler is not None else None
+            offset = self.sampler.pixel_offset_one(*key) if key is not None else None
+            ray = self.cam.ray_through_pixel(i, j, n_bounces, offset)
+            if stats is not None:
+                stats.add_time("primary", start)
+            # get the color each ray that we are shooting out finds
+            pix_color += self.get_color(ray, n_incident_rays=n_incident_rays, n_channels=self.color_channels,
+                                        key=key).ray_color
+        return pix_color/n_rays
+
+    def get_color(self, ray: Ray, n_incident_rays: int = 1, n_channels: int = 3, key: tuple = None,
+                  branch: int = 0) -> RayColorInfo:
+        """
+        Color seen along a ray, branching into n_incident_rays rays at its hit
+        :param key: (pixel, sample) the ray belongs to, its random numbers come from the scene's sampler when given
+        :param branch: Which branch of the pixel's ray tree this is, every branch draws its own numbers
+        """
+        stats = self.stats
+        if stats is not None:
+            stats.add_rays(stats.n_bounces - ray.bounces)
+        # try to find the closest hit
+        best_hit: HitInfo = self.closest_hit(ray)
         # if we didn't find a valid bounce, combine the ray color with the ambient color
         if not best_hit.did_hit:
-            return ray.color * RayColorInfo(n_channels, self.ambient_color)
+            color = RayColorInfo(n_channels, self.ambient_color)
+            color *= ray.color
+            return color
 
         # pick up light from light sources, combine it with the current ray color
-        color = ray.color * RayColorInfo(n_channels, best_hit.color_info)
+        color = RayColorInfo(n_channels, best_hit.color_info)
+        color *= ray.color
 
         # if we aren't bouncing anymore, we just return the light source info
         if ray.bounces == 0:
@@ -76,23 +548,56 @@ class Scene:
         incoming_color = np.zeros([self.color_channels, ])      # holds the coloring coming in from the bounce
         spec_prob = best_hit.color_info.specular_probability    # what is the probability the bounce is specular?
         for i in range(n_incident_rays):
-            # specular bounce based on the probability that a given ray on the hit object is a specular bounce
-            if random() < spec_prob:
+            # the bounce count is unique along a path, so (bounce, branch) is unique in the tree
+            child = (branch * n_incident_rays + i) & 0x7FFFFFFF
+            random_normal = None
+            if key is None:
+                # specular bounce based on the probability that a given ray on the hit object is a specular bounce
+                specular = random() < spec_prob
+            else:
+                stream = Sampler.PATH + 2 * child
+                specular = self.sampler.uniform_one(*key, ray.bounces, stream)[0] < spec_prob
+                if not specular:
+                    random_normal = self.sampler.sphere_one(*key, ray.bounces, stream + 1)
+            if stats is not None:
+                stats.specular += specular
+                stats.diffuse += not specular
+            if specular:
                 # specular bounce
-                part_color = self.get_color(specular_ray(best_hit.p_hit, best_hit.norm, tinted_ray, ray.bounces-1))
+                part_color = self.get_color(specular_ray(best_hit.p_hit, best_hit.norm, tinted_ray, ray.bounces-1),
+                                            key=key, branch=child)
                 incoming_color += part_color.ray_color
             else:
                 # if not a specular bounce, do diffuse
-                part_color = self.get_color(ray_in_hemisphere(best_hit.p_hit, best_hit.norm, tinted_ray, ray.bounces-1))
+                part_color = self.get_color(ray_in_hemisphere(best_hit.p_hit, best_hit.norm, tinted_ray, ray.bounces-1,
+                                                              random_normal),
+                                            key=key, branch=child)
                 incoming_color += part_color.ray_color
         # take in the colors from the incoming light
         # and add to it the color of the surface
         # (behind the scenes, multiply the color of the surface to the ray, then add in the emitted light)
-        color = RayColorInfo(self.color_channels, incoming_color/n_incident_rays) + color
-
-        # make sure we don't overflow the color
-        max_c = np.max(color.ray_color)
-        if max_c > 1:
-            color.ray_color /= max_c
+        # += scales the result back down, so we don't overflow the color
+        incoming_color /= n_incident_rays
+        color += incoming_color
 
         return color
+
+
+def load_scene(path: str, camera: Camera, mmap_mode: str = "r") -> Scene:
+    """
+    Opens a scene written by Scene.save without making any objects, the arrays stay on disk and are paged in
+    as rays need them. Only the wavefront and preview modes can render it,
+    the others trace the python objects
+    :param path: Directory the scene was saved to
+    :param camera: Camera to render it through
+    :param mmap_mode: See load_compiled, None reads the whole scene into memory
+    """
+    compiled = load_compiled(path, mmap_mode)
+    if compiled.color_channels != camera.num_channels:
+        raise ValueError("Scene load: The scene has ", compiled.color_channels, " color channels, the camera ",
+                         camera.num_channels)
+    scene = Scene(camera, color=compiled.ambient)
+    scene.compiled = compiled
+    scene.dtype = compiled.dtype
+    camera.set_precision(compiled.dtype)
+    return scene
@@ -0,0 +1,184 @@
+import numpy as np
+import random
+from collections import deque
+from time import perf_counter
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+from Wavefront import WavefrontRenderer
+from PathTracer import PathTracer
+
+"""
+    Multi-core renderer, splits the frame into tiles and hands them to a pool of processes
+    Every worker gets the scene once, when it starts, and writes its tiles straight into a shared framebuffer,
+    or when streaming, sends them back to be written out to an ImageSink
+"""
+
+# per worker state, set once by _start_worker so tiles don't have to carry the scene with them
+_worker_scene = None
+_worker_framebuffer: np.ndarray = None
+_worker_memory: SharedMemory = None
+
+
+def _start_worker(scene, memory_name: str = None, shape: tuple = None):
+    global _worker_scene, _worker_framebuffer, _worker_memory
+    _worker_scene = scene
+    # streaming workers send their tiles back instead
+    if memory_name is not None:
+        _worker_memory = SharedMemory(name=memory_name)
+        _worker_framebuffer = np.ndarray(shape, dtype=scene.cam.image.dtype, buffer=_worker_memory.buf)
+
+
+def _render_tile(job: tuple) -> tuple:
+    tile_number, tile, n_bounces, n_incident_rays, n_rays, mode, seed, backend = job
+    seed_tile(seed, tile_number)
+    # the worker's copy of the scene's stats only holds this tile, the parent adds them all up
+    stats = _worker_scene.stats
+    if stats is not None:
+        stats.reset(n_bounces)
+    start = perf_counter()
+    if _worker_framebuffer is not None:
+        render_tile(_worker_scene, _worker_framebuffer, tile, n_bounces, n_incident_rays, n_rays, mode, backend)
+        colors = None
+    else:
+        colors = tile_colors(_worker_scene, tile, n_bounces, n_incident_rays, n_rays, mode, backend)
+    if stats is not None:
+        stats.add_time("total", start)
+    return tile_number, colors, stats
+
+
+def seed_tile(seed: int, tile_number: int):
+    # every tile draws from its own stream, so no matter which worker gets it or when, it comes out the same
+    tile_seed = np.random.SeedSequence([seed, tile_number]).generate_state(2)
+    np.random.seed(tile_seed[0])
+    random.seed(int(tile_seed[1]))
+
+
+def tile_colors(scene, tile: tuple, n_bounces: int, n_incident_rays: int, n_rays: int, mode: str = "recursive",
+                backend: str = "auto") -> np.ndarray:
+    """
+    Renders one tile of the scene's camera
+    :param tile: (x_start, x_stop, y_start, y_stop)
+    :param backend: Kernels for the wavefront mode, see Kernels
+    :return: [x_stop - x_start, y_stop - y_start, C] colors, laid out like Camera.image
+    """
+    x0, x1, y0, y1 = tile
+    if mode == "wavefront":
+        xs, ys = np.meshgrid(np.arange(x0, x1), np.arange(y0, y1))
+        pixels = (ys * scene.cam.x_res + xs).ravel()
+        colors = WavefrontRenderer(scene, backend=backend).render_pixels(pixels, n_bounces, n_incident_rays, n_rays)
+        return colors.reshape([y1 - y0, x1 - x0, -1]).transpose((1, 0, 2))
+    colors = np.zeros([x1 - x0, y1 - y0, scene.color_channels])
+    tracer = PathTracer(scene) if mode == "path" else None
+    for j in range(y0, y1):
+        for i in range(x0, x1):
+            colors[i - x0, j - y0] = scene.render_pixel(i, j, n_bounces, n_incident_rays, n_rays, mode, tracer=tracer)
+    return colors
+
+
+def render_tile(scene, framebuffer: np.ndarray, tile: tuple, n_bounces: int, n_incident_rays: int, n_rays: int,
+                mode: str = "recursive", backend: str = "auto"):
+    """
+    Renders one tile of the scene's camera into framebuffer
+    :param framebuffer: [x_res, y_res, C] array, laid out like Camera.image
+    :param tile: (x_start, x_stop, y_start, y_stop)
+    :param backend: Kernels for the wavefront mode, see Kernels
+    """
+    x0, x1, y0, y1 = tile
+    framebuffer[x0:x1, y0:y1] = tile_colors(scene, tile, n_bounces, n_incident_rays, n_rays, mode, backend)
+
+
+class TiledRenderer:
+    scene = None
+    workers: int = 1
+    tile_size: int = 32
+
+    def __init__(self, scene, workers: int = 1, tile_size: int = 32):
+        self.scene = scene
+        self.workers = max(1, int(workers))
+        self.tile_size = int(tile_size)
+
+    def render(self, n_bounces: int = 1, n_incident_rays: int = 1, n_rays: int = 1,
+               mode: str = "recursive", seed: int = 0, backend: str = "auto") -> np.ndarray:
+        """
+        Renders the scene's camera with a pool of worker processes
+        :param mode: "recursive", "wavefront" or "path", how each worker renders its tiles
+        :param seed: Base seed, tile k is rendered with a stream made from (seed, k)
+        :param backend: Kernels for the wavefront mode, see Kernels
+        :return: The image, same as Scene.render
+        """
+        cam = self.scene.cam
+        tiles = cam.tiles(self.tile_size)
+        shape = cam.image.shape
+        # pack the scene here, so every worker gets the compiled arrays and BVH along with it
+        self.scene.compile()
+        memory = SharedMemory(create=True, size=int(np.prod(shape)) * cam.image.dtype.itemsize)
+        try:
+            framebuffer = np.ndarray(shape, dtype=cam.image.dtype, buffer=memory.buf)
+            framebuffer[:] = 0
+            with Pool(self.workers, initializer=_start_worker, initargs=(self.scene, memory.name, shape)) as pool:
+                jobs = [(k, tile, n_bounces, n_incident_rays, n_rays, mode, seed, backend)
+                        for k, tile in enumerate(tiles)]
+                # tiles come back in whatever order they finish, the framebuffer already holds them
+                for tile_number, colors, tile_stats in pool.imap_unordered(_render_tile, jobs):
+                    if tile_stats is not None:
+                        self.scene.stats.merge(tile_stats)
+            cam.image[:] = framebuffer
+            del framebuffer
+        finally:
+            memory.close()
+            memory.unlink()
+        return cam.get_image()
+
+    def render_to(self, sink, n_bounces: int = 1, n_incident_rays: int = 1, n_rays: int = 1,
+                  mode: str = "recursive", seed: int = 0, backend: str = "auto"):
+        """
+        Renders the scene's camera into an ImageSink instead of the camera image.
+        Tiles are written out in order as they finish and only a couple per worker are ever waiting,
+        so memory grows with the tile size and the number of workers, not the size of the frame.
+        Tiles are seeded like render, so the sink ends up with the same image render would give
+        :param sink: Where the tiles go, see ImageSink. It is closed once the last tile is in, or aborted if a tile
+                     fails
+        :return: The sink
+        """
+        tiles = self.scene.cam.tiles(self.tile_size)
+        stats = self.scene.stats
+        self.scene.compile()
+        jobs = [(k, tile, n_bounces, n_incident_rays, n_rays, mode, seed, backend) for k, tile in enumerate(tiles)]
+        try:
+            if self.workers == 1:
+                # no point starting a pool for one worker
+                for tile_number, tile in enumerate(tiles):
+                    seed_tile(seed, tile_number)
+                    start = perf_counter()
+                    self.__write(sink, tile,
+                                 tile_colors(self.scene, tile, n_bounces, n_incident_rays, n_rays, mode, backend))
+                    if stats is not None:
+                        stats.add_time("total", start)
+            else:
+                with Pool(self.workers, initializer=_start_worker, initargs=(self.scene, )) as pool:
+                    waiting = deque()
+                    for job in jobs:
+                        waiting.append(pool.apply_async(_render_tile, (job, )))
+                        if len(waiting) >= 2 * self.workers:
+                            self.__collect(sink, tiles, waiting.popleft().get())
+                    while waiting:
+                        self.__collect(sink, tiles, waiting.popleft().get())
+        except BaseException:
+            # the render's own error is the one worth seeing, not the sink complaining it is unfinished
+            sink.abort()
+            raise
+        sink.close()
+        return sink
+
+    def __collect(self, sink, tiles: list, result: tuple):
+        tile_number, colors, tile_stats = result
+        if tile_stats is not None:
+            self.scene.stats.merge(tile_stats)
+        self.__write(sink, tiles[tile_number], colors)
+
+    def __write(self, sink, tile: tuple, colors: np.ndarray):
+        start = perf_counter()
+        # sinks take tiles laid out like Camera.get_image
+        sink.write_tile(tile, colors.transpose((1, 0, 2)))
+        if self.scene.stats is not None:
+            self.scene.stats.add_time("framebuffer", start)
@@ -0,0 +1,252 @@
+import numpy as np
+from time import perf_counter
+from Kernels import NumpyKernels, get_backend, scale_rows
+from Sampler import Sampler
+
+"""
+    Wavefront renderer, traces every live ray of a bounce at once as numpy arrays
+    instead of recursing through Scene.get_color one Ray at a time
+    Intersection, normals, shading and bounces go through a kernel backend, see Kernels
+"""
+
+
+class WavefrontRenderer:
+    scene = None
+    chunk_size: int = 1 << 16
+    rays_traced: int = 0
+    kernels: NumpyKernels = None
+
+    def __init__(self, scene, chunk_size: int = 1 << 16, backend: str = "auto"):
+        """
+        :param scene: Scene to render
+        :param chunk_size: Most paths traced together
+        :param backend: Kernels to trace with, "numpy", "numba" or "auto", see Kernels.get_backend
+        """
+        self.scene = scene
+        self.chunk_size = int(chunk_size)
+        self.kernels = get_backend(backend)
+
+    def render(self, n_bounces: int = 1, n_incident_rays: int = 1, n_rays: int = 1) -> np.ndarray:
+        """
+        Renders the scene's camera, following the same shading rules as Scene.get_color.
+        Instead of branching into n_incident_rays children at every bounce,
+        each primary ray is followed by n_incident_rays independent paths, so the work grows
+        linearly with the number of bounces rather than exponentially
+
+        :param n_bounces: How many times a path may bounce before it stops
+        :param n_incident_rays: Paths traced for every primary ray
+        :param n_rays: Primary rays per pixel
+        :return: The image, same as Scene.render
+        """
+        cam = self.scene.cam
+        colors = self.render_pixels(np.arange(cam.x_res * cam.y_res), n_bounces, n_incident_rays, n_rays)
+
+        start = perf_counter()
+        # pixels were generated row first, the camera image is indexed [x, y]
+        cam.image[:] = colors.reshape([cam.y_res, cam.x_res, -1]).transpose((1, 0, 2))
+        image = cam.get_image()
+        if self.scene.stats is not None:
+            self.scene.stats.add_time("framebuffer", start)
+        return image
+
+    def camera_rays(self, pixels: np.ndarray, camera_samples: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        The camera rays render_pixels starts its paths from
+        :param pixels: [N, ] flat pixel index of every ray
+        :param camera_samples: [N, ] which camera sample of its pixel every ray is,
+                               only matters when the scene's sampler jitters the rays
+        :return: [N, 3] origins, [N, 3] unit directions
+        """
+        sampler = self.scene.sampler
+        if sampler is not None and sampler.jitter:
+            return self.scene.cam.primary_rays(pixels=pixels, offsets=sampler.pixel_offsets(pixels, camera_samples))
+        return self.scene.cam.primary_rays(pixels=pixels)
+
+    def first_hits(self, pixels: np.ndarray, n_rays: int = 1) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Intersects the camera rays of a set of pixels once, for render_pixels to start from instead
+        :param pixels: Flat pixel indices (j * x_res + i)
+        :param n_rays: Camera samples per pixel, the first n_rays of each
+        :return: [M, ] t (np.inf for a miss), [M, ] object id (-1 for a miss) and [M, 3] normal (zero for a miss)
+                 of the M = len(pixels) * n_rays camera rays, the samples of a pixel one after another
+        """
+        pixels = np.asarray(pixels).reshape(-1)
+        compiled = self.scene.compile()
+        stats = self.scene.stats
+        n_rays = int(n_rays)
+        t = np.full(pixels.size * n_rays, np.inf, dtype=compiled.dtype)
+        obj = np.full(pixels.size * n_rays, -1)
+        norms = np.zeros([pixels.size * n_rays, 3], dtype=compiled.dtype)
+        pixels_per_chunk = max(1, self.chunk_size // n_rays)
+        for first in range(0, pixels.size, pixels_per_chunk):
+            chunk = pixels[first:first + pixels_per_chunk]
+            rays = slice(first * n_rays, (first + chunk.size) * n_rays)
+            start = perf_counter()
+            o, d = self.camera_rays(np.repeat(chunk, n_rays), np.tile(np.arange(n_rays), chunk.size))
+            o, d = o.astype(compiled.dtype, copy=False), d.astype(compiled.dtype, copy=False)
+            if stats is not None:
+                stats.add_time("primary", start)
+            start = perf_counter()
+            tests = stats.intersection_tests if stats is not None else None
+            t[rays], obj[rays] = self.kernels.closest_hit(compiled, o, d, tests)
+            hit = np.flatnonzero(obj[rays] >= 0)
+            norms[rays][hit] = self.kernels.normals(compiled, o[hit] + d[hit] * t[rays][hit, None], obj[rays][hit])
+            if stats is not None:
+                stats.add_time("traversal", start)
+                stats.add_rays(0, o.shape[0])
+        return t, obj, norms
+
+    def render_pixels(self, pixels: np.ndarray, n_bounces: int = 1, n_incident_rays: int = 1,
+                      n_rays: int = 1, first_sample=0, first_hits: tuple = None, touched: list = None) -> np.ndarray:
+        """
+        Renders a set of pixels without touching the camera image
+        :param pixels: Flat pixel indices (j * x_res + i)
+        :param first_sample: Camera samples each pixel already has, one number or one per pixel.
+                             Picks which of the scene sampler's numbers these paths draw, ignored without one
+        :param first_hits: What the camera rays hit, from first_hits(pixels, n_rays) with the same geometry and
+                           camera. The paths start from these instead of intersecting the camera rays again
+        :param touched: If given, (pixels, object ids) arrays of every object the pixels' paths hit are added to it,
+                        see PathRecords
+        :return: [len(pixels), C] averaged color of each pixel
+        """
+        pixels = np.asarray(pixels).reshape(-1)
+        cam, stats, sampler = self.scene.cam, self.scene.stats, self.scene.sampler
+        n_rays, n_incident_rays = int(n_rays), int(n_incident_rays)
+        samples = n_rays * n_incident_rays
+        # path k of a pixel is path k % n_incident_rays of its camera sample first_sample + k // n_incident_rays
+        first_sample = np.broadcast_to(np.asarray(first_sample), pixels.shape)
+        jitter = sampler is not None and sampler.jitter
+        if not jitter:
+            # every camera sample of a pixel is the same ray, it is made once and repeated
+            start = perf_counter()
+            origins, directions = cam.primary_rays(pixels=pixels)
+            if stats is not None:
+                stats.add_time("primary", start)
+        n_pixels = pixels.size
+        self.rays_traced = 0
+
+        colors = np.zeros([n_pixels, self.scene.color_channels], dtype=cam.dtype)
+        pixels_per_chunk = max(1, self.chunk_size // samples)
+        for start in range(0, n_pixels, pixels_per_chunk):
+            stop = min(start + pixels_per_chunk, n_pixels)
+            camera_samples = np.repeat(first_sample[start:stop], n_rays) + np.tile(np.arange(n_rays), stop - start)
+            if jitter:
+                # each camera sample goes through its own spot in the pixel, its paths all start from that ray
+                primary_start = perf_counter()
+                o, d = self.camera_rays(np.repeat(pixels[start:stop], n_rays), camera_samples)
+                o = np.repeat(o, n_incident_rays, axis=0)
+                d = np.repeat(d, n_incident_rays, axis=0)
+                if stats is not None:
+                    stats.add_time("primary", primary_start)
+            else:
+                o = np.repeat(origins[start:stop], samples, axis=0)
+                d = np.repeat(directions[start:stop], samples, axis=0)
+            path_pixels = np.repeat(pixels[start:stop], samples)
+            path_samples = (np.repeat(camera_samples * n_incident_rays, n_incident_rays) +
+                            np.tile(np.arange(n_incident_rays), camera_samples.size))
+            path_hits = None
+            if first_hits is not None:
+                path_hits = tuple(np.repeat(a[start * n_rays:stop * n_rays], n_incident_rays, axis=0)
+                                  for a in first_hits)
+            path_touched = [] if touched is not None else None
+            path_colors = self.trace(o, d, n_bounces, path_pixels, path_samples, path_hits, path_touched)
+            if touched is not None and path_touched:
+                # one pair per pixel and object, however many of its paths hit it
+                pairs = np.unique(np.concatenate([np.stack([path_pixels[paths], objects], axis=1)
+                                                  for paths, objects in path_touched]), axis=0)
+                touched.append((pairs[:, 0], pairs[:, 1]))
+            colors[start:stop] = path_colors.reshape([stop - start, samples, -1]).mean(axis=1)
+        return colors
+
+    def trace(self, origins: np.ndarray, directions: np.ndarray, n_bounces: int, pixels: np.ndarray = None,
+              samples: np.ndarray = None, first_hits: tuple = None, touched: list = None) -> np.ndarray:
+        """
+        Follows a batch of paths through the scene, one bounce per step.
+        Every step intersects, shades and spawns the next rays for the whole active set,
+        rays that miss or run out of bounces drop out of it
+
+        :param origins: [N, 3] starting points
+        :param directions: [N, 3] unit directions
+        :param n_bounces: Bounces left for every ray
+        :param pixels: [N, ] pixel of every path, with samples the key its random numbers are drawn with
+                       when the scene has a sampler. The global numpy stream is used otherwise
+        :param samples: [N, ] which path of its pixel each one is
+        :param first_hits: ([N, ] t, [N, ] object id, [N, 3] normal) of the first hit of every path,
+                           already known, so the first step skips intersecting
+        :param touched: If given, ([M, ] path, [M, ] object id) arrays of every hit are added to it
+        :return: [N, C] color gathered by each path
+        """
+        compiled = self.scene.compile()
+        kernels = self.kernels
+        stats = self.scene.stats
+        sampler = self.scene.sampler if pixels is not None else None
+        tests = stats.intersection_tests if stats is not None else None
+        n_channels = compiled.color_channels
+        material_color, emitted = compiled.material_color, compiled.material_emitted
+        shown, spec_prob = compiled.material_shown, compiled.material_specular
+
+        # every buffer follows the precision the scene was compiled in
+        dtype = compiled.dtype
+        n = origins.shape[0]
+        o = origins.astype(dtype, copy=False)
+        d = directions.astype(dtype, copy=False)
+        active = np.arange(n)
+        throughput = np.ones([n, n_channels], dtype=dtype)
+        # light picked up at each bounce, Scene.get_color folds it together on the way back up
+        picked_up = np.zeros([n_bounces + 1, n, n_channels], dtype=dtype)
+        final = np.zeros([n, n_channels], dtype=dtype)
+
+        for depth in range(n_bounces + 1):
+            if active.size == 0:
+                break
+            cached = depth == 0 and first_hits is not None
+            if cached:
+                t, hit_obj = first_hits[0].astype(dtype, copy=False), first_hits[1]
+            else:
+                self.rays_traced += active.size
+                start = perf_counter()
+                t, hit_obj = kernels.closest_hit(compiled, o, d, tests)
+
+            # misses take on the ambient color and stop
+            missed = hit_obj < 0
+            if stats is not None and not cached:
+                stats.add_time("traversal", start)
+                stats.add_rays(depth, active.size)
+                stats.misses += int(missed.sum())
+                stats.hits += int(missed.size - missed.sum())
+            final[active[missed]] = throughput[missed] * compiled.ambient
+
+            hit = ~missed
+            active, o, d, t = active[hit], o[hit], d[hit], t[hit]
+            throughput, hit_obj = throughput[hit], hit_obj[hit]
+            if touched is not None:
+                touched.append((active, hit_obj))
+            hit_mat = compiled.object_material[hit_obj]
+            picked_up[depth, active] = throughput * shown[hit_mat]
+            if depth == n_bounces:
+                break
+
+            p = o + d * t[:, None]
+            norms = first_hits[2][active].astype(dtype, copy=False) if cached else kernels.normals(compiled, p, hit_obj)
+
+            # tint the ray with the material, then pick a specular or diffuse bounce
+            throughput = kernels.shade(throughput, hit_mat, material_color, emitted)
+            if sampler is None:
+                specular = np.random.random(active.size) < spec_prob[hit_mat]
+                random_normals = np.random.standard_normal([int((~specular).sum()), 3])
+            else:
+                decisions = sampler.uniform(pixels[active], samples[active], depth, Sampler.DECISIONS)
+                specular = decisions[:, 0] < spec_prob[hit_mat]
+                diffuse = active[~specular]
+                random_normals = sampler.sphere(pixels[diffuse], samples[diffuse], depth, Sampler.DIRECTION)
+            if stats is not None:
+                stats.specular += int(specular.sum())
+                stats.diffuse += int(specular.size - specular.sum())
+            random_normals = random_normals.astype(dtype, copy=False)
+            d = kernels.bounce(d, norms, specular, random_normals)
+            o = p
+
+        color = final
+        for depth in range(n_bounces, -1, -1):
+            color = scale_rows(color + picked_up[depth])
+        return color